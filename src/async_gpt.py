@@ -0,0 +1,133 @@
+import asyncio
+import contextlib
+import time
+from typing import Hashable
+
+from rate_limiter import estimate_tokens
+from key_pool import NoKeyAvailable, get_key_pool
+from response_cache import get_cache, cache_disabled
+from resilience import call_with_retry_async, POLICIES
+from ledger import get_ledger
+from profiling import span
+
+
+DEFAULT_CONCURRENCY = 8
+
+
+async def get_response_GPT_async(prompt: str,
+                                 api_key: str | None=None,
+                                 semaphore: asyncio.Semaphore | None=None,
+                                 use_cache: bool=True) -> str:
+    """
+    Asynchronous version of `functions.get_response_GPT` with the same prompt-in/text-out contract.
+    The API key and organization are passed per request instead of being set globally,
+    and every attempt takes the key with the most RPM/TPM budget left (see `key_pool`).
+
+    Args:
+        prompt (str): prompt for ChatGPT
+        api_key (str | None, optional): name of the env variable with API key, None for the key pool. Defaults to None.
+        semaphore (asyncio.Semaphore | None, optional): limits requests in flight. Defaults to None.
+        use_cache (bool, optional): serve and store the response in the response cache. Defaults to True.
+
+    Returns:
+        str: response content or None if the request failed
+    """
+    use_cache = use_cache and not cache_disabled()
+    cache_key = get_cache().make_key(model='gpt-3.5-turbo', prompt=prompt, temperature=0)
+    if use_cache and (cached := get_cache().get(cache_key)) is not None:
+        get_ledger().record('gpt-3.5-turbo', cached=True)
+        return cached
+    import openai
+    pool = get_key_pool(api_key)
+    reserved = estimate_tokens(prompt)
+    start, call = time.perf_counter(), {'attempts': 0, 'latency': 0.0}
+    # waits for a key count against the retry deadline too
+    deadline = time.monotonic() + POLICIES['openai'].deadline
+
+    async def request():
+        key = await pool.checkout_async(reserved, deadline=deadline)
+        call['attempts'] += 1
+        request_start = time.perf_counter()
+        try:
+            # the timeout covers the request only, not the wait for the budget
+            with span('request.chat'):
+                return key, await asyncio.wait_for(openai.ChatCompletion.acreate(model='gpt-3.5-turbo',
+                                                                                 messages=[{'role': 'user', 'content': prompt}],
+                                                                                 temperature=0,
+                                                                                 request_timeout=POLICIES['openai'].timeout,
+                                                                                 **key.credentials),
+                                                   timeout=POLICIES['openai'].timeout)
+        except openai.OpenAIError as err:
+            pool.report_error(key, err)
+            # a request the API answered with an error used no tokens, a timed out one may have
+            if getattr(err, 'http_status', None): pool.settle(key, reserved, 0)
+            raise
+        finally:
+            call['latency'] = time.perf_counter() - request_start
+
+    async with semaphore or contextlib.nullcontext():
+        try:
+            # transient errors are retried with backoff
+            key, response = await call_with_retry_async(request, policy=POLICIES['openai'], name='openai.chat')
+            pool.settle(key, reserved, response['usage']['total_tokens'])
+            get_ledger().record('gpt-3.5-turbo', response['usage']['prompt_tokens'], response['usage']['completion_tokens'],
+                                latency_s=call['latency'], total_s=time.perf_counter() - start, retries=call['attempts'] - 1)
+            content = response['choices'][0]['message']['content']
+            if use_cache: get_cache().set(cache_key, content)
+            return content
+        except (openai.OpenAIError, NoKeyAvailable, asyncio.TimeoutError) as err:
+            get_ledger().record('gpt-3.5-turbo', total_s=time.perf_counter() - start, retries=max(0, call['attempts'] - 1), error=repr(err))
+            print("An error occurred during the OpenAI request:", repr(err))
+            return None
+
+
+async def gather_responses_GPT(prompts: dict[Hashable, str],
+                               concurrency: int=DEFAULT_CONCURRENCY,
+                               api_key: str | None=None) -> dict:
+    """
+    Sends all prompts keeping up to `concurrency` requests in flight and collects results as they finish.
+    Keys are arbitrary, e.g. option numbers of one city or (city, number) tuples for many cities.
+
+    Args:
+        prompts (dict[Hashable, str]): prompts by key
+        concurrency (int, optional): max requests in flight. Defaults to DEFAULT_CONCURRENCY.
+        api_key (str | None, optional): name of the env variable with API key, None for the key pool. Defaults to None.
+
+    Returns:
+        dict: responses by the same keys, None for failed requests
+    """
+    import aiohttp
+    import openai
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(key, prompt):
+        return key, await get_response_GPT_async(prompt, api_key, semaphore)
+
+    results = dict()
+    # one keep-alive connection pool for the whole batch
+    async with aiohttp.ClientSession() as session:
+        openai.aiosession.set(session)
+        try:
+            for future in asyncio.as_completed([worker(key, prompt) for key, prompt in prompts.items()]):
+                key, response = await future
+                results[key] = response
+        finally:
+            openai.aiosession.set(None)
+    return results
+
+
+def get_responses_GPT(prompts: dict[Hashable, str],
+                      concurrency: int=DEFAULT_CONCURRENCY,
+                      api_key: str | None=None) -> dict:
+    """
+    Blocking entry point for scripts: runs `gather_responses_GPT` in a new event loop.
+
+    Args:
+        prompts (dict[Hashable, str]): prompts by key
+        concurrency (int, optional): max requests in flight. Defaults to DEFAULT_CONCURRENCY.
+        api_key (str | None, optional): name of the env variable with API key, None for the key pool. Defaults to None.
+
+    Returns:
+        dict: responses by the same keys, None for failed requests
+    """
+    return asyncio.run(gather_responses_GPT(prompts, concurrency, api_key))
@@ -0,0 +1,94 @@
+from typing import Hashable
+
+from async_gpt import get_responses_GPT
+from response_schema import Schema, repair_json, complete_responses
+from ledger import call_context
+
+
+BATCH_SIZE = 5
+BATCH_TEMPLATE = ('Complete each of the following {n} tasks independently of each other. '
+                  'Return only a JSON array of {n} objects in the same order as the tasks, without any other text. '
+                  'Each object must have the key "id" with the task id and the key "answer" '
+                  'with the JSON object that the task asks for.\n\n{tasks}')
+
+
+def loads_response(response: str) -> dict | list | None:
+    """
+    Parses a JSON response, see `response_schema.repair_json`.
+
+    Args:
+        response (str): response content
+
+    Returns:
+        dict | list | None: parsed JSON or None if it can't be parsed
+    """
+    return repair_json(response)
+
+
+def compose_batch_prompt(prompts: dict[Hashable, str]) -> str:
+    tasks = '\n\n'.join(f'Task id {key}:\n{prompt}' for key, prompt in prompts.items())
+    return BATCH_TEMPLATE.format(n=len(prompts), tasks=tasks)
+
+
+def split_batch_response(response: str, keys: list) -> dict:
+    """
+    Splits a combined answer back into per-task records. Tasks with a missing or
+    non-object answer are left out, so they can be retried on their own.
+
+    Args:
+        response (str): response content for a batch prompt
+        keys (list): task keys of the batch
+
+    Returns:
+        dict: parsed answers by task key
+    """
+    parsed = loads_response(response)
+    if isinstance(parsed, dict):
+        # a single object instead of an array, e.g. {"tasks": [...]}
+        parsed = next((value for value in parsed.values() if isinstance(value, list)), [])
+    if not isinstance(parsed, list):
+        return dict()
+    by_id = {str(key): key for key in keys}
+    answers = dict()
+    for item in parsed:
+        if not isinstance(item, dict) or str(item.get('id')) not in by_id:
+            continue
+        if isinstance(item.get('answer'), dict):
+            answers[by_id[str(item['id'])]] = item['answer']
+    return answers
+
+
+def get_batched_responses(prompts: dict[Hashable, str], batch_size: int=BATCH_SIZE, schema: Schema | None=None) -> dict:
+    """
+    Packs up to `batch_size` prompts into one request and splits the JSON array answer
+    back into per-prompt records. Only the prompts whose answers are missing or failed
+    to parse are sent again on their own. With a schema the answers are validated too,
+    and only their missing or invalid fields are asked again (see `response_schema.complete_responses`).
+
+    Args:
+        prompts (dict[Hashable, str]): prompts by key, each asking for a JSON object
+        batch_size (int, optional): prompts per request. Defaults to BATCH_SIZE.
+        schema (Schema | None, optional): expected fields of every answer. Defaults to None.
+
+    Returns:
+        dict: parsed JSON answers by the same keys, None for prompts that failed twice
+              (SchemaError with a schema)
+    """
+    keys = list(prompts)
+    batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+    with call_context(prompt_key=f'{schema.name}:batch' if schema else 'batch'):
+        responses = get_responses_GPT({i: compose_batch_prompt({key: prompts[key] for key in batch})
+                                       for i, batch in enumerate(batches) if len(batch) > 1})
+    results = dict()
+    for i, batch in enumerate(batches):
+        if i in responses:
+            results.update(split_batch_response(responses[i], batch))
+    if schema:
+        return complete_responses(prompts, results, schema)
+    failed = [key for key in keys if key not in results]
+    if failed:
+        retried = get_responses_GPT({key: prompts[key] for key in failed})
+        for key in failed:
+            parsed = loads_response(retried[key])
+            results[key] = parsed if isinstance(parsed, dict) else None
+    return results
@@ -0,0 +1,359 @@
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+
+BENCH_DIR = Path(__file__).resolve().parent.parent/'files'/'bench'
+FIXTURES_DIR = BENCH_DIR/'fixtures'
+BASELINE_PATH = BENCH_DIR/'baseline.json'
+SIZES = (512, 1024)
+# distinct images generated per size, the fixture files are copies of them
+DISTINCT_IMAGES = 8
+TOLERANCE = 0.2
+WORDS = ('city', 'old', 'town', 'museum', 'river', 'square', 'market', 'cathedral', 'harbour', 'view', 'local', 'food',
+         'street', 'walk', 'park', 'history', 'gallery', 'bridge', 'castle', 'night', 'festival', 'family', 'garden', 'tour')
+COUNTRIES = ('Portugal', 'Spain', 'France', 'Italy', 'Greece', 'Türkiye', 'Poland', 'Norway', 'Japan', 'Brazil')
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def _paragraph(rng: random.Random, sentences: int=4) -> str:
+    return ' '.join(_sentence(rng, rng.randint(8, 16)) for _ in range(sentences))
+
+
+def synthetic_image(rng: random.Random, size: int):
+    """
+    Noise blurred to photo-like detail, so the JPEGs have realistic sizes and decode costs.
+    """
+    from PIL import Image, ImageFilter
+    channels = [Image.effect_noise((size, size), rng.randint(40, 90)).filter(ImageFilter.GaussianBlur(rng.uniform(1, 3)))
+                for _ in range(3)]
+    return Image.merge('RGB', channels)
+
+
+def make_fixtures(root: Path | str=FIXTURES_DIR, cities: int=20, options: int=10, seed: int=0) -> dict:
+    """
+    Builds the synthetic fixtures, unless the same ones already exist:
+    cities.csv with `cities` rows, images/<city>/<n>_<option>.jpg (`options` per city, 512 and 1024 px),
+    content/<city>.json with `options` SEO options and texts.json with SMM texts.
+
+    Args:
+        root (Path | str, optional): fixtures folder. Defaults to FIXTURES_DIR.
+        cities (int, optional): number of cities. Defaults to 20.
+        options (int, optional): options per city. Defaults to 10.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: fixture parameters
+    """
+    root = Path(root)
+    params = {'cities': cities, 'options': options, 'seed': seed, 'sizes': list(SIZES)}
+    params_path = root/'params.json'
+    if params_path.exists() and json.loads(params_path.read_text()) == params:
+        return params
+    shutil.rmtree(root, ignore_errors=True)
+    root.mkdir(parents=True)
+    rng = random.Random(seed)
+    images = dict()
+    for size in SIZES:
+        images[size] = []
+        for _ in range(DISTINCT_IMAGES):
+            buffer = io.BytesIO()
+            synthetic_image(rng, size).save(buffer, format='JPEG', quality=90)
+            images[size].append(buffer.getvalue())
+    rows, texts = ['id_city,city,country'], []
+    for i in range(cities):
+        # a few names with diacritics and spaces, like the real table
+        city = f'{rng.choice(("Porto", "Malmö", "São Paulo", "Zürich", "Rio de Janeiro", "Kraków"))} {i:04d}'
+        rows.append(f'{i + 1},{city},{rng.choice(COUNTRIES)}')
+        slug = city.replace(' ', '_')
+        content = dict()
+        for j in range(1, options + 1):
+            option = f'{rng.choice(WORDS).capitalize()} {rng.choice(WORDS).capitalize()}'
+            size = SIZES[j % len(SIZES)]
+            (root/'images'/slug).mkdir(parents=True, exist_ok=True)
+            (root/'images'/slug/f'{j}_{option.replace(" ", "_")}.jpg').write_bytes(rng.choice(images[size]))
+            content[str(j)] = {'name': option, 'location': city, 'meta': _sentence(rng, 20),
+                               'keywords': ', '.join(rng.sample(WORDS, 6)), 'title': _sentence(rng, 8),
+                               'text': '\n\n'.join(_paragraph(rng) for _ in range(5)),
+                               'links': [f'https://example.com/{slug}/{j}/{k}' for k in range(3)],
+                               'image': f'http://127.0.0.1/files/images/{slug}/{j}.jpg'}
+            texts.append('\n'.join([_sentence(rng, 6), *[_paragraph(rng) for _ in range(3)]]) + '\n\n'
+                         + ' '.join(f'#{word}' for word in rng.sample(WORDS, 5)) + '\n\n'
+                         + f'More: https://example.com/{slug}/{j}')
+        (root/'content').mkdir(exist_ok=True)
+        (root/'content'/f'{slug}.json').write_text(json.dumps(content, indent=4, ensure_ascii=False), encoding='utf-8')
+    (root/'cities.csv').write_text('\n'.join(rows) + '\n', encoding='utf-8')
+    (root/'texts.json').write_text(json.dumps(texts, ensure_ascii=False), encoding='utf-8')
+    params_path.write_text(json.dumps(params))
+    return params
+
+
+def _dir_bytes(path: Path) -> int:
+    return sum(p.stat().st_size for p in Path(path).rglob('*') if p.is_file())
+
+
+def _raise_printed_errors(output: str) -> None:
+    # the resize functions print their errors instead of raising, a run with errors measures nothing
+    errors = [line for line in output.splitlines() if 'rror' in line or 'wrong' in line]
+    if errors:
+        raise RuntimeError(f'{len(errors)} errors, first: {errors[0]}')
+
+
+def bench_resize_image(fixtures: Path, work: Path) -> dict:
+    from functions import resize_image
+    shutil.copytree(fixtures/'images', work/'images')
+    files = sorted((work/'images').rglob('*.jpg'))
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        for file_path in files:
+            resize_image(file_path, (800, 800))
+    seconds = time.perf_counter() - start
+    _raise_printed_errors(output.getvalue())
+    return {'ops': len(files), 'seconds': seconds, 'bytes': _dir_bytes(work/'images')}
+
+
+def bench_resize_images(fixtures: Path, work: Path) -> dict:
+    from functions import resize_images
+    shutil.copytree(fixtures/'images', work/'images')
+    # resize_images only picks up '.jpeg' files
+    files = sorted((work/'images').rglob('*.jpg'))
+    for file_path in files:
+        file_path.rename(file_path.with_suffix('.jpeg'))
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        resize_images(work/'images', (800, 800))
+    seconds = time.perf_counter() - start
+    _raise_printed_errors(output.getvalue())
+    return {'ops': len(files), 'seconds': seconds, 'bytes': _dir_bytes(work/'images')}
+
+
+def bench_compress_jpeg_images(fixtures: Path, work: Path) -> dict:
+    from compress_images import compress_jpeg_images
+    shutil.copytree(fixtures/'images', work/'images')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary = compress_jpeg_images(str(work/'images'), quality=80, incremental=False)
+    if summary['failed']:
+        raise RuntimeError(f'{summary["failed"]} images failed')
+    return {'ops': summary['compressed'], 'seconds': time.perf_counter() - start, 'bytes': summary['bytes_out']}
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+
+def bench_download_decode_resize(fixtures: Path, work: Path) -> dict:
+    """
+    `ImageDownloader.fetch` against a loopback HTTP server: streaming, decode, resize and save.
+    """
+    from image_downloader import ImageDownloader
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(_QuietHandler, directory=str(fixtures)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    downloader = ImageDownloader()
+    files = sorted((fixtures/'images').rglob('*.jpg'))
+    try:
+        start = time.perf_counter()
+        for file_path in files:
+            relative = file_path.relative_to(fixtures).as_posix()
+            downloader.fetch(f'http://127.0.0.1:{server.server_port}/{relative}', work/relative, size=(800, 800))
+        seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+    return {'ops': len(files), 'seconds': seconds, 'bytes': _dir_bytes(work)}
+
+
+def bench_clean_text(fixtures: Path, work: Path, rounds: int=20) -> dict:
+    from compose_posts import clean_text
+    texts = json.loads((fixtures/'texts.json').read_text(encoding='utf-8'))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            clean_text(text)
+    return {'ops': rounds * len(texts), 'seconds': time.perf_counter() - start, 'bytes': 0}
+
+
+def bench_provider_lookups(fixtures: Path, work: Path, rounds: int=200) -> dict:
+    from data_provider import CSVDataProvider
+    provider = CSVDataProvider(str(fixtures/'cities.csv'))
+    names = list(provider.df['city'])
+    variants = [name.lower() for name in names]
+    start = time.perf_counter()
+    ops = 0
+    for _ in range(rounds):
+        for name, variant in zip(names, variants):
+            provider.get_city_name(provider.get_city_id(name))
+            provider.get_city_id(variant)
+            provider.get_city_slug(name)
+        provider.get_city_ids(variants)
+        ops += 3 * len(names) + len(variants)
+    ops += sum(1 for _ in provider.gen_data())
+    return {'ops': ops, 'seconds': time.perf_counter() - start, 'bytes': 0}
+
+
+def bench_json_load_dump(fixtures: Path, work: Path, rounds: int=5) -> dict:
+    from functions import load_json
+    files = sorted((fixtures/'content').glob('*.json'))
+    (work/'content').mkdir(parents=True)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for file_path in files:
+            content = load_json(file_path)
+            tmp_path = work/'content'/f'{file_path.stem}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as fp:
+                json.dump(content, fp, indent=4)
+            os.replace(tmp_path, work/'content'/file_path.name)
+    return {'ops': rounds * len(files), 'seconds': time.perf_counter() - start, 'bytes': rounds * _dir_bytes(work/'content')}
+
+
+def bench_content_store(fixtures: Path, work: Path) -> dict:
+    """
+    Import of the content tree into a fresh store and export back to per-city JSON.
+    """
+    from content_store import ContentStore
+    from data_provider import CSVDataProvider
+    store = ContentStore(work/'content.sqlite')
+    provider = CSVDataProvider(str(fixtures/'cities.csv'))
+    start = time.perf_counter()
+    cities = store.import_dir('bench', fixtures/'content', provider=provider)
+    store.export('bench', work/'export')
+    return {'ops': 2 * cities, 'seconds': time.perf_counter() - start, 'bytes': _dir_bytes(work)}
+
+
+BENCHMARKS = {
+    'resize_image': bench_resize_image,
+    'resize_images': bench_resize_images,
+    'compress_jpeg_images': bench_compress_jpeg_images,
+    'download_decode_resize': bench_download_decode_resize,
+    'clean_text': bench_clean_text,
+    'provider_lookups': bench_provider_lookups,
+    'json_load_dump': bench_json_load_dump,
+    'content_store': bench_content_store,
+}
+
+
+def _run_in_child(name: str, fixtures: str, work: str) -> dict:
+    # every run is a fresh process, so the peak RSS belongs to this benchmark only (in KB on Linux)
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    result = BENCHMARKS[name](Path(fixtures), Path(work))
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {**result, 'peak_rss_mb': peak_kb / 1024}
+
+
+def run_benchmark(name: str, fixtures: Path | str=FIXTURES_DIR, repeat: int=3) -> dict:
+    """
+    Runs a benchmark `repeat` times, each in a new process on a fresh copy of the fixtures.
+
+    Args:
+        name (str): one of BENCHMARKS
+        fixtures (Path | str, optional): fixtures folder. Defaults to FIXTURES_DIR.
+        repeat (int, optional): number of runs. Defaults to 3.
+
+    Returns:
+        dict: median ops/sec, median seconds, max peak RSS in MB, bytes written per run and the error of a failed run
+    """
+    runs = []
+    context = multiprocessing.get_context('spawn')
+    for i in range(repeat):
+        work = Path(fixtures).parent/'work'/f'{name}_{i}'
+        shutil.rmtree(work, ignore_errors=True)
+        work.mkdir(parents=True)
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                runs.append(executor.submit(_run_in_child, name, str(fixtures), str(work)).result())
+        except Exception as err:
+            return {'error': f'{type(err).__name__}: {err}'}
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+    return {'ops': runs[0]['ops'],
+            'seconds': statistics.median(run['seconds'] for run in runs),
+            'ops_per_s': statistics.median(run['ops'] / run['seconds'] for run in runs if run['seconds']),
+            'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+            'bytes': runs[-1]['bytes'],
+            'error': None}
+
+
+def compare(results: dict, baseline: dict, tolerance: float=TOLERANCE) -> list:
+    """
+    Returns:
+        list: messages about the benchmarks that got slower or use more memory than the baseline allows
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', dict()).get(name)
+        if not base or base.get('error'):
+            continue
+        # a benchmark that used to pass and now crashes is the worst regression
+        if result['error']:
+            regressions.append(f'{name}: failed with {result["error"]}, baseline passed')
+            continue
+        if result['ops_per_s'] < base['ops_per_s'] * (1 - tolerance):
+            regressions.append(f'{name}: {result["ops_per_s"]:.1f} ops/s, baseline {base["ops_per_s"]:.1f}')
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f'{name}: peak RSS {result["peak_rss_mb"]:.0f} MB, baseline {base["peak_rss_mb"]:.0f}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the local CPU and disk bound stages on synthetic fixtures')
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS), help=f'Benchmarks to run: {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('--cities', type=int, default=20, help='Synthetic cities (default: 20)')
+    parser.add_argument('--options', type=int, default=10, help='Options per city (default: 10)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark (default: 3)')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='Exit with an error if a benchmark regressed against the baseline')
+    parser.add_argument('--baseline', type=str, default=str(BASELINE_PATH), help='Baseline file (default: files/bench/baseline.json)')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help=f'Allowed slowdown or memory growth (default: {TOLERANCE})')
+    args = parser.parse_args()
+    if unknown := [name for name in args.benchmarks if name not in BENCHMARKS]:
+        parser.error(f'unknown benchmarks: {", ".join(unknown)}')
+
+    params = make_fixtures(FIXTURES_DIR, args.cities, args.options)
+    print(f'Fixtures: {args.cities} cities x {args.options} options in {FIXTURES_DIR}')
+    results = dict()
+    for name in args.benchmarks:
+        results[name] = result = run_benchmark(name, FIXTURES_DIR, args.repeat)
+        if result['error']:
+            print(f'{name:24} FAILED: {result["error"]}')
+            continue
+        print(f'{name:24} {result["ops_per_s"]:10.1f} ops/s {result["seconds"]:8.3f} s '
+              f'{result["peak_rss_mb"]:7.0f} MB peak {result["bytes"] / 1024 / 1024:8.1f} MB written')
+
+    regressions = []
+    baseline_path = Path(args.baseline)
+    if args.compare:
+        if not baseline_path.exists():
+            print(f'No baseline in {baseline_path}')
+        else:
+            baseline = json.loads(baseline_path.read_text())
+            if baseline.get('params') != params:
+                print(f'The baseline was measured on other fixtures: {baseline.get("params")}')
+            else:
+                regressions = compare(results, baseline, args.tolerance)
+                for message in regressions:
+                    print(f'REGRESSION {message}')
+    if args.save_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps({'params': params, 'python': sys.version.split()[0], 'results': results}, indent=4))
+        print(f'Baseline saved to {baseline_path}')
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,70 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+SRC_DIR = Path(__file__).resolve().parent
+ENTRY_POINTS = ['functions', 'data_provider', 'cheap_eats_option', 'city_description_edit', 'compose_posts',
+                'compress_images', 'generate_images', 'generate_texts', 'seo_accomodations', 'seo_children_attractions',
+                'seo_city_attractions', 'seo_city_descriptions', 'seo_events_festivals', 'seo_events_festivals_collect',
+                'pipeline', 'renditions']
+
+
+def time_import(module: str, repeat: int=5) -> dict:
+    """
+    Measures the cold start of an entry point: a fresh interpreter importing the module
+    (which runs its module-level setup, but not its __main__ block).
+
+    Args:
+        module (str): module name in the src folder
+        repeat (int, optional): number of runs. Defaults to 5.
+
+    Returns:
+        dict: median and min wall time in ms, the heaviest imports and the error of a failed import
+    """
+    timings, imports, error = [], [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                cwd=SRC_DIR, capture_output=True, text=True)
+        timings.append((time.perf_counter() - start) * 1000)
+        if result.returncode:
+            error = result.stderr.strip().splitlines()[-1]
+            break
+    else:
+        # -X importtime lines: "import time: self [us] | cumulative | imported package"
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if line.startswith('import time:') and len(parts) == 3 and parts[1].strip().isdigit():
+                # nested imports are indented below the module that imported them
+                depth = len(parts[2]) - len(parts[2].lstrip())
+                imports.append((int(parts[1]) / 1000, parts[2].strip(), depth))
+    top_level = [(ms, name) for ms, name, depth in imports if depth == 1]
+    return {'median_ms': statistics.median(timings), 'min_ms': min(timings),
+            'heaviest': sorted(top_level, reverse=True)[:5], 'error': error}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the import time of the entry points')
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS, help='Modules to measure (default: all entry points)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per module (default: 5)')
+    parser.add_argument('--max-ms', type=float, default=None, help='Exit with an error if a median exceeds this (optional)')
+    parser.add_argument('--json', type=str, default=None, help='Save the results to a JSON file (optional)')
+    args = parser.parse_args()
+
+    results = dict()
+    for module in args.modules:
+        results[module] = result = time_import(module, args.repeat)
+        if result['error']:
+            print(f'{module:32} FAILED: {result["error"]}')
+            continue
+        heaviest = ', '.join(f'{name} {ms:.0f}ms' for ms, name in result['heaviest'])
+        print(f'{module:32} {result["median_ms"]:8.0f} ms (min {result["min_ms"]:.0f})  {heaviest}')
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=4))
+    if args.max_ms and any(r['median_ms'] > args.max_ms for r in results.values() if not r['error']):
+        sys.exit(1)
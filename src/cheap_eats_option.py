@@ -1,89 +1,108 @@
-from data_provider import CSVDataProvider
+from data_provider import get_provider
 import functions 
+from response_schema import SCHEMAS, SchemaError, get_structured_responses, repair_json
+from journal import Journal
+from ledger import set_context
+from content_store import get_store
 from config import PROMPTS_DIR, OPTION_LISTS_DIR, SEO_TEXTS_DIR
-import json
 from pathlib import Path
 from logger import logger_setup
-from datetime import datetime
 
 
-dp = CSVDataProvider()
-timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-logger = logger_setup(f'{Path(__file__).stem}_{timestamp}')
+dp = get_provider()
+logger = logger_setup(Path(__file__).stem)
 
 
-def get_cheap_eats_options():
+def get_cheap_eats_options(replay_failed=False, cities=None):
+    journal = Journal('cheap_eats_options')
     save_dir = Path(f'{OPTION_LISTS_DIR}/cheap_eats')
     save_dir.mkdir(parents=True, exist_ok=True)
-    logger.info(f'Making output dir...SUCCESSFULLY')
+    logger.info('Making output dir...SUCCESSFULLY')
     prompts = functions.get_prompts_GPT(f'{PROMPTS_DIR}/cheap_eats.json')
-    logger.info(f'Getting prompts...SUCCESSFULLY')
+    logger.info('Getting prompts...SUCCESSFULLY')
     j = 1
-    for city, country in dp.gen_data():
-        city_ = city.replace(' ', '_').replace('-', '_')
-        # if city_ in [c.stem for c in save_dir.glob('*.json')]: continue
-        logger.info(f'Processing {city}, {country}...')
+    for city, country in cities or dp.gen_data():
+        set_context(category='cheap_eats_options', city=city, option=None)
+        city_ = dp.get_city_slug(city)
+        if journal.is_done(city, 'options'):
+            # the journal alone doesn't make a city done, a deleted option file is restored from it
+            if not (save_dir/f'{city_}.json').exists():
+                get_store().save_city('cheap_eats_options', city, journal.get(city, 'options'), save_dir)
+                logger.info('Restoring options of %s from the journal...SUCCESS', city)
+            continue
+        if replay_failed and city not in journal.failed_cities(): continue
+        logger.info('Processing %s, %s...', city, country)
         prompt = prompts['options'].format(city=city, country=country)
         try:
             response = functions.get_response_GPT(prompt)
-            logger.info(f'Getting response...SUCCESSFULLY')
-            parsed = json.loads(response)
-            logger.info(f'Parsing response...SUCCESSFULLY')
-            with open(Path(f'{save_dir}/{city_}.json'), 'w') as fp:
-                json.dump(parsed, fp, indent=4)
-            logger.info(f'Saving data...SUCCESSFULLY')
+            logger.info('Getting response...SUCCESSFULLY')
+            parsed = repair_json(response)
+            if not isinstance(parsed, dict): raise ValueError(f'Unparseable option list: {response}')
+            logger.info('Parsing response...SUCCESSFULLY')
+            get_store().save_city('cheap_eats_options', city, parsed, save_dir)
+            logger.info('Saving data...SUCCESSFULLY')
+            journal.record(city, 'options', parsed)
         except Exception as err:
-            logger.error(f'Error: {err} while processing {city}, {country}')
+            logger.error('Error: %s while processing %s, %s', err, city, country)
+            journal.fail(city, 'options', err)
             continue
-        logger.info(f'Completed {city}, {country} SUCCESSFULLY. Total score: {j}/{dp.numrows}')
+        logger.info('Completed %s, %s SUCCESSFULLY. Total score: %s/%s', city, country, j, dp.numrows)
         j += 1
 
 
 @functions.elapsed_time
-def gen_content():
+def gen_content(replay_failed=False, cities=None):
     category = 'cheap_eats'
+    journal = Journal(category)
     base_url = f'http://20.240.63.21/files/images/{category}'
     save_dir = Path(f'{SEO_TEXTS_DIR}/{category}')
     save_dir.mkdir(parents=True, exist_ok=True)
-    logger.info(f'Making output dir...SUCCESSFULLY')
+    logger.info('Making output dir...SUCCESSFULLY')
     prompts = functions.get_prompts_GPT(f'{PROMPTS_DIR}/{category}.json')
-    logger.info(f'Getting prompts...SUCCESSFULLY')
+    logger.info('Getting prompts...SUCCESSFULLY')
     j = 1
-    for city, country in dp.gen_data():
-        logger.info(f'Processing {city}, {country} started...')
-        city_ = city.replace(' ', '_').replace('-', '_')
+    for city, country in cities or dp.gen_data():
+        if replay_failed and city not in journal.failed_cities(): continue
+        set_context(category=category, city=city, option=None)
+        logger.info('Processing %s, %s started...', city, country)
+        city_ = dp.get_city_slug(city)
         # getting option list for the given city
         try:
             options = functions.load_json(f'{OPTION_LISTS_DIR}/{category}/{city_}.json')
-            logger.info(f'Category options loading...SUCCESS')
+            logger.info('Category options loading...SUCCESS')
         except Exception as err:
-            logger.error(f'\t{type(err).__name__}: {err} while getting options. Continue to process with next city')
+            logger.error('\t%s: %s while getting options. Continue to process with next city', type(err).__name__, err)
             continue
-        # looping over the options
-        data = dict()
-        for num, option in options.items():
-            logger.info(f'Processing for {num}.{option} starting...')
+        # sending the prompts of all options at once
+        pending = journal.pending(city, options.keys())
+        responses = get_structured_responses({num: prompts['content'].format(option=options[num], city=city, country=country)
+                                              for num in pending}, SCHEMAS['cheap_eats.content'])
+        logger.info('Getting responses for %s options...SUCCESS', len(responses))
+        # looping over the options, the ones completed in earlier runs are taken from the journal
+        data = journal.city_results(city)
+        for num in pending:
+            set_context(option=num)
+            option = options[num]
+            logger.info('Processing for %s.%s starting...', num, option)
             data[num] = dict()
-            # composing prompt for the given option
-            prompt = prompts['content'].format(option=option, city=city, country=country)
-            # getting response from ChatGPT
             try:
-                response = functions.get_response_GPT(prompt)
-                logger.info(f'Response for {num}.{option} generating...SUCCESS')
-                parsed = json.loads(response)
-                logger.info(f'Response for {num}.{option} parsing...SUCCESS')
+                parsed = responses[num]
+                if isinstance(parsed, SchemaError): raise parsed
+                logger.info('Response for %s.%s generating and validating...SUCCESS', num, option)
             except Exception as err:
-                logger.error(f'{type(err).__name__}: {err} while getting ChatGPT response. Continue to process with next option')
+                logger.error('%s: %s while getting ChatGPT response. Continue to process with next option', type(err).__name__, err)
+                journal.fail(city, num, err)
                 del data[num]
                 continue
             prompt = prompts['images'].format(text=parsed['text'])
             try:
                 url = functions.get_images_DALLE(prompt)
-                logger.info(f'Image of option {num}.{option} generating...SUCCESS')
-                img_name = functions.download_image(url[0], category, city, num, option)
-                logger.info(f'Image of option {num}.{option} saving...SUCCESS')
+                logger.info('Image of option %s.%s generating...SUCCESS', num, option)
+                img_name = functions.download_image(url[0], category, city, num, option, background=True)
+                logger.info('Image of option %s.%s saving...SUCCESS', num, option)
             except Exception as err:
-                logger.error(f'{type(err).__name__}: {err} while generating or downloading image. Continue to process with next option')
+                logger.error('%s: %s while generating or downloading image. Continue to process with next option', type(err).__name__, err)
+                journal.fail(city, num, err)
                 del data[num]
                 continue
             # Compose a data[num] subdict
@@ -93,27 +112,51 @@ def gen_content():
             data[num]['keywords'] = parsed['keywords'].split(', ')
             data[num]['title'] = parsed['title']
             data[num]['text'] = parsed['text']
-            data[num]['links'] = [link for link in parsed['links'] if functions.is_valid_link(link)]
+            data[num]['links'] = functions.filter_valid_links(parsed['links'])
             data[num]['images'] = [f'{base_url}/{city_}/{img_name}']
-            logger.info(f'Option {option} adding...SUCCESS')
-        # saving data dict to json
-        with open(Path(f'{save_dir}/{city_}.json'), 'w') as fp:
-            json.dump(data, fp, indent=4)
-        logger.info(f'Processing {city}, {country} completed SUCCESSFULLY. Total score {j}/{dp.get_numrows()}')
+            logger.info('Option %s adding...SUCCESS', option)
+        # images were downloading in the background while the next options were generated,
+        # an option is journaled as done only once its image is on disk
+        failed = {num: err for (_, num), err in functions.wait_downloads().items()}
+        for num, err in failed.items():
+            logger.error('%s: %s while downloading image of option %s', type(err).__name__, err, num)
+            journal.fail(city, num, err)
+            data.pop(num, None)
+        for num in pending:
+            if num in data: journal.record(city, num, data[num])
+        # avoid to save empty data dict
+        if not data: continue
+        # saving data dict to the store and its json
+        get_store().save_city(category, city, data, save_dir)
+        logger.info('Processing %s, %s completed SUCCESSFULLY. Total score %s/%s', city, country, j, dp.get_numrows())
         j += 1        
                 
       
 def get_missing_cities():
     category = 'cheap_eats'
     base_url = f'http://20.240.63.21/files/images/{category}'
-    for city, _ in dp.gen_data():
-        city_ = city.replace(' ', '_').replace('-', '_')
-        content = functions.load_json(f'{SEO_TEXTS_DIR}/{category}/{city_}.json')
-        for key in content.keys():
-            option = content[key]['images'][0].split('/')[-1]
-            content[key]['images'] = [f'{base_url}/{city_}/{option}']
-        with open(f'{SEO_TEXTS_DIR}/{category}/{city_}.json', 'w') as fp:
-            json.dump(content, fp, indent=4)
+    store = get_store()
+    for city in store.cities(category):
+        city_ = dp.get_city_slug(city)
+        for key, content in store.get_city(category, city).items():
+            option = content['images'][0].split('/')[-1]
+            store.update(category, city, key, images=[f'{base_url}/{city_}/{option}'])
+        store.export_city(category, city, f'{SEO_TEXTS_DIR}/{category}')
+    # cities generated before the content store exist only as json, they are fixed and moved to the store
+    stored = {dp.get_city_slug(city) for city in store.cities(category)}
+    for file_path in sorted(Path(f'{SEO_TEXTS_DIR}/{category}').glob('*.json')):
+        if file_path.stem in stored: continue
+        try:
+            city = dp.get_city_name(dp.get_city_id_by_slug(file_path.stem))
+        except KeyError:
+            logger.error('Unknown city of %s', file_path)
+            continue
+        data = functions.load_json(file_path)
+        if not data: continue
+        for content in data.values():
+            option = content['images'][0].split('/')[-1]
+            content['images'] = [f'{base_url}/{file_path.stem}/{option}']
+        store.save_city(category, city, data, f'{SEO_TEXTS_DIR}/{category}')
     
     
             
@@ -1,20 +1,19 @@
-from datetime import datetime
 from pathlib import Path
 from config import SEO_CITY_DESCRIPTIONS_DIR
 import json
 
-from data_provider import CSVDataProvider
+from data_provider import get_provider
+from content_store import get_store, WHOLE
 from logger import logger_setup
 
 
-dp = CSVDataProvider()
-timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-logger = logger_setup(f'{Path(__file__).stem}_{timestamp}')
+logger = logger_setup(Path(__file__).stem)
 
 
 def edit():
+    dp = get_provider()
     for city, country in dp.gen_data():
-        city_ = city.replace(' ', '_').replace('-', '_')
+        city_ = dp.get_city_slug(city)
         
         with open(f'{SEO_CITY_DESCRIPTIONS_DIR}_copy/{city_}.json', 'r') as fp:
             content = json.load(fp)
@@ -32,8 +31,8 @@ def edit():
         data['images'] = content['images']
         data['to_id'] = content['destinations_id']
         
-        with open(f'{SEO_CITY_DESCRIPTIONS_DIR}/{city_}.json', 'w') as fp:
-            json.dump(data, fp, indent=4)
+        get_store().upsert('city_descriptions', city, WHOLE, data)
+        get_store().export_city('city_descriptions', city, SEO_CITY_DESCRIPTIONS_DIR)
 
 
 if __name__ == '__main__':
@@ -1,26 +1,36 @@
 from pathlib import Path
+import argparse
 import json
-from datetime import datetime
-from data_provider import CSVDataProvider
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from data_provider import get_provider
+from content_store import get_store
+from image_index import get_image_index
+from ledger import submit
 
 
 from logger import logger_setup
-from config import POSTS_DIR, SMM_CITY_ATTRACTIONS_FP_DIR, CITY_ATTRACTIONS_IMG_DIR
+from config import POSTS_DIR, SMM_CITY_ATTRACTIONS_FP_DIR
     
 
-dp = CSVDataProvider()
-timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-logger = logger_setup(f'{Path(__file__).stem}_{timestamp}')
+dp = get_provider()
+logger = logger_setup(Path(__file__).stem)
 
 
 posts_dir = Path(f'{POSTS_DIR}/city_attractions/en')
 base_url = 'http://20.240.63.21/files/images/city_attractions'
+# categories in the content store, the texts are written there by generate_texts
+texts_category = f'smm_{Path(SMM_CITY_ATTRACTIONS_FP_DIR).name}'
+posts_category = 'posts_city_attractions'
 
 
 def get_texts(city: str) -> dict:
-    city = city.replace(' ', '_').replace('-', '_')
-    logger.info(f'Getting texts...')
-    file_path = f'{SMM_CITY_ATTRACTIONS_FP_DIR}/{city}.json'
+    logger.info('Getting texts...')
+    # generate_texts writes them with the Russian prompt, so they are stored as 'ru'
+    texts = get_store().get_city(texts_category, city, language='ru')
+    if texts: return texts
+    # cities generated before the content store are read from their json
+    file_path = f'{SMM_CITY_ATTRACTIONS_FP_DIR}/{dp.get_city_slug(city)}.json'
     try:
         with open(file_path, 'r') as fp:
             return json.load(fp)
@@ -29,15 +39,12 @@ def get_texts(city: str) -> dict:
 
 
 def get_images(city: str) -> list:
-    city = city.replace(' ', '_').replace('-', '_')
-    logger.info(f'Getting images...')
-    folder_path = f'{CITY_ATTRACTIONS_IMG_DIR}/{city}'
-    try:
-        images = list(Path(folder_path).glob('[0-9]*.jpg'))
-        if not images: raise FileNotFoundError(images)
-        return images
-    except FileNotFoundError as err:
-        logger.error(f'No images were found: {err}')
+    logger.info('Getting images...')
+    images = get_image_index().numbered('city_attractions', city)
+    if not images:
+        logger.error('No images were found for %s', city)
+        return None
+    return list(images.values())
 
 
 def post_to_json(count: int, data: dict, city_id: int) -> None:
@@ -45,64 +52,108 @@ def post_to_json(count: int, data: dict, city_id: int) -> None:
     file_path = f'{posts_dir}/{post_number}.json'
     try:
         with open(file_path, 'w', encoding='utf-8') as fp:
-            logger.info(f'posting data to: {post_number}.json')
+            logger.info('posting data to: %s.json', post_number)
             json.dump(data, fp, indent=4, ensure_ascii=False)
     except FileNotFoundError as err:
-        logger.error(f'Disable posting to {file_path} because of error: {err}')
+        logger.error('Disable posting to %s because of error: %s', file_path, err)
+
+
+def clean_text(text: str) -> tuple[str, str]:
+    """
+    Drops the paragraphs with hashtags or links and splits the rest into the title (first line) and the text.
+    """
+    text = '\n\n'.join(paragraph for paragraph in text.split('\n\n') if '#' not in paragraph and 'http' not in paragraph)
+    title, _, body = text.partition('\n')
+    return title, body
 
 
-def compose_post(city: str, country: str, images: list, texts: dict) -> None:
+def compose_post(city: str, country: str, images: list, texts: dict) -> dict:
     if not texts or not images: return None
-    city_ = city.replace(' ', '_').replace('-', '_')
-    logger.info(f'Composing posts...')
+    city_ = dp.get_city_slug(city)
+    logger.info('Composing posts...')
     data = dict()
     for image in images:        
-        url = f'{base_url}/{city_}/{image.name}'
         index = image.name.split('_')[0]
-        data[index] = dict()
         try:
-            # find hashtags and links in the 'text' and remove them
-            paragraphs = texts[index]['text'].split('\n\n')
-            for paragraph in texts[index]['text'].split('\n\n'):
-                if '#' in paragraph or 'http' in paragraph:
-                    paragraphs.remove(paragraph)
-            texts[index]['text'] = '\n\n'.join(paragraphs)
+            title, text = clean_text(texts[index]['text'])
             # make hashtags as a list if aren't
-            if not isinstance(texts[index]['hashtags'], list):
-                texts[index]['hashtags'] = texts[index]['hashtags'].split(" ")                              
-        except KeyError as err:
-            logger.error(err)
+            hashtags = texts[index]['hashtags']
+            if not isinstance(hashtags, list): hashtags = hashtags.split(' ')
+            data[index] = {'name': texts[index]['name'],
+                           'location': f'{city}, {country}',
+                           'title': title,
+                           'text': text,
+                           'hashtags': hashtags,
+                           'links': [],
+                           'images': [f'{base_url}/{city_}/{image.name}']}
+        except (KeyError, TypeError, AttributeError) as err:
+            logger.error('%s: %s while composing post %s for %s', type(err).__name__, err, index, city)
             continue
-        except TypeError as err:
-            logger.error(err)
-            continue
-        data[index] = {'name': texts[index]['name'],
-                       'location': f'{city}, {country}',
-                       'title': texts[index]['text'].split('\n')[0],
-                       'text': '\n'.join(texts[index]['text'].split('\n')[1:]),
-                       'hashtags': texts[index]['hashtags'],
-                       'links': [],
-                       'images': [url]}
     return data
+
+
+def compose_city(city: str, country: str, images: list, force: bool=False) -> Counter:
+    """
+    Composes the posts of a city and writes only the ones that differ from the last run
+    (kept in the content store) or whose file is missing.
+
+    Returns:
+        Counter: numbers of 'composed', 'skipped' and 'failed' posts
+    """
+    counts = Counter()
+    city_id = dp.get_city_id(city)
+    logger.info('Starting...%s %s', city.upper(), city_id)
+    posts = compose_post(city, country, images, get_texts(city))
+    if not posts:
+        logger.error('No posts for %s %s were composed', city, city_id)
+        counts['failed'] += len(images or ()) or 1
+        return counts
+    counts['failed'] += len(images) - len(posts)
+    previous = get_store().get_city(posts_category, city)
+    for key, post in posts.items():
+        if not force and previous.get(key) == post and Path(f'{posts_dir}/{city_id * 100 + int(key)}.json').exists():
+            counts['skipped'] += 1
+            continue
+        post_to_json(int(key), post, city_id)
+        counts['composed'] += 1
+    get_store().upsert_city(posts_category, city, posts, replace=True)
+    logger.info('completed successfully...%s %s: %s', city.upper(), city_id, dict(counts))
+    return counts
            
                       
-def main():
+def main(cities=None, workers: int=8, force: bool=False) -> dict:
+    """
+    Composes the posts of all cities (or the given (city, country) tuples) on a thread pool,
+    joining images and texts through the image index.
+
+    Returns:
+        dict: numbers of 'composed', 'skipped' and 'failed' posts
+    """
     posts_dir.mkdir(parents=True, exist_ok=True)
-    j = 1
-    for city, country in dp.gen_data():
-        city_id = dp.get_city_id(city)
-        logger.info(f'Starting...{city.upper()} {city_id}')
-        # city = city.replace(' ', '_').replace('-', '_')
-        try:
-            posts = compose_post(city, country, get_images(city), get_texts(city))
-            for key, post in posts.items():
-                post_to_json(int(key), post, city_id)
-        except AttributeError as err:
-            logger.error(f'No posts for {city} {city_id} were composed because of error: {err}')
-            continue
-        logger.info(f'completed successfully...{city.upper()} {city_id}, total processed: {j}/{dp.get_numrows()}')
-        j += 1        
+    # one scan of the folders that changed since the last run, then lookups only
+    get_image_index().refresh('city_attractions')
+    cities = list(cities or dp.gen_data())
+    totals = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {submit(executor, compose_city, city, country, get_images(city), force): city
+                   for city, country in cities}
+        for j, future in enumerate(as_completed(futures), 1):
+            try:
+                totals.update(future.result())
+            except Exception as err:
+                logger.error('No posts for %s were composed because of error: %s', futures[future], err)
+                totals['failed'] += 1
+            logger.info('Total processed: %s/%s', j, len(cities))
+    report = {key: totals[key] for key in ('composed', 'skipped', 'failed')}
+    logger.info('Posts composed: %s, skipped: %s, failed: %s', report["composed"], report["skipped"], report["failed"])
+    print(report)
+    return report
 
                 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Compose the city attractions posts')
+    parser.add_argument('--workers', type=int, default=8, help='Cities composed at the same time (default: 8)')
+    parser.add_argument('--force', action='store_true', help='Rewrite the posts that did not change')
+    args = parser.parse_args()
+
+    main(workers=args.workers, force=args.force)
@@ -1,55 +1,147 @@
 import argparse, sys
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from PIL import Image
 from typing import Optional
 
+from renditions import RENDITIONS
 
-def compress_jpeg_images(source_path: str, quality: int = 80) -> None:
+
+EXTENSIONS = {'.jpeg', '.jpg', '.png', '.gif', '.bmp'}
+MANIFEST_NAME = '.compress_manifest.json'
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_images(source_folder: Path):
+    """
+    Walks the source tree once and yields image files as they are found. The rendition
+    subfolders (thumb, medium, full) are derived images and are not walked.
+    """
+    for root, dirs, files in os.walk(source_folder):
+        dirs[:] = sorted(name for name in dirs if name not in RENDITIONS)
+        for name in sorted(files):
+            if Path(name).suffix.lower() in EXTENSIONS:
+                yield Path(root)/name
+
+
+def _compress_one(file_path: Path, output_file_path: Path, quality: int, known_hash: str | None=None) -> tuple:
+    """
+    Hashes and re-encodes one image, runs in a worker process. An image whose content hash
+    equals `known_hash` (the one of the previous run) is not re-encoded.
+
+    Returns:
+        tuple: (status 'compressed', 'skipped' or 'failed', bytes in, bytes out, content hash, error message or None)
+    """
+    tmp_path = output_file_path.with_name(f'.{output_file_path.name}.part')
+    try:
+        digest = file_hash(file_path)
+        if digest == known_hash:
+            return 'skipped', 0, 0, digest, None
+        output_file_path.parent.mkdir(parents=True, exist_ok=True)
+        with Image.open(file_path) as image:
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(tmp_path, 'JPEG', quality=quality)
+        os.replace(tmp_path, output_file_path)
+        return 'compressed', file_path.stat().st_size, output_file_path.stat().st_size, digest, None
+    except (IOError, OSError) as e:
+        tmp_path.unlink(missing_ok=True)
+        return 'failed', 0, 0, None, str(e)
+
+
+def compress_jpeg_images(source_path: str, quality: int = 80, workers: Optional[int] = None, incremental: bool = True) -> dict:
     """
     Compresses images in a folder and saves them to the output folder as JPEG.
+    The tree is walked once and the encodes are spread over a process pool. In incremental mode
+    images whose source size and mtime (or, if those changed, content hash) and quality match
+    the previous run are skipped.
 
     Arguments:
         source_path (str): Path to the source folder containing JPEG images.
-        output_path (str): Output path for compressed images.
         quality (int): Compression quality (default: 80).
+        workers (int): Worker processes (default: number of CPUs).
+        incremental (bool): Skip images compressed by an earlier run (default: True).
 
+    Returns:
+        dict: summary with counts of compressed, skipped and failed files, bytes in and out and elapsed seconds
     """
-    patterns = ['**/*.jpeg', '**/*.jpg', '**/*.png', '**/*.gif', '**/*.bmp']
-    
+    summary = {'compressed': 0, 'skipped': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+    start = time.perf_counter()
     try:
         source_folder = Path(source_path)
+        if not source_folder.is_dir():
+            raise FileNotFoundError(source_path)
         output_folder = Path(f'{source_folder}_compressed')
-        # output_folder.mkdir(parents=True, exist_ok=True)
-        for file_path in [file for pattern in patterns for file in source_folder.rglob(pattern)]:
-            try:
-                # Replace spaces and dashes in the file name
-                new_file_name = file_path.name.replace(' ', '_').replace('-', '_')
-                # Replace spaces and dashes in the folder names
-                new_folder_path = '/'.join(part.replace(' ', '_').replace('-', '_') for part in file_path.parts[:-1])
-                # Combine the updated folder path and file name
-                new_file_path = Path(new_folder_path) / new_file_name
-                output_file_path = output_folder / new_file_path.relative_to(source_folder)
-                output_file_path.parent.mkdir(parents=True, exist_ok=True)
-                with Image.open(file_path) as image:
-                    image.save(output_file_path, 'JPEG', quality=quality)
-            except (IOError, OSError) as e:
-                print(f"Error processing file: {file_path}. Skipping... ({e})")
-    
+        manifest_path = output_folder/MANIFEST_NAME
+        manifest = json.loads(manifest_path.read_text()) if incremental and manifest_path.exists() else dict()
+        futures = dict()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for file_path in iter_images(source_folder):
+                relative = file_path.relative_to(source_folder)
+                # Replace spaces and dashes in the folder and file names
+                output_file_path = output_folder.joinpath(*(part.replace(' ', '_').replace('-', '_') for part in relative.parts))
+                stat = file_path.stat()
+                entry = manifest.get(str(relative))
+                known_hash = None
+                if entry and entry['quality'] == quality and output_file_path.exists():
+                    if (entry['mtime'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+                        summary['skipped'] += 1
+                        continue
+                    # only touched, the worker compares the content hash before re-encoding
+                    if entry['size'] == stat.st_size: known_hash = entry['hash']
+                future = executor.submit(_compress_one, file_path, output_file_path, quality, known_hash)
+                futures[future] = (file_path, relative, stat)
+            for future, (file_path, relative, stat) in futures.items():
+                status, bytes_in, bytes_out, digest, error = future.result()
+                if error:
+                    print(f"Error processing file: {file_path}. Skipping... ({error})")
+                    summary['failed'] += 1
+                    continue
+                summary[status] += 1
+                summary['bytes_in'] += bytes_in
+                summary['bytes_out'] += bytes_out
+                manifest[str(relative)] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': digest, 'quality': quality}
+        if futures or summary['skipped']:
+            output_folder.mkdir(parents=True, exist_ok=True)
+            manifest_path.write_text(json.dumps(manifest))
+
     except FileNotFoundError:
         print(f"Folder not found: {source_path}")
     except Exception as e:
         print(f"An error occurred: {e}")
 
+    summary['seconds'] = time.perf_counter() - start
+    total = summary['compressed'] + summary['skipped'] + summary['failed']
+    megabytes = summary['bytes_in'] / 2**20
+    print(f"Files: {total} (compressed {summary['compressed']}, skipped {summary['skipped']}, failed {summary['failed']})")
+    print(f"Bytes: {summary['bytes_in']} in, {summary['bytes_out']} out")
+    if summary['seconds'] > 0:
+        print(f"Throughput: {summary['compressed'] / summary['seconds']:.1f} files/s, {megabytes / summary['seconds']:.1f} MB/s")
+    return summary
+
 
 if __name__ == '__main__':
-    
+
     parser = argparse.ArgumentParser(description='Compress JPEG images in a folder')
     parser.add_argument('source_path', type=str, nargs='?', default='.', help='Path to the folder containing JPEG images (default: current directory)')
     # parser.add_argument('output_path', type=str, nargs='?', default='./compressed_images', help='Output path for compressed images (default: ./output)')
     parser.add_argument('--quality', type=int, default=80, help='Compression quality (default: 80)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: number of CPUs)')
+    parser.add_argument('--full', action='store_true', help='Re-encode all images, ignoring the previous run')
     args = parser.parse_args()
 
     try:
-        compress_jpeg_images(args.source_path, quality=args.quality)
+        compress_jpeg_images(args.source_path, quality=args.quality, workers=args.workers, incremental=not args.full)
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -0,0 +1,220 @@
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from data_provider import to_slug
+from profiling import span
+
+
+DEFAULT_DB = Path(__file__).resolve().parent.parent/'files'/'content'/'content.sqlite'
+# option key of categories stored as one document per city, e.g. city descriptions
+WHOLE = ''
+
+
+class ContentStore:
+    def __init__(self, path: Path | str=DEFAULT_DB) -> None:
+        """
+        Generated content with one row per (category, language, city, option). Writes are
+        transactional upserts of single options or of a whole city, so concurrent runs and
+        fix-up scripts only touch the rows they change. The JSON layout the site reads
+        (<out_dir>/<city slug>.json) is written from the store with `export_city` / `export`.
+
+        Args:
+            path (Path | str, optional): SQLite file. Defaults to DEFAULT_DB.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS content (category TEXT, language TEXT, city TEXT, option TEXT, '
+                         'data TEXT, updated REAL, PRIMARY KEY (category, language, city, option))')
+            conn.execute('CREATE INDEX IF NOT EXISTS content_city ON content (city)')
+            conn.execute('CREATE INDEX IF NOT EXISTS content_category ON content (category, language)')
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with span('write.store'), contextlib.closing(self._connect()) as conn:
+            # the write lock is taken at the start, so read-modify-write cycles don't interleave
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    @staticmethod
+    def _upsert(conn: sqlite3.Connection, rows: list) -> None:
+        # ON CONFLICT keeps the rowid, so options keep the order in which they were first added
+        conn.executemany('INSERT INTO content VALUES (?, ?, ?, ?, ?, ?) '
+                         'ON CONFLICT (category, language, city, option) DO UPDATE SET data=excluded.data, updated=excluded.updated',
+                         rows)
+
+    def get(self, category: str, city: str, option=WHOLE, language: str='en') -> dict | None:
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute('SELECT data FROM content WHERE category=? AND language=? AND city=? AND option=?',
+                               (category, language, city, str(option))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_city(self, category: str, city: str, language: str='en') -> dict:
+        """
+        Returns all options of a city by option key.
+        """
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute('SELECT option, data FROM content WHERE category=? AND language=? AND city=? ORDER BY rowid',
+                                (category, language, city)).fetchall()
+        return {option: json.loads(data) for option, data in rows}
+
+    def cities(self, category: str, language: str='en') -> list:
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute('SELECT DISTINCT city FROM content WHERE category=? AND language=? ORDER BY city',
+                                (category, language)).fetchall()
+        return [city for city, in rows]
+
+    def upsert(self, category: str, city: str, option, data, language: str='en') -> None:
+        """
+        Inserts or replaces one option of a city.
+        """
+        with self._transaction() as conn:
+            self._upsert(conn, [(category, language, city, str(option), json.dumps(data, ensure_ascii=False), time.time())])
+
+    def upsert_city(self, category: str, city: str, options: dict, language: str='en', replace: bool=False) -> None:
+        """
+        Inserts or replaces the given options of a city in one transaction.
+
+        Args:
+            category (str): content category
+            city (str): city name
+            options (dict): option key -> JSON-serializable data
+            language (str, optional): content language. Defaults to 'en'.
+            replace (bool, optional): also delete the stored options that are not in `options`. Defaults to False.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            if replace:
+                conn.execute('DELETE FROM content WHERE category=? AND language=? AND city=?', (category, language, city))
+            self._upsert(conn, [(category, language, city, str(option), json.dumps(data, ensure_ascii=False), now)
+                                for option, data in options.items()])
+
+    def update(self, category: str, city: str, option=WHOLE, language: str='en', **fields) -> dict:
+        """
+        Sets some fields of a stored option without rewriting the others.
+
+        Raises:
+            KeyError: the option is not stored
+
+        Returns:
+            dict: the updated option
+        """
+        with self._transaction() as conn:
+            row = conn.execute('SELECT data FROM content WHERE category=? AND language=? AND city=? AND option=?',
+                               (category, language, city, str(option))).fetchone()
+            if row is None:
+                raise KeyError((category, language, city, str(option)))
+            data = {**json.loads(row[0]), **fields}
+            self._upsert(conn, [(category, language, city, str(option), json.dumps(data, ensure_ascii=False), time.time())])
+        return data
+
+    def delete_city(self, category: str, city: str, language: str='en') -> None:
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM content WHERE category=? AND language=? AND city=?', (category, language, city))
+
+    def export_city(self, category: str, city: str, out_dir: Path | str, language: str='en', ensure_ascii: bool=True) -> Path | None:
+        """
+        Writes a city to <out_dir>/<city slug>.json in the layout the site reads. A WHOLE
+        document is written as is, options are written as one dict by option key.
+
+        Returns:
+            Path | None: the written file, None if the city has no content
+        """
+        options = self.get_city(category, city, language)
+        if not options:
+            return None
+        content = options[WHOLE] if list(options) == [WHOLE] else options
+        path = Path(out_dir)/f'{to_slug(city)}.json'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with span('write.export'):
+            with open(tmp_path, 'w', encoding='utf-8') as fp:
+                json.dump(content, fp, indent=4, ensure_ascii=ensure_ascii)
+            os.replace(tmp_path, path)
+        return path
+
+    def save_city(self, category: str, city: str, options: dict, out_dir: Path | str, language: str='en', ensure_ascii: bool=True) -> Path | None:
+        """
+        Replaces the content of a city and exports it, the usual last step of a generator.
+        """
+        self.upsert_city(category, city, options, language, replace=True)
+        return self.export_city(category, city, out_dir, language, ensure_ascii)
+
+    def export(self, category: str, out_dir: Path | str, language: str='en', cities: list | None=None, ensure_ascii: bool=True) -> int:
+        """
+        Bulk export of a category to the JSON layout.
+
+        Returns:
+            int: number of written files
+        """
+        return sum(self.export_city(category, city, out_dir, language, ensure_ascii) is not None
+                   for city in cities or self.cities(category, language))
+
+    def import_dir(self, category: str, src_dir: Path | str, language: str='en', whole: bool=False, provider=None) -> int:
+        """
+        Loads existing <city slug>.json files into the store, e.g. to migrate a category.
+
+        Args:
+            category (str): content category
+            src_dir (Path | str): folder with the per-city JSON files
+            language (str, optional): content language. Defaults to 'en'.
+            whole (bool, optional): store every file as one WHOLE document instead of by option. Defaults to False.
+            provider (CSVDataProvider | None, optional): maps the file names to city names. Defaults to the shared provider.
+
+        Returns:
+            int: number of imported cities
+        """
+        from data_provider import get_provider
+        dp = provider or get_provider()
+        count = 0
+        for path in sorted(Path(src_dir).glob('*.json')):
+            try:
+                city = dp.get_city_name(dp.get_city_id_by_slug(path.stem))
+            except KeyError:
+                city = path.stem.replace('_', ' ')
+            with open(path, 'r', encoding='utf-8') as fp:
+                content = json.load(fp)
+            self.upsert_city(category, city, {WHOLE: content} if whole else content, language, replace=True)
+            count += 1
+        return count
+
+
+_store = None
+
+
+def get_store() -> ContentStore:
+    global _store
+    if _store is None:
+        _store = ContentStore()
+    return _store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import per-city JSON files into the content store or export them back')
+    parser.add_argument('action', choices=['import', 'export'], help='Direction of the copy')
+    parser.add_argument('category', type=str, help='Content category, e.g. cheap_eats')
+    parser.add_argument('folder', type=str, help='Folder with the per-city JSON files')
+    parser.add_argument('--language', type=str, default='en', help='Content language (default: en)')
+    parser.add_argument('--whole', action='store_true', help='Import every file as one document (city descriptions)')
+    parser.add_argument('--cities', nargs='*', help='Cities to export (default: all)')
+    args = parser.parse_args()
+
+    store = get_store()
+    if args.action == 'import':
+        print(f'Imported {store.import_dir(args.category, args.folder, args.language, args.whole)} cities')
+    else:
+        print(f'Exported {store.export(args.category, args.folder, args.language, args.cities)} cities')
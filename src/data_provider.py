@@ -1,21 +1,54 @@
-import polars as pl
-from typing import Generator, Union
+import hashlib
+import os
+import threading
+import unicodedata
+import zlib
+from typing import Generator, Union, TYPE_CHECKING
 from pathlib import Path
 
+from config import CITIES_COUNTRIES_CSV
+
+if TYPE_CHECKING:
+    import polars as pl
+
+# polars is imported inside the provider methods, so that importing this module for
+# to_slug/normalize_name or get_provider stays cheap until a table is actually read
+
+# every module of a run reads the same cities table
+DEFAULT_CSV = CITIES_COUNTRIES_CSV
+SNAPSHOT_DIR = Path(__file__).resolve().parent.parent/'files'/'cache'
+
+
+def to_slug(city: str) -> str:
+    """
+    File system name of a city used for the per-city JSON files and image folders, e.g. 'Rio de Janeiro' -> 'Rio_de_Janeiro'.
+    """
+    return city.replace(' ', '_').replace('-', '_')
+
+
+def normalize_name(name: str) -> str:
+    """
+    Case and diacritic insensitive form of a city name, e.g. 'Malmö' and 'malmo' -> 'malmo'.
+    """
+    decomposed = unicodedata.normalize('NFKD', name.strip())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold().replace('-', ' ')
+
 
 # This class is likely a provider or generator of city and country information
 class CSVDataProvider:
-    def __init__(self, path: str='../files/csv/cities_countries.csv') -> None:
+    def __init__(self, path: str=DEFAULT_CSV) -> None:
         """
-        This is the constructor method of a class. It takes a path parameter as input which is a string representing the path of a CSV file. The method reads the CSV file using polars library's read_csv method and stores it in a variable called df. It also initializes a variable called numrows with the number of rows in the CSV file.
+        This is the constructor method of a class. It takes a path parameter as input which is a string representing the path of a CSV file. The method reads the CSV file (through a cached Arrow snapshot, see _read_table) and stores it in a variable called df. It also initializes a variable called numrows with the number of rows in the CSV file.
 
         Args:
             path (str): string representing the path to a CSV file containing data
         """
+        import polars as pl
         try:
             self.path = Path(path)
-            self.df = pl.read_csv(self.path)
+            self.df = self._read_table()
             self.numrows = self.df.shape[0]
+            self._build_indexes()
             
         except FileNotFoundError:
             print("File not found: ", path)
@@ -35,54 +68,172 @@ class CSVDataProvider:
             print("ValueError: ", e)
             
     
+    def _read_table(self) -> 'pl.DataFrame':
+        """
+        Reads the table from an Arrow IPC snapshot of the CSV. The snapshot name contains the CSV's
+        path, mtime and size, so any change of the CSV makes it parse the CSV again and rewrite the snapshot.
+
+        Returns:
+            pl.DataFrame: the table
+        """
+        import polars as pl
+        stat = self.path.stat()
+        digest = hashlib.sha1(f'{self.path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()[:12]
+        snapshot = SNAPSHOT_DIR/f'{self.path.stem}-{digest}.arrow'
+        if snapshot.exists():
+            return pl.read_ipc(snapshot, memory_map=False)
+        df = pl.read_csv(self.path)
+        try:
+            SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+            for old in SNAPSHOT_DIR.glob(f'{self.path.stem}-*.arrow'):
+                old.unlink(missing_ok=True)
+            tmp_path = snapshot.with_suffix('.tmp')
+            df.write_ipc(tmp_path)
+            os.replace(tmp_path, snapshot)
+        except OSError as err:
+            print("Couldn't write the snapshot of the CSV file: ", err)
+        return df
+            
+    
+    def _build_indexes(self) -> None:
+        """
+        Builds hash indexes id <-> name <-> slug once, so that lookups don't scan the dataframe.
+        """
+        ids, names = self.df['id_city'].to_list(), self.df['city'].to_list()
+        self._name_by_id = dict(zip(ids, names))
+        self._id_by_name = dict(zip(names, ids))
+        self._slug_by_name = {name: to_slug(name) for name in names}
+        self._id_by_slug = {to_slug(name): id for id, name in zip(ids, names)}
+        self._id_by_normalized = {normalize_name(name): id for id, name in zip(ids, names)}
+        self._sorted_views = dict()
+            
+    
     def gen_data(self,
                       from_: int=0, 
                       to_: int=-1, 
                       type_: list=['city', 'country'], 
-                      sort_: str='city') -> Generator[tuple,
+                      sort_: str='city',
+                      shard: int | None=None,
+                      num_shards: int=1,
+                      shard_mode: str='hash',
+                      cities: list[str] | None=None,
+                      countries: list[str] | None=None) -> Generator[tuple,
                                                         Union[int, list[str], str], 
-                                                        pl.ColumnNotFoundError]:
+                                                        'pl.ColumnNotFoundError']:
         """
-        This is a method that generates a tuples of values from certain columns. The parameters include the range of values to generate, the type of data to include (city and/or country), and how to sort the values. The method uses a polars dataframe to retrieve the data and returns a generator object that yields the desired values.
+        This is a method that generates a tuples of values from certain columns. The parameters include the range of values to generate, the type of data to include (city and/or country), and how to sort the values. The sorted frame is cached per sort column, the range is sliced without materialising the other rows, and rows are yielded one by one.
+        With `shard` and `num_shards` every worker gets a deterministic, non-overlapping share of the rows: 'hash' assigns a city by a stable hash of its name (so a city keeps its shard when rows are added), 'stride' takes every num_shards-th row.
 
         Args:
             from_ (int, optional): the first element of the returned subset. Defaults to 0.
-            to_ (int, optional): the last element of the returned subset. Defaults to 0.
+            to_ (int, optional): the last element of the returned subset, -1 or None for all. Defaults to -1.
             type_ (list, optional): list of column names whose values are returned. Defaults to ['city', 'country'].
             sort_ (str, optional): the name of the column to sort by. Defaults to 'city'.
+            shard (int | None, optional): index of the shard to return, None for all rows. Defaults to None.
+            num_shards (int, optional): number of shards. Defaults to 1.
+            shard_mode (str, optional): 'hash' or 'stride'. Defaults to 'hash'.
+            cities (list[str] | None, optional): only these cities. Defaults to None.
+            countries (list[str] | None, optional): only cities of these countries. Defaults to None.
 
         Yields:
             Generator[tuple, int, AttributeError]: tuples generator
         """
-        if to_ == -1: to_ = self.numrows
-        for value in self.df[type_].sort(sort_).rows()[from_:to_]:
+        import polars as pl
+        if shard is not None and not 0 <= shard < num_shards:
+            raise ValueError(f'shard must be in range 0..{num_shards - 1}, got {shard}')
+        if shard_mode not in ('hash', 'stride'):
+            raise ValueError(f"shard_mode must be 'hash' or 'stride', got {shard_mode}")
+        view = self._sorted_view(sort_)
+        if cities is not None:
+            view = view.filter(pl.col('city').is_in(list(cities)))
+        if countries is not None:
+            view = view.filter(pl.col('country').is_in(list(countries)))
+        from_ = from_ or 0
+        if to_ is None or to_ == -1: to_ = view.height
+        view = view.slice(from_, max(0, to_ - from_))
+        for i, (city, value) in enumerate(zip(view['city'], view.select(type_).iter_rows())):
+            if shard is not None:
+                key = zlib.crc32(city.encode('utf-8')) if shard_mode == 'hash' else i
+                if key % num_shards != shard: continue
             yield value
             
     
+    def _sorted_view(self, sort_: str) -> 'pl.DataFrame':
+        """
+        Returns the dataframe sorted by the given column, sorting it only on first use.
+        """
+        if sort_ not in self._sorted_views:
+            self._sorted_views[sort_] = self.df.sort(sort_)
+        return self._sorted_views[sort_]
+            
+    
     def get_city_name(self, id: int) -> str:
         """
-        Takes an integer id as input and returns the corresponding city name from the dataframe 'df_cities_countries'. It filters the dataframe based on the id and returns the first value of the 'city' column.
+        Takes an integer id as input and returns the corresponding city name using the id index built in the constructor.
 
         Args:
             id (int): city id
 
+        Raises:
+            KeyError: unknown id
+
         Returns:
             str: city name
         """
-        return self.df.filter(pl.col('id_city') == id)['city'][0]
+        return self._name_by_id[id]
     
     
     def get_city_id(self, name: str) -> int:
         """
-        This function takes in a city name as a string and returns the corresponding city ID as an integer. It does this by filtering the dataframe of cities and countries for the row where the 'city' column matches the input name, and then returning the value in the 'id_city' column for that row. 
+        This function takes in a city name as a string and returns the corresponding city ID as an integer. An exact match is looked up first, then a case and diacritic insensitive one, so spelling variants like 'malmo' for 'Malmö' are found too.
 
         Args:
             name (str): city name
 
+        Raises:
+            KeyError: unknown city
+
         Returns:
             int: city id
         """
-        return self.df.filter(pl.col('city') == name)['id_city'][0]
+        if name in self._id_by_name:
+            return self._id_by_name[name]
+        return self._id_by_normalized[normalize_name(name)]
+    
+    
+    def get_city_ids(self, names: list[str]) -> list[int | None]:
+        """
+        Bulk version of get_city_id, unknown names give None instead of raising.
+
+        Args:
+            names (list[str]): city names
+
+        Returns:
+            list[int | None]: city ids in the same order
+        """
+        return [self._id_by_name.get(name, self._id_by_normalized.get(normalize_name(name))) if isinstance(name, str) else None
+                for name in names]
+    
+    
+    def get_city_names(self, ids: list[int]) -> list[str | None]:
+        """
+        Bulk version of get_city_name, unknown ids give None instead of raising.
+        """
+        return [self._name_by_id.get(id) for id in ids]
+    
+    
+    def get_city_slug(self, name: str) -> str:
+        """
+        Returns the precomputed file system name of a city (see to_slug).
+        """
+        return self._slug_by_name.get(name) or to_slug(name)
+    
+    
+    def get_city_id_by_slug(self, slug: str) -> int:
+        """
+        Returns the city id for a file system name, e.g. the stem of a per-city JSON file.
+        """
+        return self._id_by_slug[slug]
         
     
     def get_numrows(self):
@@ -93,6 +244,27 @@ class CSVDataProvider:
         return self.df.columns
     
 
+_providers = dict()
+_providers_lock = threading.Lock()
+
+
+def get_provider(path: str | Path=DEFAULT_CSV) -> CSVDataProvider:
+    """
+    Returns the shared provider for a CSV file, so that all modules of a run use one parsed table.
+
+    Args:
+        path (str | Path, optional): path to a CSV file. Defaults to DEFAULT_CSV.
+
+    Returns:
+        CSVDataProvider: provider instance
+    """
+    key = Path(path).resolve()
+    with _providers_lock:
+        if key not in _providers:
+            _providers[key] = CSVDataProvider(key)
+        return _providers[key]
+    
+
 if __name__ == '__main__':
     # dp = CSVDataProvider()
     # for d in dp.gen_data():
@@ -0,0 +1,202 @@
+import argparse
+import re
+import threading
+
+import airportsdata
+import numpy as np
+import polars as pl
+import pycountry
+
+from data_provider import get_provider, normalize_name
+from response_schema import SCHEMAS, SchemaError, get_structured_responses
+
+
+EARTH_RADIUS_KM = 6371.0
+DEFAULT_COUNT = 10
+# nearest cities of the same country taken first, the rest are the nearest ones anywhere
+SAME_COUNTRY = 3
+# candidates sent to ChatGPT when the destinations are re-ranked
+SHORTLIST = 15
+# country names of the CSV unknown to pycountry
+COUNTRY_CODES = {'Turkey': 'TR', 'Kosovo': 'XK', 'Brunei': 'BN'}
+# IATA (or ICAO) codes for the cities the airports data names differently, tried in order;
+# cities without an airport of their own get the nearest one
+AIRPORT_CODES = {
+    'Sanaa': ('SAH',), 'Phnom Penh': ('PNH', 'KTI'), 'Kyoto': ('ITM',), 'Jerusalem': ('TLV',), 'Penang Island': ('PEN',),
+    'Ha Noi': ('HAN',), 'Johor Bahru': ('JHB',), 'Mecca': ('JED',), 'Pattaya': ('UTP',), 'Macau': ('MFM',),
+    'Hong Kong': ('HKG',), 'Alexandroupoli': ('AXD',), 'Alanya': ('GZP',), 'Bodo': ('BOO',), 'Basel': ('BSL',),
+    'Corfu': ('CFU',), 'Doncaster': ('DSA', 'EGCN'), 'Florence': ('FLR',), 'Floro': ('FRO',), 'Guernsey': ('GCI',),
+    'Genoa': ('GOA',), 'Kortrijk': ('KJK',), 'Las Palmas de Gran Canaria': ('LPA',), 'Mahon': ('MAH',), 'Malta': ('MLA',),
+    'Naples': ('NAP',), 'Alderney': ('ACI',), 'Oviedo': ('OVD',), 'Plymouth': ('PLH', 'EGHD'), 'Rhodes': ('RHO',),
+    'Thira': ('JTR',), 'Turin': ('TRN',), 'Terceira': ('TER',), 'Venice': ('VCE',), 'Wroclaw': ('WRO',),
+    'Zweibrücken': ('ZQW', 'EDRZ'), 'Thimphu': ('PBH',), 'Thiruvananthapuram': ('TRV',),
+}
+
+
+def country_code(country: str) -> str | None:
+    if country in COUNTRY_CODES:
+        return COUNTRY_CODES[country]
+    try:
+        return pycountry.countries.lookup(country).alpha_2
+    except LookupError:
+        return None
+
+
+def attach_coordinates(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Adds 'lat' and 'lon' columns to the cities table from the airports data bundled with `airportsdata`,
+    offline. A city takes the mean position of the airports of the same name in its country, then of the
+    airports whose city or name contains its name, then of the airports in AIRPORT_CODES. Cities that are
+    still not found get nulls.
+
+    Args:
+        df (pl.DataFrame): table with 'city' and 'country' columns
+
+    Returns:
+        pl.DataFrame: the table with the coordinates
+    """
+    airports = airportsdata.load('ICAO')
+    by_code = {**{a['iata']: a for a in airports.values() if a['iata']}, **airports}
+    by_country = dict()
+    for airport in airports.values():
+        by_country.setdefault(airport['country'], []).append(airport)
+    lats, lons = [], []
+    for city, country in zip(df['city'], df['country']):
+        name = normalize_name(city)
+        candidates = by_country.get(country_code(country), [])
+        word = re.compile(rf'\b{re.escape(name)}\b')
+        found = ([a for a in candidates if normalize_name(a['city']) == name]
+                 or [a for a in candidates if word.search(normalize_name(a['city']))]
+                 or [a for a in candidates if word.search(normalize_name(a['name']))]
+                 or [by_code[code] for code in AIRPORT_CODES.get(city, ()) if code in by_code][:1])
+        lats.append(float(np.mean([a['lat'] for a in found])) if found else None)
+        lons.append(float(np.mean([a['lon'] for a in found])) if found else None)
+    return df.with_columns(pl.Series('lat', lats, dtype=pl.Float64), pl.Series('lon', lons, dtype=pl.Float64))
+
+
+def haversine_matrix(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """
+    Great-circle distances in km between all points at once, NaN for unknown coordinates.
+    """
+    lat, lon = np.radians(lat), np.radians(lon)
+    dlat = lat[:, None] - lat[None, :]
+    dlon = lon[:, None] - lon[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class DestinationEngine:
+    def __init__(self, df: pl.DataFrame) -> None:
+        """
+        Popular destinations of every city computed locally: the distance matrix of all cities is
+        built once and each row is sorted once, so the destinations of all cities take a fraction
+        of a second instead of a ChatGPT call per city with the whole city list in the prompt.
+
+        Args:
+            df (pl.DataFrame): cities table with 'id_city', 'city' and 'country' columns
+        """
+        df = attach_coordinates(df)
+        self.ids = df['id_city'].to_list()
+        self.names = df['city'].to_list()
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.countries = np.array(df['country'].to_list())
+        self.missing = [name for name, lat in zip(self.names, df['lat']) if lat is None]
+        lat = df['lat'].fill_null(np.nan).to_numpy()
+        lon = df['lon'].fill_null(np.nan).to_numpy()
+        distances = haversine_matrix(lat, lon)
+        # a city is never its own destination, cities without coordinates come last
+        distances[np.isnan(distances)] = np.inf
+        np.fill_diagonal(distances, np.inf)
+        self.distances = distances
+        self.order = np.argsort(self.distances, axis=1, kind='stable')
+
+    def shortlist(self, city: str, size: int=SHORTLIST, same_country: int=SAME_COUNTRY) -> list[int]:
+        """
+        Nearest cities with up to `same_country` of the city's own country first. A city without
+        coordinates gets only cities of its own country.
+
+        Args:
+            city (str): city name
+            size (int, optional): number of cities. Defaults to SHORTLIST.
+            same_country (int, optional): cities of the same country taken first. Defaults to SAME_COUNTRY.
+
+        Raises:
+            KeyError: unknown city
+
+        Returns:
+            list[int]: row indexes of the cities ordered by the rules
+        """
+        i = self.index[city]
+        order = self.order[i][self.order[i] != i]
+        local = order[self.countries[order] == self.countries[i]][:same_country]
+        rest = order[~np.isin(order, local)][:max(0, size - len(local))]
+        if not np.isfinite(self.distances[i]).any():
+            rest = order[self.countries[order] == self.countries[i]][same_country:size]
+        return [*local.tolist(), *rest.tolist()]
+
+    def destinations(self, city: str, count: int=DEFAULT_COUNT, same_country: int=SAME_COUNTRY) -> list[int]:
+        """
+        Returns:
+            list[int]: ids of the popular destinations of a city, see `shortlist`
+        """
+        return [self.ids[j] for j in self.shortlist(city, count, same_country)]
+
+    def rerank(self, cities: list[str], prompt: str, count: int=DEFAULT_COUNT, size: int=SHORTLIST) -> dict:
+        """
+        Lets ChatGPT choose the `count` most popular destinations among the `size` shortlisted ones
+        of every city, all prompts being sent at once. Only shortlisted names are accepted, so the
+        answer maps back to ids without spelling issues; missing picks are filled by distance.
+
+        Args:
+            cities (list[str]): city names
+            prompt (str): prompt with {city} and {city_list} placeholders, answering {"destinations_id": [names]}
+            count (int, optional): destinations per city. Defaults to DEFAULT_COUNT.
+            size (int, optional): shortlisted candidates per city. Defaults to SHORTLIST.
+
+        Returns:
+            dict: city -> destination ids
+        """
+        shortlists = {city: self.shortlist(city, size) for city in cities}
+        prompts = {city: prompt.format(city=city, city_list=[self.names[j] for j in shortlists[city]]) for city in cities}
+        responses = get_structured_responses(prompts, SCHEMAS['city_descriptions_pmt.popular_directions'])
+        result = dict()
+        for city, shortlist in shortlists.items():
+            response = responses[city]
+            picked = response.partial if isinstance(response, SchemaError) else response
+            by_name = {normalize_name(self.names[j]): j for j in shortlist}
+            chosen = []
+            for name in picked.get('destinations_id', []):
+                j = by_name.get(normalize_name(name)) if isinstance(name, str) else None
+                if j is not None and j not in chosen: chosen.append(j)
+            chosen += [j for j in shortlist if j not in chosen]
+            result[city] = [self.ids[j] for j in chosen[:count]]
+        return result
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> DestinationEngine:
+    """
+    Returns the process-wide engine of the cities table, building it on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = DestinationEngine(get_provider().df)
+        return _engine
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the popular destinations of cities')
+    parser.add_argument('cities', nargs='*', help='City names (default: all)')
+    parser.add_argument('--count', type=int, default=DEFAULT_COUNT, help=f'Destinations per city (default: {DEFAULT_COUNT})')
+    args = parser.parse_args()
+
+    engine = get_engine()
+    if engine.missing:
+        print(f'No coordinates for: {", ".join(engine.missing)}')
+    for city in args.cities or engine.names:
+        names = [engine.names[j] for j in engine.shortlist(city, args.count)]
+        print(f'{city}: {", ".join(names)}')
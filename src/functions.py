@@ -1,40 +1,61 @@
-import polars as pl
 import json
 import time
-import openai
-import os
 from pathlib import Path
-from PIL import Image
-import requests
-from io import BytesIO
 
-from config import IMG_DIR, CITIES_COUNTRIES_CSV
+from config import IMG_DIR
+from data_provider import get_provider
+from rate_limiter import get_limiter, estimate_tokens
+from key_pool import NoKeyAvailable, get_key_pool
+from response_cache import get_cache, cache_disabled, IMAGE_URLS_MAX_AGE
+from resilience import call_with_retry, POLICIES
+from ledger import get_ledger
+# elapsed_time moved to profiling, it is imported from here by the scripts
+from profiling import elapsed_time, span
 
-df_cities_countries = pl.read_csv(CITIES_COUNTRIES_CSV)
+# openai, PIL, requests and aiohttp are imported inside the functions that use them,
+# so that importing this module stays cheap for jobs that never call the APIs
 
 def get_cities():
-    return sorted(df_cities_countries['city'])
+    return sorted(get_provider().df['city'])
 
 
-def download_image(url: str, category: str, city: str, number: str, option: str) -> None:
+def get_cities_countries() -> list[tuple]:
+    return list(get_provider().gen_data())
+
+
+def download_image(url: str, category: str, city: str, number: str, option: str, background: bool=False, renditions: dict | None=None) -> Path:
+    """
+    Downloads an image to IMG_DIR/<category>/<city>/<number>_<option>.jpg, scaled down to fit 1024x1024.
+    With `renditions` (see `renditions.RENDITIONS`) thumbnails etc. are written from the same decode.
+    With background=True the download runs in the shared downloader pool and the file name is
+    returned at once; failures are collected with `wait_downloads`.
+    """
     category, city, option = map(lambda x: x.replace(' ', '_').replace('-', '_') , [category, city, option])
     save_dir = Path(f'{IMG_DIR}/{category}/{city}')
-    save_dir.mkdir(parents=True, exist_ok=True)
     image_name = Path(f'{number}_{option}.jpg')
     save_path = save_dir/image_name
+    from image_downloader import get_downloader
+    if background:
+        get_downloader().submit((city, number), url, save_path, renditions=renditions)
+        return image_name
     try:
-        response = requests.get(url)
-        # Open the downloaded image using PIL
-        with Image.open(BytesIO(response.content)) as image:
-            # Define the desired size and save
-            new_size = (1024, 1024)
-            resized_image = image.resize(new_size)
-            resized_image.save(save_path, format='JPEG')
+        get_downloader().fetch(url, save_path, renditions=renditions)
         return image_name   
     except IOError as err:
         print(f'An error {err} was occured while downloading image of {number}.{option} for {city}')
     except Exception as err:
         print(f'Unexpected error was occured while downloading image {url}')
+
+
+def wait_downloads() -> dict:
+    """
+    Waits for the downloads started with `download_image(..., background=True)`.
+
+    Returns:
+        dict: exceptions of the failed downloads by (city, number)
+    """
+    from image_downloader import get_downloader
+    return get_downloader().wait_all()
         
 
 def correct_image_names():
@@ -48,6 +69,7 @@ def correct_image_names():
 
 
 def resize_images(folder_path: Path | str, to_size: tuple=(1024, 1024)) -> None:
+    from PIL import Image
     if isinstance(folder_path, str):
         folder_path = Path(folder_path)
     try:
@@ -70,6 +92,7 @@ def resize_images(folder_path: Path | str, to_size: tuple=(1024, 1024)) -> None:
         
 
 def resize_image(file_path: Path | str, to_size: tuple=(1024, 1024)) -> None:
+    from PIL import Image
     try:
         img = Image.open(file_path)
         if img.size == to_size:
@@ -82,13 +105,21 @@ def resize_image(file_path: Path | str, to_size: tuple=(1024, 1024)) -> None:
         print(f"Error resizing {file_path.name}: {str(e)}")
 
 
-def is_valid_link(url: str, timeout: int=10) -> bool:
-    try:
-        requests.head(url, timeout=timeout, allow_redirects=False).raise_for_status()
-        return True
-    except requests.exceptions.RequestException as err:
-        print("An error occurred during the request:", err)
-        return False
+def is_valid_link(url: str) -> bool:
+    """
+    Checks one url through the shared link validator, see `link_validator.validate_links`
+    to check all links of an option in one call.
+    """
+    from link_validator import validate_links
+    return validate_links([url]).get(url, False)
+
+
+def filter_valid_links(urls: list) -> list:
+    """
+    Keeps the valid urls of an option in their original order, checking them in one call.
+    """
+    import link_validator
+    return link_validator.filter_valid_links(urls)
 
 
 def get_prompts_GPT(prompt_json_path: Path | str) -> dict:
@@ -96,78 +127,116 @@ def get_prompts_GPT(prompt_json_path: Path | str) -> dict:
         return json.load(f)
     
 
-def limit_calls_per_minute(max_calls):
+def limit_calls_per_minute(max_calls, key=None):
     """
-    Decorator that limits a function to being called `max_calls` times per minute,
-    with a delay between subsequent calls calculated based on the time since the
-    previous call.
+    Decorator that limits a function to being called `max_calls` times per minute.
+    The limit is kept in a shared token bucket (see `rate_limiter.RateLimiter`), so it holds
+    across threads and across separately started scripts using the same `key`.
     """
-    calls = []
     def decorator(func):
+        limiter = get_limiter(key or func.__qualname__, rpm=max_calls, tpm=None)
         def wrapper(*args, **kwargs):
-            # Remove any calls from the call history that are older than 1 minute
-            calls[:] = [call for call in calls if call > time.time() - 60]
-            if len(calls) >= max_calls:
-                # Too many calls in the last minute, calculate delay before allowing additional calls
-                time_since_previous_call = time.time() - calls[-1]
-                delay_seconds = 60 / max_calls - time_since_previous_call
-                if delay_seconds > 0:
-                    time.sleep(delay_seconds)
-            # Call the function and add the current time to the call history
-            result = func(*args, **kwargs)
-            calls.append(time.time())
-            return result
+            limiter.acquire()
+            return func(*args, **kwargs)
         return wrapper
     return decorator
     
   
-@limit_calls_per_minute(3)    
-def get_response_GPT(prompt: str, api_key: str='OPENAI_API_KEY_CT_2') -> str:
-    openai.organization = os.getenv('OPENAI_ID_CT')
-    openai.api_key = os.getenv(api_key)
+def get_response_GPT(prompt: str, api_key: str | None=None, use_cache: bool=True) -> str:
+    """
+    Sends a prompt to ChatGPT with a key from the key pool (or the given API key env variable)
+    and returns the response content, None if the request failed.
+    """
+    use_cache = use_cache and not cache_disabled()
+    cache_key = get_cache().make_key(model='gpt-3.5-turbo', prompt=prompt, temperature=0)
+    if use_cache and (cached := get_cache().get(cache_key)) is not None:
+        get_ledger().record('gpt-3.5-turbo', cached=True)
+        return cached
+    import openai
+    pool = get_key_pool(api_key)
+    reserved = estimate_tokens(prompt)
     # print(f'prompt = ')
+    start, call = time.perf_counter(), {'attempts': 0, 'latency': 0.0}
+    # waits for a key count against the retry deadline too
+    deadline = time.monotonic() + POLICIES['openai'].deadline
+
+    def request():
+        # every attempt takes a key with budget, so a retry after a 429 can go to another key
+        key = pool.checkout(reserved, deadline=deadline)
+        call['attempts'] += 1
+        request_start = time.perf_counter()
+        try:
+            with span('request.chat'):
+                return key, openai.ChatCompletion.create(model='gpt-3.5-turbo',
+                                                         messages=[
+                                                                     #{"role": "system", "content": f"Act as an {role}"},
+                                                                     {'role': 'user', 'content': prompt}
+                                                                 ],
+                                                         temperature=0,
+                                                         request_timeout=POLICIES['openai'].timeout,
+                                                         **key.credentials)
+        except openai.OpenAIError as err:
+            pool.report_error(key, err)
+            # a request the API answered with an error used no tokens, a timed out one may have
+            if getattr(err, 'http_status', None): pool.settle(key, reserved, 0)
+            raise
+        finally:
+            call['latency'] = time.perf_counter() - request_start
+
     try:
-        response = openai.ChatCompletion.create(model='gpt-3.5-turbo',
-                                                messages=[
-                                                            #{"role": "system", "content": f"Act as an {role}"},
-                                                            {'role': 'user', 'content': prompt}
-                                                        ],
-                                                temperature=0)  
-        print(f"\n{response['choices'][0]['message']['content']}") 
-        return response['choices'][0]['message']['content']
-    except openai.OpenAIError as err:
+        key, response = call_with_retry(request, policy=POLICIES['openai'], name='openai.chat')
+        pool.settle(key, reserved, response['usage']['total_tokens'])
+        get_ledger().record('gpt-3.5-turbo', response['usage']['prompt_tokens'], response['usage']['completion_tokens'],
+                            latency_s=call['latency'], total_s=time.perf_counter() - start, retries=call['attempts'] - 1)
+        content = response['choices'][0]['message']['content']
+        print(f"\n{content}") 
+        if use_cache: get_cache().set(cache_key, content)
+        return content
+    except (openai.OpenAIError, NoKeyAvailable) as err:
+        get_ledger().record('gpt-3.5-turbo', total_s=time.perf_counter() - start, retries=max(0, call['attempts'] - 1), error=repr(err))
         print("An error occurred during the OpenAI request:", err)
         return None 
      
 
-@limit_calls_per_minute(3)    
-def get_images_DALLE(prompt: str, n: int=1, size: str='512x512', api_key: str='OPENAI_API_KEY_CT_2') -> list:
-    openai.organization = os.getenv('OPENAI_ID_CT')
-    openai.api_key = os.getenv(api_key)
+def get_images_DALLE(prompt: str, n: int=1, size: str='512x512', api_key: str | None=None, use_cache: bool=True) -> list:
+    use_cache = use_cache and not cache_disabled()
+    cache_key = get_cache().make_key(model='dall-e', prompt=prompt, n=n, size=size)
+    if use_cache and (cached := get_cache().get(cache_key, max_age=IMAGE_URLS_MAX_AGE)) is not None:
+        get_ledger().record('dall-e', size=size, cached=True)
+        return json.loads(cached)
+    import openai
+    pool = get_key_pool(api_key)
+    start, call = time.perf_counter(), {'attempts': 0, 'latency': 0.0}
+    deadline = time.monotonic() + POLICIES['openai'].deadline
+
+    def request():
+        # images have their own per-minute limit, so they use a separate bucket of the key
+        key = pool.checkout(kind='images', deadline=deadline)
+        call['attempts'] += 1
+        request_start = time.perf_counter()
+        try:
+            with span('request.images'):
+                return openai.Image.create(prompt=prompt, n=n, size=size, request_timeout=POLICIES['openai'].timeout,
+                                           **key.credentials)
+        except openai.OpenAIError as err:
+            pool.report_error(key, err)
+            raise
+        finally:
+            call['latency'] = time.perf_counter() - request_start
+
     try:
-        response = openai.Image.create(prompt=prompt, n=n, size=size)
-        return [item['url'] for item in response['data']]
-    except openai.OpenAIError as err:
+        response = call_with_retry(request, policy=POLICIES['openai'], name='openai.images')
+        urls = [item['url'] for item in response['data']]
+        get_ledger().record('dall-e', images=len(urls), size=size, latency_s=call['latency'],
+                            total_s=time.perf_counter() - start, retries=call['attempts'] - 1)
+        if use_cache: get_cache().set(cache_key, json.dumps(urls))
+        return urls
+    except (openai.OpenAIError, NoKeyAvailable) as err:
+        get_ledger().record('dall-e', size=size, total_s=time.perf_counter() - start, retries=max(0, call['attempts'] - 1), error=repr(err))
         print("An error occurred during the OpenAI request:", err)
         return None
     
 
-def elapsed_time(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        elapsed = end_time - start_time
-        elapsed_minutes = int(elapsed // 60)
-        elapsed_seconds = int(elapsed % 60)
-        elapsed_hours = int(elapsed_minutes // 60)
-        elapsed_minutes %= 60
-        print(f'Elapsed time for {func.__name__}: {elapsed_hours} hours, '
-                f'{elapsed_minutes} minutes, {elapsed_seconds} seconds')
-        return result
-    return wrapper
-
-    
 def load_json(path: str) -> dict:
     """
     This function loads a JSON file from a given path. The purpose of this function is to provide a convenient way to load JSON data from a file, while also handling potential errors that may occur during the loading process.
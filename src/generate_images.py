@@ -1,66 +1,72 @@
-import requests
 from pathlib import Path 
 import json
-from io import BytesIO
-from PIL import Image
 
+from image_downloader import get_downloader
 from functions import get_prompts_GPT, get_images_DALLE, elapsed_time, get_cities
 from logger import logger_setup
+from data_provider import to_slug
+from journal import Journal
+from ledger import set_context
 from config import IMG_DIR, PROMPTS_DIR, CHILDREN_ATTRACTIONS_LIST_DIR
 
 
 logger = logger_setup(Path(__file__).stem)
 
 
-def download_image(url: str, city: str, number: str, attraction: str) -> None:
-    save_dir = Path(f'{IMG_DIR}/children_attractions/{city}')
-    save_dir.mkdir(parents=True, exist_ok=True)
-    image_name = Path(f'{number}_{attraction}.jpg')
-    save_path = save_dir/image_name
+def image_path(city: str, number: str, attraction: str) -> Path:
+    attraction = attraction.replace(' ', '_').replace('-', '_').replace("'", "")
+    return Path(f'{IMG_DIR}/children_attractions/{city}/{number}_{attraction}.jpg')
+
+
+def download_image(url: str, city: str, number: str, attraction: str) -> Path:
+    save_path = image_path(city, number, attraction)
     try:
-        response = requests.get(url)
-        # Open the downloaded image using PIL
-        with Image.open(BytesIO(response.content)) as image:
-            # define the desired size and save
-            new_size = (1024, 1024)
-            resized_image = image.resize(new_size)
-            resized_image.save(save_path, format='JPEG')
-            logger.info(f"Resized and saved succcessfully to {save_path}")
+        get_downloader().fetch(url, save_path, size=(1024, 1024))
+        logger.info("Resized and saved succcessfully to %s", save_path)
+        return save_path
     except IOError as err:
-        logger.error(f'An error occurred while saving the file: {err}')
+        logger.error('An error occurred while saving the file: %s', err)
     except Exception as err:
-        logger.error(f'An unexpected error occurred: {err}')
+        logger.error('An unexpected error occurred: %s', err)
         
 
 @elapsed_time
-def generate_image():
+def generate_image(replay_failed=False, cities=None):
+    journal = Journal('children_attractions_images')
     prompts = get_prompts_GPT(PROMPTS_DIR/'children_attractions_images_pmt.json')
-    cities = get_cities()
+    cities = cities or get_cities()
     j = 0
     for city in cities:
-        logger.info(f'Processing...{city.upper()}')
-        city_ = city.replace(' ', '_').replace('-', '_')
+        if replay_failed and city not in journal.failed_cities(): continue
+        set_context(category='children_attractions_images', city=city, option=None)
+        logger.info('Processing...%s', city.upper())
+        city_ = to_slug(city)
         try:
             file_path = Path(f'{CHILDREN_ATTRACTIONS_LIST_DIR}/{city_}.json')
             with open(file_path, 'r') as fp:
                 attractions = json.load(fp)
-            logger.info(f'Got attraction list succesfully...')    
-            for number, attraction in attractions.items():
+            logger.info('Got attraction list succesfully...')    
+            for number in journal.pending(city, attractions.keys()):
+                set_context(option=number)
+                attraction = attractions[number]
                 prompt = prompts['child_attractions'].format(attraction=attraction, city=city)
                 try:
                     url = get_images_DALLE(prompt)
                     if not url: raise Exception(f'No image generated for {number}:"{attraction}"')
-                    logger.info(f'Generated succesfully: {number}:"{attraction}"')
+                    logger.info('Generated succesfully: %s:"%s"', number, attraction)
                     attraction = attraction.replace(' ', '_').replace('-', '_').replace("'", "")
-                    download_image(url[0], city, number, attraction)
+                    save_path = download_image(url[0], city, number, attraction)
+                    if not save_path: raise Exception(f'No image saved for {number}:"{attraction}"')
+                    journal.record(city, number, save_path.name)
                 except Exception as err:
                     logger.error(err)
+                    journal.fail(city, number, err)
                     continue        
         except FileNotFoundError as err:
             logger.error(err)
             continue
         
-        logger.info(f'Processed successfully...{city}, total score: {j + 1}/{len(cities)}')
+        logger.info('Processed successfully...%s, total score: %s/%s', city, j + 1, len(cities))
         j += 1
 
 
@@ -1,10 +1,13 @@
 import json
-import requests
 from pathlib import Path
 
 
 from config import CITY_ATTRACTIONS_LIST_DIR, PROMPTS_DIR, SMM_DIR
-from functions import get_prompts_GPT, get_response_GPT, elapsed_time, get_cities
+from functions import get_prompts_GPT, elapsed_time, get_cities, is_valid_link
+from async_gpt import get_responses_GPT
+from journal import Journal
+from ledger import set_context
+from content_store import get_store
 
 
 def get_options(city: str) -> dict:    
@@ -13,51 +16,51 @@ def get_options(city: str) -> dict:
     return options
 
 
-def is_valid_link(url: str, timeout: int=10) -> bool:
-    try:
-        requests.head(url, timeout=timeout, allow_redirects=False).raise_for_status()
-        return True
-    except requests.exceptions.RequestException as err:
-        print("An error occurred during the request:", err)
-        return False
+def output_data(data: dict, city: str, output_path: Path | str, category: str, language: str='en') -> None:
+    get_store().save_city(category, city, data, output_path, language, ensure_ascii=False)
 
 
-def output_data(data: dict, city: str, output_path: Path | str) -> None:
-    if any([' ' in city, '-' in city]):
-        city = city.replace(' ', '_').replace('-', '_')
-    with open(f'{output_path}/{city}.json', 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-
-
-def generate_texts(city: str, options: dict, prompt: str) -> dict:
-    data = dict()
-    for i, option in options.items():
+def generate_texts(city: str, options: dict, prompt: str, journal: Journal | None=None) -> dict:
+    data = journal.city_results(city) if journal else dict()
+    pending = journal.pending(city, options.keys()) if journal else list(options)
+    responses = get_responses_GPT({i: prompt.format(option=options[i], city=city) for i in pending})
+    for i in pending:
+        option = options[i]
         print(i, option)
         try:
-            response = get_response_GPT(prompt.format(option=option, city=city))
+            response = responses[i]
             content = json.loads(response, strict=False)
             if not is_valid_link(content['link']): content['link'] = ''
             data[i] = content
+            if journal: journal.record(city, i, content)
         except TypeError as err:
             print("TypeError:", err)
+            if journal: journal.fail(city, i, err)
             continue
         except json.JSONDecodeError as err:
             print(err)
+            if journal: journal.fail(city, i, err)
             continue
         except Exception as err:
             print("TypeError:",err)
+            if journal: journal.fail(city, i, err)
     return data
 
 
 @elapsed_time
-def main(index: int=0, prompts_file: str='', output_dir: str='.'):
+def main(index: int=0, prompts_file: str='', output_dir: str='.', replay_failed: bool=False, cities: list | None=None):
     prompts = get_prompts_GPT(f'{PROMPTS_DIR}/{prompts_file}')
+    category = f'smm_{Path(output_dir).name}'
+    journal = Journal(category)
     output_path = Path(f'{SMM_DIR}/{output_dir}')
     output_path.mkdir(parents=True, exist_ok=True)
-    for city in get_cities():
+    for city in cities or get_cities():
+        if replay_failed and city not in journal.failed_cities(): continue
+        set_context(category=category, city=city)
         options = get_options(city)
-        texts = generate_texts(city, options, prompts['prompt_ru'])
-        output_data(texts, city, output_path)
+        texts = generate_texts(city, options, prompts['prompt_ru'], journal)
+        # the texts are written by the Russian prompt
+        output_data(texts, city, output_path, category, language='ru')
 
 
 if __name__ == "__main__":
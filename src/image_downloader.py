@@ -0,0 +1,145 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from pathlib import Path
+from typing import Hashable
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+from ledger import submit
+from renditions import fit, render
+from resilience import call_with_retry, POLICIES
+from profiling import span
+
+
+POOL_SIZE = 16
+WORKERS = 4
+# (connect, read) timeouts in seconds
+TIMEOUT = (5, 60)
+MAX_BYTES = 20 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageDownloader:
+    def __init__(self,
+                 workers: int=WORKERS,
+                 pool_size: int=POOL_SIZE,
+                 timeout: tuple=TIMEOUT,
+                 max_bytes: int=MAX_BYTES) -> None:
+        """
+        Downloads images over a keep-alive connection pool with bounded parallelism.
+        The body is streamed to a temporary file next to the target, decoded once, scaled down
+        (never up) and atomically moved into place, so a failed download never leaves a broken image behind.
+
+        Args:
+            workers (int, optional): downloads running at the same time. Defaults to WORKERS.
+            pool_size (int, optional): keep-alive connections per host. Defaults to POOL_SIZE.
+            timeout (tuple, optional): (connect, read) timeouts in seconds. Defaults to TIMEOUT.
+            max_bytes (int, optional): max size of a downloaded body. Defaults to MAX_BYTES.
+        """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    def _stream_to(self, url: str, fp) -> int:
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if int(response.headers.get('Content-Length', 0)) > self.max_bytes:
+                raise IOError(f'Image {url} is larger than {self.max_bytes} bytes')
+            size = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise IOError(f'Image {url} is larger than {self.max_bytes} bytes')
+                fp.write(chunk)
+            return size
+
+    def fetch(self, url: str, save_path: Path | str, size: tuple | None=(1024, 1024), renditions: dict | None=None) -> Path:
+        """
+        Downloads an image, scales it down to fit `size` and saves it as JPEG.
+        Smaller images are kept at their native size, e.g. 512x512 DALL-E images are not upscaled.
+
+        Args:
+            url (str): image url
+            save_path (Path | str): target file
+            size (tuple | None, optional): max size, None keeps the original. Defaults to (1024, 1024).
+            renditions (dict | None, optional): renditions written from the same decode (see `renditions.render`). Defaults to None.
+
+        Returns:
+            Path: saved file
+        """
+        save_path = Path(save_path)
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        raw_fd, raw_path = tempfile.mkstemp(dir=save_path.parent, suffix='.part')
+        out_fd, out_path = tempfile.mkstemp(dir=save_path.parent, suffix='.jpg.part')
+        os.close(out_fd)
+        try:
+            with os.fdopen(raw_fd, 'wb') as fp:
+                def attempt():
+                    # a retry starts the body from scratch
+                    fp.seek(0)
+                    fp.truncate()
+                    return self._stream_to(url, fp)
+                with span('download'):
+                    call_with_retry(attempt, policy=POLICIES['download'], name='download')
+            with span('resize'), Image.open(raw_path) as image:
+                if size and image.format == 'JPEG':
+                    image.draft('RGB', size)
+                image.load()
+                if size and (image.size[0] > size[0] or image.size[1] > size[1]):
+                    image = image.resize(fit(image.size, max(size)), Image.LANCZOS)
+                image = image.convert('RGB')
+                image.save(out_path, format='JPEG')
+                if renditions:
+                    render(image, save_path.parent, save_path.stem, renditions)
+            os.replace(out_path, save_path)
+            return save_path
+        finally:
+            for path in (raw_path, out_path):
+                if os.path.exists(path): os.remove(path)
+
+    def submit(self, key: Hashable, url: str, save_path: Path | str, size: tuple | None=(1024, 1024), renditions: dict | None=None) -> Future:
+        """
+        Starts a download in the background, so the caller can go on generating.
+        The result is collected by `wait_all` under the given key.
+        """
+        future = submit(self.executor, self.fetch, url, save_path, size, renditions)
+        with self.lock:
+            self.pending[key] = future
+        return future
+
+    def wait_all(self) -> dict:
+        """
+        Waits for all submitted downloads.
+
+        Returns:
+            dict: exceptions of the failed downloads by key
+        """
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        wait(pending.values())
+        return {key: future.exception() for key, future in pending.items() if future.exception()}
+
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+
+def get_downloader() -> ImageDownloader:
+    """
+    Returns the process-wide downloader, creating it on first use.
+    """
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = ImageDownloader()
+        return _downloader
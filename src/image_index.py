@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import threading
+from pathlib import Path
+
+from config import IMG_DIR
+from data_provider import to_slug
+
+
+MANIFEST_PATH = Path(__file__).resolve().parent.parent/'files'/'cache'/'image_index.json'
+BASE_URL = 'http://20.240.63.21/files/images'
+
+
+class ImageIndex:
+    def __init__(self, root: Path | str=IMG_DIR, manifest_path: Path | str=MANIFEST_PATH, base_url: str=BASE_URL) -> None:
+        """
+        Index of the '.jpg' files of <root>/<category>/<city slug>/ answering (category, city, number)
+        -> file name and public URL without touching the disk. A category is scanned on first use;
+        the listing of every city folder is kept in a manifest together with the folder's mtime,
+        so a refresh lists again only the folders that changed (e.g. where images were added).
+
+        Args:
+            root (Path | str, optional): images root folder. Defaults to IMG_DIR.
+            manifest_path (Path | str, optional): persisted listings. Defaults to MANIFEST_PATH.
+            base_url (str, optional): public URL of the root folder. Defaults to BASE_URL.
+        """
+        self.root = Path(root)
+        self.manifest_path = Path(manifest_path)
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.manifest = json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else dict()
+        # category -> city slug -> number -> file name
+        self.numbers = dict()
+
+    def refresh(self, category: str) -> int:
+        """
+        Lists again the city folders of a category whose mtime changed and saves the manifest.
+
+        Returns:
+            int: number of listed folders
+        """
+        with self.lock:
+            known = self.manifest.get(str(self.root/category), dict())
+            listings, listed = dict(), 0
+            try:
+                city_dirs = [entry for entry in os.scandir(self.root/category) if entry.is_dir()]
+            except FileNotFoundError:
+                city_dirs = []
+            for city_dir in city_dirs:
+                mtime = city_dir.stat().st_mtime_ns
+                if city_dir.name in known and known[city_dir.name]['mtime'] == mtime:
+                    listings[city_dir.name] = known[city_dir.name]
+                    continue
+                names = sorted(entry.name for entry in os.scandir(city_dir.path) if entry.name.endswith('.jpg') and entry.is_file())
+                listings[city_dir.name] = {'mtime': mtime, 'names': names}
+                listed += 1
+            self.manifest[str(self.root/category)] = listings
+            self.numbers[category] = {city: self._by_number(listing['names']) for city, listing in listings.items()}
+            if listed or len(listings) != len(known):
+                self._save()
+            return listed
+
+    @staticmethod
+    def _by_number(names: list) -> dict:
+        numbers = dict()
+        for name in names:
+            number, sep, _ = name.partition('_')
+            # the first file wins, as next(glob(f'{number}_*.jpg')) did
+            if sep and number not in numbers:
+                numbers[number] = name
+        return numbers
+
+    def _save(self) -> None:
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.manifest))
+        os.replace(tmp_path, self.manifest_path)
+
+    def _category(self, category: str) -> dict:
+        if category not in self.numbers:
+            self.refresh(category)
+        return self.numbers[category]
+
+    def name(self, category: str, city: str, number) -> str:
+        """
+        Returns the file name of image <number>_*.jpg of a city.
+
+        Raises:
+            KeyError: no such image
+        """
+        return self._category(category)[to_slug(city)][str(number)]
+
+    def url(self, category: str, city: str, number) -> str:
+        """
+        Returns the public URL of image <number>_*.jpg of a city.
+
+        Raises:
+            KeyError: no such image
+        """
+        return f'{self.base_url}/{category}/{to_slug(city)}/{self.name(category, city, number)}'
+
+    def names(self, category: str, city: str) -> list:
+        """
+        Returns the file names of all '.jpg' images of a city.
+        """
+        self._category(category)
+        return list(self.manifest[str(self.root/category)].get(to_slug(city), {'names': []})['names'])
+
+    def urls(self, category: str, city: str) -> list:
+        return [f'{self.base_url}/{category}/{to_slug(city)}/{name}' for name in self.names(category, city)]
+
+    def numbered(self, category: str, city: str) -> dict:
+        """
+        Returns the numbered images of a city as {number: path}.
+        """
+        return {number: self.root/category/to_slug(city)/name
+                for number, name in self._category(category).get(to_slug(city), dict()).items()}
+
+
+_index = None
+
+
+def get_image_index() -> ImageIndex:
+    global _index
+    if _index is None:
+        _index = ImageIndex()
+    return _index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the image index of some categories')
+    parser.add_argument('categories', nargs='+', help='Image categories, e.g. city_attractions')
+    args = parser.parse_args()
+
+    index = get_image_index()
+    for category in args.categories:
+        print(f'{category}: {index.refresh(category)} folders listed')
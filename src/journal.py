@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from profiling import span
+
+
+JOURNAL_DIR = Path(__file__).resolve().parent.parent/'files'/'journal'
+
+
+class Journal:
+    def __init__(self, category: str, path: Path | str | None=None) -> None:
+        """
+        Write-ahead journal of per-option results for one generation category. Every completed
+        (city, option) result and every failure is appended as a JSON line and flushed to disk
+        before the script moves on, so a crash loses at most the option in progress.
+        On start the journal is replayed: the last record of each (city, option) wins.
+
+        Args:
+            category (str): category name, used as the journal file name
+            path (Path | str | None, optional): journal file. Defaults to JOURNAL_DIR/<category>.jsonl.
+        """
+        self.category = category
+        self.path = Path(path) if path else JOURNAL_DIR/f'{category}.jsonl'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.done = dict()
+        self.failed = dict()
+        self._load()
+
+    def _load(self) -> None:
+        if not self.path.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn last line after a crash
+                    continue
+                key = (record['city'], str(record['option']))
+                if record['status'] == 'reset':
+                    # an empty option resets the whole city
+                    if record['option']:
+                        self.done.pop(key, None)
+                        self.failed.pop(key, None)
+                    else:
+                        self._drop_city(record['city'])
+                elif record['status'] == 'done':
+                    self.done[key] = record['result']
+                    self.failed.pop(key, None)
+                else:
+                    self.failed[key] = record['error']
+                    self.done.pop(key, None)
+
+    def _append(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock, span('write.journal'):
+            # one write per record in append mode keeps lines whole across processes
+            with open(self.path, 'a', encoding='utf-8') as fp:
+                fp.write(line)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+    def is_done(self, city: str, option) -> bool:
+        return (city, str(option)) in self.done
+
+    def get(self, city: str, option):
+        return self.done.get((city, str(option)))
+
+    def pending(self, city: str, options) -> list:
+        """
+        Returns the options of a city that have no completed result yet.
+        """
+        return [option for option in options if not self.is_done(city, option)]
+
+    def record(self, city: str, option, result) -> None:
+        """
+        Appends a completed result.
+
+        Args:
+            city (str): city name
+            option: option number or name
+            result: JSON-serializable result of the option
+        """
+        self._append({'status': 'done', 'city': city, 'option': str(option), 'result': result, 'time': time.time()})
+        self.done[(city, str(option))] = result
+        self.failed.pop((city, str(option)), None)
+
+    def fail(self, city: str, option, error: Exception | str) -> None:
+        """
+        Appends a failure to the ledger, the option will be retried on the next run.
+        """
+        error = f'{type(error).__name__}: {error}' if isinstance(error, Exception) else str(error)
+        self._append({'status': 'failed', 'city': city, 'option': str(option), 'error': error, 'time': time.time()})
+        self.failed[(city, str(option))] = error
+        self.done.pop((city, str(option)), None)
+
+    def _drop_city(self, city: str) -> None:
+        for results in (self.done, self.failed):
+            for key in [key for key in results if key[0] == city]:
+                del results[key]
+
+    def reset(self, city: str, options: list | None=None) -> None:
+        """
+        Forgets the results and failures of a city, e.g. after its inputs or prompts changed.
+
+        Args:
+            city (str): city name
+            options (list | None, optional): options to forget, all of the city if None. Defaults to None.
+        """
+        if options is None:
+            self._append({'status': 'reset', 'city': city, 'option': '', 'time': time.time()})
+            self._drop_city(city)
+            return
+        for option in options:
+            self._append({'status': 'reset', 'city': city, 'option': str(option), 'time': time.time()})
+            self.done.pop((city, str(option)), None)
+            self.failed.pop((city, str(option)), None)
+
+    def city_results(self, city: str) -> dict:
+        """
+        Returns the completed results of a city by option.
+        """
+        return {option: result for (city_, option), result in self.done.items() if city_ == city}
+
+    def failed_cities(self) -> set:
+        return {city for city, _ in self.failed}
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+from rate_limiter import get_limiter, DEFAULT_RPM, DEFAULT_TPM
+from resilience import is_fatal
+from profiling import span
+
+
+# env variable with the pool as a JSON list, e.g.
+# [{"api_key": "OPENAI_API_KEY_CT_1", "rpm": 60, "tpm": 90000}, {"api_key": "OPENAI_API_KEY_CT_2", "organization": "OPENAI_ID_CT_2"}]
+# (values are env variable names, not the keys themselves)
+POOL_ENV = 'OPENAI_KEY_POOL'
+DEFAULT_KEYS = [{'api_key': 'OPENAI_API_KEY_CT_2'}]
+DEFAULT_ORGANIZATION = 'OPENAI_ID_CT'
+# seconds a key is out of rotation after a rate limit, an exhausted quota or a rejected key
+RATE_LIMIT_COOLDOWN = 60
+QUOTA_COOLDOWN = 3600
+
+
+class NoKeyAvailable(Exception):
+    """
+    Every key of the pool is out of rotation for a quota or authentication error, or none gets
+    budget before the caller's deadline.
+    """
+
+
+class ApiKey:
+    def __init__(self,
+                 api_key: str,
+                 organization: str=DEFAULT_ORGANIZATION,
+                 rpm: int=DEFAULT_RPM,
+                 tpm: int=DEFAULT_TPM,
+                 images_rpm: int=DEFAULT_RPM) -> None:
+        """
+        One key of the pool with its own limits, see `rate_limiter.RateLimiter`.
+
+        Args:
+            api_key (str): name of the env variable with the API key
+            organization (str, optional): name of the env variable with the organization id. Defaults to DEFAULT_ORGANIZATION.
+            rpm (int, optional): completion requests per minute. Defaults to DEFAULT_RPM.
+            tpm (int, optional): completion tokens per minute. Defaults to DEFAULT_TPM.
+            images_rpm (int, optional): image requests per minute. Defaults to DEFAULT_RPM.
+        """
+        self.name = api_key
+        self.organization = organization
+        self.limiters = {'chat': get_limiter(api_key, rpm, tpm),
+                         'images': get_limiter(f'{api_key}:images', images_rpm, None)}
+        self.cooldown_until = 0.0
+        # the quota or authentication error that put the key out of rotation, None for a rate limit
+        self.fatal_error = None
+
+    @property
+    def credentials(self) -> dict:
+        """
+        Keyword arguments for the openai calls, so that no global client state is touched.
+        """
+        return {'api_key': os.getenv(self.name), 'organization': os.getenv(self.organization)}
+
+
+class KeyPool:
+    def __init__(self, keys: list[ApiKey]) -> None:
+        """
+        Spreads requests over several API keys. A request takes the available key with the most
+        budget left (see `RateLimiter.remaining`) and waits only when every key is exhausted.
+        Keys returning quota or authentication errors are taken out of rotation for a while.
+
+        Args:
+            keys (list[ApiKey]): pool keys
+        """
+        if not keys:
+            raise ValueError('The key pool needs at least one key')
+        self.keys = keys
+        self.lock = threading.Lock()
+
+    def _candidates(self, kind: str) -> list[ApiKey]:
+        now = time.time()
+        with self.lock:
+            active = [key for key in self.keys if key.cooldown_until <= now]
+        # when every key is cooling down the one that comes back first after a rate limit is used,
+        # keys that failed with a quota or authentication error are not waited for
+        if not active:
+            cooling = [key for key in self.keys if key.fatal_error is None]
+            if not cooling:
+                raise NoKeyAvailable(f'Every API key is out of rotation: {self.keys[0].fatal_error}') from self.keys[0].fatal_error
+            return [min(cooling, key=lambda key: key.cooldown_until)]
+        return sorted(active, key=lambda key: min(key.limiters[kind].remaining()), reverse=True)
+
+    def _try_checkout(self, tokens: int, kind: str) -> tuple[ApiKey | None, float]:
+        waits = []
+        for key in self._candidates(kind):
+            # a cooling key is not charged, its budget is only taken when it can be used
+            wait = key.cooldown_until - time.time()
+            if wait <= 0 and not (wait := key.limiters[kind]._try_acquire(tokens)):
+                return key, 0.0
+            waits.append(wait)
+        return None, min(waits)
+
+    @staticmethod
+    def _check_deadline(wait: float, deadline: float | None) -> None:
+        if deadline is not None and time.monotonic() + wait > deadline:
+            raise NoKeyAvailable(f'No API key has budget before the deadline, the next one in {wait:.0f} s')
+
+    def checkout(self, tokens: int=0, kind: str='chat', deadline: float | None=None) -> ApiKey:
+        """
+        Blocks until one of the keys has budget for a request and takes it.
+
+        Args:
+            tokens (int, optional): estimated tokens of the request. Defaults to 0.
+            kind (str, optional): 'chat' or 'images'. Defaults to 'chat'.
+            deadline (float | None, optional): time.monotonic() after which not to wait. Defaults to None.
+
+        Raises:
+            NoKeyAvailable: every key failed with a quota or authentication error, or the wait would pass the deadline
+
+        Returns:
+            ApiKey: the key to send the request with
+        """
+        with span('limiter_wait'):
+            while True:
+                key, wait = self._try_checkout(tokens, kind)
+                if key: return key
+                self._check_deadline(wait, deadline)
+                time.sleep(wait)
+
+    async def checkout_async(self, tokens: int=0, kind: str='chat', deadline: float | None=None) -> ApiKey:
+        """
+        Asyncio version of `checkout`.
+        """
+        with span('limiter_wait'):
+            while True:
+                key, wait = await asyncio.to_thread(self._try_checkout, tokens, kind)
+                if key: return key
+                self._check_deadline(wait, deadline)
+                await asyncio.sleep(wait)
+
+    def settle(self, key: ApiKey, reserved: int, used: int) -> None:
+        key.limiters['chat'].settle(reserved, used)
+
+    def report_error(self, key: ApiKey, err: Exception) -> None:
+        """
+        Takes a key out of rotation after a rate limit (for Retry-After or RATE_LIMIT_COOLDOWN seconds),
+        an exhausted quota or a rejected key (QUOTA_COOLDOWN seconds). Other errors are ignored.
+        """
+        status = getattr(err, 'http_status', None)
+        fatal = is_fatal(err)
+        if fatal:
+            cooldown = QUOTA_COOLDOWN
+        elif status == 429:
+            headers = getattr(err, 'headers', None) or dict()
+            try:
+                cooldown = float(headers.get('Retry-After', RATE_LIMIT_COOLDOWN))
+            except (TypeError, ValueError):
+                cooldown = RATE_LIMIT_COOLDOWN
+        else:
+            return
+        with self.lock:
+            if key.cooldown_until <= time.time(): key.fatal_error = None
+            key.cooldown_until = max(key.cooldown_until, time.time() + cooldown)
+            if fatal: key.fatal_error = err
+        print(f'API key {key.name} is out of rotation for {cooldown:.0f} s: {err}')
+
+
+def load_keys() -> list[ApiKey]:
+    """
+    Reads the pool from the OPENAI_KEY_POOL env variable, DEFAULT_KEYS if it is not set.
+    """
+    specs = json.loads(os.environ[POOL_ENV]) if os.getenv(POOL_ENV) else DEFAULT_KEYS
+    return [ApiKey(**spec) for spec in specs]
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(api_key: str | None=None) -> KeyPool:
+    """
+    Returns the process-wide pool, or a pool of the single given key for callers that pin one.
+
+    Args:
+        api_key (str | None, optional): name of the env variable with API key. Defaults to None.
+    """
+    with _pools_lock:
+        if api_key not in _pools:
+            _pools[api_key] = KeyPool([ApiKey(api_key)] if api_key else load_keys())
+        return _pools[api_key]
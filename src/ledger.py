@@ -0,0 +1,185 @@
+import argparse
+import contextlib
+import contextvars
+import json
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Executor, Future
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+
+LEDGER_PATH = Path(__file__).resolve().parent.parent/'files'/'ledger'/'calls.jsonl'
+# estimated USD prices, per token for completions and per image for DALL-E
+PRICES = {
+    'gpt-3.5-turbo': {'prompt': 0.0015 / 1000, 'completion': 0.002 / 1000},
+    'dall-e': {'256x256': 0.016, '512x512': 0.018, '1024x1024': 0.020},
+}
+GROUP_KEYS = ('day', 'stage', 'category', 'prompt_key', 'model', 'city')
+
+_context = contextvars.ContextVar('ledger_context', default=dict())
+
+
+def set_context(**fields) -> None:
+    """
+    Sets fields (stage, category, city, prompt_key) recorded with the following calls of the
+    current thread or asyncio task, e.g. set_context(category='cheap_eats', city=city) in a city loop.
+    """
+    _context.set({**_context.get(), **fields})
+
+
+def get_context() -> dict:
+    """
+    Fields set for the current thread or asyncio task, e.g. to tag log records. Don't modify it.
+    """
+    return _context.get()
+
+
+@contextlib.contextmanager
+def call_context(**fields):
+    """
+    Same as `set_context` for the calls inside the with block only.
+    """
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def submit(executor: Executor, fn: Callable, *args, **kwargs) -> Future:
+    """
+    Same as executor.submit, but the task runs with the fields set by the caller. Pool threads
+    don't inherit them otherwise, and every task gets its own copy, so fields it sets don't leak
+    into the next task of the same thread.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def estimate_cost(model: str, prompt_tokens: int=0, completion_tokens: int=0, images: int=0, size: str | None=None) -> float:
+    prices = PRICES.get(model, dict())
+    if images:
+        return images * prices.get(size, 0.0)
+    return prompt_tokens * prices.get('prompt', 0.0) + completion_tokens * prices.get('completion', 0.0)
+
+
+class Ledger:
+    def __init__(self, path: Path | str=LEDGER_PATH) -> None:
+        """
+        Append-only JSON lines log of every completion and image call: model, context
+        (stage, category, city, prompt key), tokens, latency, retries and estimated cost.
+
+        Args:
+            path (Path | str, optional): ledger file. Defaults to LEDGER_PATH.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def record(self,
+               model: str,
+               prompt_tokens: int=0,
+               completion_tokens: int=0,
+               images: int=0,
+               size: str | None=None,
+               latency_s: float=0.0,
+               total_s: float=0.0,
+               retries: int=0,
+               cached: bool=False,
+               error: str | None=None) -> None:
+        """
+        Appends one call.
+
+        Args:
+            model (str): model name
+            prompt_tokens (int, optional): prompt tokens from the response usage. Defaults to 0.
+            completion_tokens (int, optional): completion tokens from the response usage. Defaults to 0.
+            images (int, optional): number of generated images. Defaults to 0.
+            size (str | None, optional): image size. Defaults to None.
+            latency_s (float, optional): duration of the successful request. Defaults to 0.0.
+            total_s (float, optional): duration of the call with waits for the budget and retries. Defaults to 0.0.
+            retries (int, optional): failed attempts before the last one. Defaults to 0.
+            cached (bool, optional): served from the response cache. Defaults to False.
+            error (str | None, optional): error of a failed call. Defaults to None.
+        """
+        entry = {'time': time.time(), **_context.get(), 'model': model,
+                 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'images': images,
+                 'latency_s': round(latency_s, 3), 'total_s': round(total_s, 3), 'retries': retries,
+                 'cost': 0.0 if cached or error else estimate_cost(model, prompt_tokens, completion_tokens, images, size),
+                 'cached': cached, 'error': error}
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as fp:
+                fp.write(line)
+
+    def read(self, since: float | None=None):
+        if not self.path.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if since is None or entry['time'] >= since:
+                    yield entry
+
+    def rollup(self, by: tuple=('day', 'stage', 'category'), since: float | None=None) -> dict:
+        """
+        Sums the calls by the given fields (any of GROUP_KEYS).
+
+        Returns:
+            dict: group tuple -> calls, cached, errors, tokens, images, retries, cost, mean and p95 latency
+        """
+        groups = defaultdict(list)
+        for entry in self.read(since):
+            entry['day'] = datetime.fromtimestamp(entry['time']).strftime('%Y-%m-%d')
+            groups[tuple(entry.get(key) or '-' for key in by)].append(entry)
+        rollup = dict()
+        for group, entries in sorted(groups.items()):
+            latencies = sorted(e['latency_s'] for e in entries if not e['cached'] and not e['error'])
+            rollup[group] = {'calls': len(entries),
+                             'cached': sum(e['cached'] for e in entries),
+                             'errors': sum(bool(e['error']) for e in entries),
+                             'prompt_tokens': sum(e['prompt_tokens'] for e in entries),
+                             'completion_tokens': sum(e['completion_tokens'] for e in entries),
+                             'images': sum(e['images'] for e in entries),
+                             'retries': sum(e['retries'] for e in entries),
+                             'cost': round(sum(e['cost'] for e in entries), 4),
+                             'mean_s': round(statistics.mean(latencies), 2) if latencies else 0.0,
+                             'p95_s': latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0}
+        return rollup
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> Ledger:
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger()
+        return _ledger
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Roll up the API calls ledger')
+    parser.add_argument('--by', nargs='+', default=['day', 'stage', 'category'], choices=GROUP_KEYS, help='Fields to group by (default: day stage category)')
+    parser.add_argument('--days', type=float, default=None, help='Only the last N days (default: all)')
+    parser.add_argument('--json', action='store_true', help='Print JSON instead of a table')
+    args = parser.parse_args()
+
+    since = time.time() - args.days * 86400 if args.days else None
+    rollup = get_ledger().rollup(tuple(args.by), since)
+    if args.json:
+        print(json.dumps([{**dict(zip(args.by, group)), **totals} for group, totals in rollup.items()], indent=4))
+    else:
+        columns = ['calls', 'cached', 'errors', 'prompt_tokens', 'completion_tokens', 'images', 'retries', 'cost', 'mean_s', 'p95_s']
+        print(' | '.join([*args.by, *columns]))
+        for group, totals in rollup.items():
+            print(' | '.join([*map(str, group), *(str(totals[column]) for column in columns)]))
+        print(f'Total cost: ${sum(totals["cost"] for totals in rollup.values()):.2f}')
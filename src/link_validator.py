@@ -0,0 +1,150 @@
+import asyncio
+import contextlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import aiohttp
+
+from resilience import call_with_retry_async, HTTPStatusError, RETRYABLE_STATUS, POLICIES
+from profiling import span
+
+
+DEFAULT_DB = Path(__file__).resolve().parent.parent/'files'/'cache'/'links.sqlite'
+# statuses of reachable urls are kept for a week, network errors only for an hour
+TTL = 7 * 24 * 3600
+ERROR_TTL = 3600
+TIMEOUT = 10
+LIMIT = 64
+LIMIT_PER_HOST = 4
+# status stored for timeouts and connection errors
+NETWORK_ERROR = -1
+# urls per IN (...) query, below SQLite's default limit of 999 parameters
+QUERY_CHUNK = 900
+
+
+class LinkCache:
+    def __init__(self, path: Path | str=DEFAULT_DB, ttl: float=TTL, error_ttl: float=ERROR_TTL) -> None:
+        """
+        Persistent url -> HTTP status cache with a TTL, shared by all scripts and categories.
+
+        Args:
+            path (Path | str, optional): SQLite file. Defaults to DEFAULT_DB.
+            ttl (float, optional): seconds a status is valid. Defaults to TTL.
+            error_ttl (float, optional): seconds a network error is remembered. Defaults to ERROR_TTL.
+        """
+        self.path = Path(path)
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS links (url TEXT PRIMARY KEY, status INTEGER, checked REAL)')
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def get_many(self, urls: list) -> dict:
+        """
+        Returns fresh cached statuses of the given urls.
+        """
+        now = time.time()
+        rows = []
+        with contextlib.closing(self._connect()) as conn:
+            for i in range(0, len(urls), QUERY_CHUNK):
+                chunk = urls[i:i + QUERY_CHUNK]
+                rows += conn.execute(f'SELECT url, status, checked FROM links WHERE url IN ({",".join("?" * len(chunk))})',
+                                     chunk).fetchall()
+        return {url: status for url, status, checked in rows
+                if now - checked < (self.error_ttl if status == NETWORK_ERROR else self.ttl)}
+
+    def set_many(self, statuses: dict) -> None:
+        now = time.time()
+        with contextlib.closing(self._connect()) as conn:
+            conn.executemany('INSERT OR REPLACE INTO links VALUES (?, ?, ?)',
+                             [(url, status, now) for url, status in statuses.items()])
+
+
+async def get_status(session: aiohttp.ClientSession, url: str) -> int:
+    """
+    HEAD request falling back to GET when the server doesn't allow HEAD.
+    429, 5xx and network errors are retried once (see `resilience.POLICIES['link']`).
+
+    Returns:
+        int: HTTP status or NETWORK_ERROR
+    """
+    async def request():
+        async with session.head(url, allow_redirects=False) as response:
+            status, headers = response.status, dict(response.headers)
+        if status == 405:
+            async with session.get(url, allow_redirects=False) as response:
+                status, headers = response.status, dict(response.headers)
+        if status in RETRYABLE_STATUS:
+            raise HTTPStatusError(status, headers)
+        return status
+
+    try:
+        return await call_with_retry_async(request, policy=POLICIES['link'], name='link')
+    except HTTPStatusError as err:
+        return err.status
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+        print("An error occurred during the request:", url, err)
+        return NETWORK_ERROR
+
+
+async def validate_links_async(urls: list, cache: LinkCache | None=None) -> dict:
+    """
+    Checks all urls in parallel with a per-host connection limit, using the cache for known urls.
+
+    Args:
+        urls (list): urls to check
+        cache (LinkCache | None, optional): status cache. Defaults to the shared cache.
+
+    Returns:
+        dict: url -> True if the url answered with a status below 400
+    """
+    urls = list(dict.fromkeys(url for url in urls if isinstance(url, str) and url))
+    if not urls:
+        return dict()
+    cache = cache or get_link_cache()
+    statuses = cache.get_many(urls)
+    unknown = [url for url in urls if url not in statuses]
+    if unknown:
+        connector = aiohttp.TCPConnector(limit=LIMIT, limit_per_host=LIMIT_PER_HOST)
+        # no total timeout: it would count the wait for a free connection to a busy host,
+        # only connecting and reading are limited
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=TIMEOUT, sock_read=TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            checked = await asyncio.gather(*(get_status(session, url) for url in unknown))
+        cache.set_many(dict(zip(unknown, checked)))
+        statuses.update(zip(unknown, checked))
+    return {url: 0 < statuses[url] < 400 for url in urls}
+
+
+def validate_links(urls: list) -> dict:
+    """
+    Blocking entry point for scripts, see `validate_links_async`.
+    """
+    with span('link_check'):
+        return asyncio.run(validate_links_async(urls))
+
+
+def filter_valid_links(urls: list) -> list:
+    """
+    Keeps the valid urls in their original order.
+    """
+    valid = validate_links(urls)
+    return [url for url in urls if valid.get(url)]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_link_cache() -> LinkCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LinkCache()
+        return _cache
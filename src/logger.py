@@ -1,29 +1,177 @@
+import argparse
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+from datetime import datetime
 from pathlib import Path
 from config import LOG_FORMATTER, LOGS_DIR
+from ledger import get_context
+
+try:
+    import fcntl
+except ImportError:
+    # without flock the shared file is safe for a single process only
+    fcntl = None
+
+
+# one sink for all scripts and worker processes, records are told apart by the logger and process fields
+LOG_FILE = 'pipeline.jsonl'
+MAX_BYTES = 50 * 1024 * 1024
+BACKUP_COUNT = 10
+CONTEXT_FIELDS = ('stage', 'category', 'city', 'option')
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        """
+        Tags the record with the stage, category, city and option set by `ledger.set_context` in the
+        logging thread or task, unless they were passed explicitly with extra=.
+        """
+        for field, value in get_context().items():
+            if field in CONTEXT_FIELDS and not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'process': record.process,
+                 'message': record.getMessage()}
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if getattr(record, 'exc', None):
+            entry['exc'] = record.exc
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        return f'{text}\n{record.exc}' if getattr(record, 'exc', None) else text
+
+
+class ExcQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Merges the message arguments like QueueHandler.prepare, but keeps the traceback apart in
+        record.exc instead of appending it to the message, so the file gets it as its own field.
+        """
+        exc = logging.Formatter().formatException(record.exc_info) if record.exc_info else record.exc_text
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args, record.exc_info, record.exc_text = record.message, None, None, None
+        record.exc = exc
+        return record
+
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, filename: Path | str, max_bytes: int=MAX_BYTES, backup_count: int=BACKUP_COUNT) -> None:
+        """
+        Size-rotated file that several processes append to: every write and rollover holds an
+        exclusive lock on <file>.lock, and a file rotated by another process is reopened.
+
+        Args:
+            filename (Path | str): log file
+            max_bytes (int, optional): size at which the file is rotated. Defaults to MAX_BYTES.
+            backup_count (int, optional): rotated files kept. Defaults to BACKUP_COUNT.
+        """
+        super().__init__(filename, 'a', max_bytes, backup_count, encoding='utf-8', delay=True)
+        self.lock_fp = open(f'{self.baseFilename}.lock', 'a') if fcntl else None
+
+    def _reopen_if_rotated(self) -> None:
+        if self.stream is None:
+            return
+        try:
+            rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self.stream.close()
+            self.stream = None
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.lock_fp is None:
+            return super().emit(record)
+        fcntl.flock(self.lock_fp, fcntl.LOCK_EX)
+        try:
+            self._reopen_if_rotated()
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lock_fp, fcntl.LOCK_UN)
+
+
+_queue = None
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def _start_listener() -> None:
+    """
+    Starts the thread that writes the records of all loggers of the process, so that logging
+    in the generation loops only puts records into a queue and never waits for the disk.
+    """
+    global _queue, _listener
+    Path(LOGS_DIR).mkdir(parents=True, exist_ok=True)
+    # the shared file gets debug messages as JSON lines
+    log_handler_file = SharedRotatingFileHandler(Path(LOGS_DIR)/LOG_FILE, MAX_BYTES, BACKUP_COUNT)
+    log_handler_file.setLevel(logging.DEBUG)
+    log_handler_file.setFormatter(JsonFormatter())
+    # the console only gets errors
+    log_handler_console = logging.StreamHandler()
+    log_handler_console.setLevel(logging.ERROR)
+    log_handler_console.setFormatter(TextFormatter(LOG_FORMATTER))
+    _queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(_queue, log_handler_file, log_handler_console, respect_handler_level=True)
+    _listener.start()
+    # stopping the listener writes the records still in the queue
+    atexit.register(_listener.stop)
 
 
 # logging parameters set up and create logger
 def logger_setup(name):
-    
+
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
-    
-    # create file handler which logs even debug messages
-    log_handler_file = logging.FileHandler(f'{LOGS_DIR}/{name}.log', 'w')
-    log_handler_file.setLevel(logging.DEBUG)
-    
-    # create console handler
-    log_handler_console = logging.StreamHandler()
-    log_handler_console.setLevel(logging.ERROR)
-    
-    # create formatter and add it to the handlers
-    formatter = logging.Formatter(LOG_FORMATTER)
-    log_handler_file.setFormatter(formatter)
-    log_handler_console.setFormatter(formatter)
-    
-    # add the handlers to the logger
-    logger.addHandler(log_handler_file)
-    logger.addHandler(log_handler_console)
-    
-    return logger         
\ No newline at end of file
+
+    with _setup_lock:
+        if _listener is None:
+            _start_listener()
+        # the same logger set up twice must not write every record twice
+        if not any(isinstance(handler, logging.handlers.QueueHandler) for handler in logger.handlers):
+            log_handler_queue = ExcQueueHandler(_queue)
+            log_handler_queue.addFilter(ContextFilter())
+            logger.addHandler(log_handler_queue)
+
+    return logger
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the shared JSON lines log as text')
+    parser.add_argument('--logger', default=None, help='Only records of this logger, e.g. cheap_eats_option')
+    parser.add_argument('--city', default=None, help='Only records of this city')
+    parser.add_argument('--level', default='DEBUG', help='Minimum level (default: DEBUG)')
+    parser.add_argument('--tail', type=int, default=0, help='Only the last N matching records')
+    args = parser.parse_args()
+
+    level = logging.getLevelName(args.level.upper())
+    lines = []
+    with open(Path(LOGS_DIR)/LOG_FILE, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            entry = json.loads(line)
+            if args.logger and entry['logger'] != args.logger: continue
+            if args.city and entry.get('city') != args.city: continue
+            if logging.getLevelName(entry['level']) < level: continue
+            context = ' '.join(f'{field}={entry[field]}' for field in CONTEXT_FIELDS if field in entry)
+            lines.append(f'{entry["time"]} {entry["level"]} {entry["logger"]}[{entry["process"]}] {context} {entry["message"]}'
+                         + (f'\n{entry["exc"]}' if 'exc' in entry else ''))
+    for line in lines[-args.tail:] if args.tail else lines:
+        print(line)
@@ -0,0 +1,416 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+from response_schema import SCHEMAS
+
+
+CASSETTES_DIR = Path(__file__).resolve().parent.parent/'files'/'cassettes'
+UPSTREAM = 'https://api.openai.com'
+MODES = ('synthetic', 'replay', 'record')
+# every field any schema asks for, a synthetic JSON answer carries the ones the prompt names
+FIELD_TYPES = {field: type_[0] if isinstance(type_, tuple) else type_
+               for schema in SCHEMAS.values() for field, type_ in schema.fields.items()}
+WORDS = ('city', 'old', 'town', 'museum', 'river', 'square', 'market', 'cathedral', 'harbour', 'view', 'local', 'food',
+         'street', 'walk', 'park', 'history', 'gallery', 'bridge', 'castle', 'night', 'festival', 'family', 'garden', 'tour')
+BATCH_TASK = re.compile(r'^Task id (.+?):\n', re.M)
+
+
+def count_tokens(text: str) -> int:
+    # about 4 characters per token, like `rate_limiter.estimate_tokens`
+    return max(1, len(text) // 4)
+
+
+class Cassette:
+    def __init__(self, name: str, root: Path | str | None=None) -> None:
+        """
+        Recorded API responses in <root>/<name>.jsonl, keyed by a hash of the endpoint and the
+        request fields that decide the answer. Recorded images are kept in <root>/<name>_files/.
+
+        Args:
+            name (str): cassette name
+            root (Path | str | None, optional): cassettes folder. Defaults to CASSETTES_DIR.
+        """
+        root = Path(root or CASSETTES_DIR)
+        self.path = root/f'{name}.jsonl'
+        self.files_dir = root/f'{name}_files'
+        self.entries = dict()
+        self.lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as fp:
+                for line in fp:
+                    entry = json.loads(line)
+                    self.entries[entry['key']] = entry
+
+    @staticmethod
+    def make_key(endpoint: str, body: dict) -> str:
+        fields = {name: body.get(name) for name in ('model', 'messages', 'temperature', 'prompt', 'n', 'size')}
+        return hashlib.sha256(json.dumps([endpoint, fields], sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        return self.entries.get(key)
+
+    def put(self, entry: dict) -> None:
+        with self.lock:
+            self.entries[entry['key']] = entry
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as fp:
+                fp.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+class Bucket:
+    def __init__(self, rpm: int | None, tpm: int | None) -> None:
+        """
+        In-memory requests and tokens per minute budget of one API key on the server side.
+        """
+        self.rpm, self.tpm = rpm, tpm
+        self.requests, self.tokens, self.updated = float(rpm or 0), float(tpm or 0), time.monotonic()
+
+    def take(self, tokens: int) -> float:
+        """
+        Returns:
+            float: 0 if the request fits, otherwise seconds until it would
+        """
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        if self.rpm: self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm: self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        wait = 0.0
+        if self.rpm and self.requests < 1: wait = (1 - self.requests) * 60 / self.rpm
+        if self.tpm and self.tokens < min(tokens, self.tpm): wait = max(wait, (min(tokens, self.tpm) - self.tokens) * 60 / self.tpm)
+        if not wait:
+            if self.rpm: self.requests -= 1
+            if self.tpm: self.tokens -= tokens
+        return wait
+
+
+class StandIn:
+    def __init__(self,
+                 mode: str='synthetic',
+                 cassette: str | None=None,
+                 latency: float=0.5,
+                 jitter: float=0.2,
+                 per_token: float=0.0,
+                 error_429: float=0.0,
+                 error_5xx: float=0.0,
+                 rpm: int | None=None,
+                 tpm: int | None=None,
+                 completion_tokens: int=300,
+                 upstream: str=UPSTREAM,
+                 seed: int | None=None) -> None:
+        """
+        Local stand-in for the ChatCompletion and Image endpoints of the OpenAI API, the image URLs
+        it hands out and the links in its answers, so the scripts run end to end without network
+        or cost. Point the openai package at it with OPENAI_API_BASE=http://<host>:<port>/v1.
+
+        Args:
+            mode (str, optional): 'synthetic' makes up answers that pass the response schemas, 'replay' answers
+                from the cassette (synthetic on a miss), 'record' forwards to the real API and records. Defaults to 'synthetic'.
+            cassette (str | None, optional): cassette name for replay and record. Defaults to None.
+            latency (float, optional): base response time in seconds. Defaults to 0.5.
+            jitter (float, optional): random +/- seconds added to the latency. Defaults to 0.2.
+            per_token (float, optional): seconds per completion token on top of the latency. Defaults to 0.0.
+            error_429 (float, optional): share of requests answered with a rate limit error. Defaults to 0.0.
+            error_5xx (float, optional): share of requests answered with a server error. Defaults to 0.0.
+            rpm (int | None, optional): requests per minute per API key, None for no limit. Defaults to None.
+            tpm (int | None, optional): tokens per minute per API key, None for no limit. Defaults to None.
+            completion_tokens (int, optional): approximate size of synthetic answers. Defaults to 300.
+            upstream (str, optional): real API for record mode. Defaults to UPSTREAM.
+            seed (int | None, optional): random seed for the injected latency and errors. Defaults to None.
+        """
+        if mode not in MODES:
+            raise ValueError(f'mode must be one of {MODES}, got {mode}')
+        if mode != 'synthetic' and not cassette:
+            raise ValueError(f'{mode} mode needs a cassette')
+        self.mode = mode
+        self.cassette = Cassette(cassette) if cassette else None
+        self.latency, self.jitter, self.per_token = latency, jitter, per_token
+        self.error_429, self.error_5xx = error_429, error_5xx
+        self.rpm, self.tpm = rpm, tpm
+        self.completion_tokens = completion_tokens
+        self.upstream = upstream
+        self.rng = random.Random(seed)
+        self.buckets = dict()
+        self.images = dict()
+        self.stats = Counter()
+        self.latencies = []
+        self.session = None
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post('/v1/chat/completions', self.chat)
+        app.router.add_post('/v1/images/generations', self.images_generations)
+        app.router.add_get('/files/images/{name}', self.image_file)
+        app.router.add_get('/cassette/{name}', self.cassette_file)
+        app.router.add_route('*', '/links/{tail:.*}', self.link)
+        app.router.add_get('/stats', self.get_stats)
+        app.router.add_post('/stats/reset', self.reset_stats)
+        app.on_startup.append(self._open_session)
+        app.on_cleanup.append(self._close_session)
+        return app
+
+    async def _open_session(self, app) -> None:
+        if self.mode == 'record':
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600))
+
+    async def _close_session(self, app) -> None:
+        if self.session:
+            await self.session.close()
+
+    # synthetic answers
+
+    def _words(self, n: int) -> str:
+        return ' '.join(self.rng.choice(WORDS) for _ in range(n)).capitalize() + '.'
+
+    def _object(self, prompt: str, base_url: str) -> dict:
+        named = [field for field in FIELD_TYPES if re.search(rf'["\']{field}["\']', prompt)]
+        obj = dict()
+        for field in named or FIELD_TYPES:
+            if FIELD_TYPES[field] is list:
+                obj[field] = ([f'{base_url}/links/{self.rng.randrange(10 ** 6)}' for _ in range(3)] if field == 'links'
+                              else [self.rng.choice(WORDS) for _ in range(5)])
+            elif field == 'text':
+                obj[field] = self._words(int(self.completion_tokens * 0.6))
+            else:
+                obj[field] = self._words(10)
+        return obj
+
+    def _synthetic_content(self, prompt: str, base_url: str) -> str:
+        tasks = BATCH_TASK.split(prompt)
+        if len(tasks) > 1:
+            # a batch prompt (see `batch_prompts`): one answer per task id
+            return json.dumps([{'id': key, 'answer': self._object(task, base_url)} for key, task in zip(tasks[1::2], tasks[2::2])])
+        if 'json' in prompt.lower() or any(f'"{field}"' in prompt for field in FIELD_TYPES):
+            return json.dumps(self._object(prompt, base_url))
+        return '\n\n'.join(self._words(40) for _ in range(max(1, self.completion_tokens // 50)))
+
+    def _synthetic_image(self, size: int, variant: int) -> bytes:
+        if (size, variant) not in self.images:
+            from bench import synthetic_image
+            buffer = io.BytesIO()
+            synthetic_image(random.Random(variant), size).save(buffer, format='JPEG', quality=90)
+            self.images[(size, variant)] = buffer.getvalue()
+        return self.images[(size, variant)]
+
+    # injected behaviour
+
+    def _error(self, status: int, message: str, type_: str, headers: dict | None=None) -> web.Response:
+        self.stats[f'status_{status}'] += 1
+        return web.json_response({'error': {'message': message, 'type': type_, 'param': None, 'code': None}},
+                                 status=status, headers=headers)
+
+    def _inject(self, request: web.Request, tokens: int) -> web.Response | None:
+        key = request.headers.get('Authorization', '')
+        if self.rpm or self.tpm:
+            bucket = self.buckets.setdefault(key, Bucket(self.rpm, self.tpm))
+            if wait := bucket.take(tokens):
+                return self._error(429, 'Rate limit reached for requests', 'requests',
+                                   {'Retry-After': f'{wait:.2f}', 'x-ratelimit-limit-requests': str(self.rpm or 0)})
+        draw = self.rng.random()
+        if draw < self.error_429:
+            return self._error(429, 'That model is currently overloaded with other requests.', 'requests', {'Retry-After': '1'})
+        if draw < self.error_429 + self.error_5xx:
+            status = self.rng.choice((500, 502, 503))
+            return self._error(status, 'The server had an error while processing your request.', 'server_error')
+        return None
+
+    async def _wait(self, completion_tokens: int) -> None:
+        delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter) + self.per_token * completion_tokens)
+        self.latencies.append(delay)
+        await asyncio.sleep(delay)
+
+    async def _forward(self, request: web.Request, endpoint: str, body: dict) -> tuple[int, dict]:
+        headers = {name: request.headers[name] for name in ('Authorization', 'OpenAI-Organization') if name in request.headers}
+        async with self.session.post(f'{self.upstream}{endpoint}', json=body, headers=headers) as response:
+            return response.status, await response.json(content_type=None)
+
+    # endpoints
+
+    async def chat(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.stats['chat'] += 1
+        prompt = '\n'.join(message.get('content', '') for message in body.get('messages', []))
+        prompt_tokens = count_tokens(prompt)
+        key = Cassette.make_key('/v1/chat/completions', body)
+        if self.mode == 'record':
+            status, response = await self._forward(request, '/v1/chat/completions', body)
+            if status == 200:
+                self.cassette.put({'key': key, 'endpoint': '/v1/chat/completions', 'request': body, 'status': status, 'response': response})
+                self.stats['recorded'] += 1
+            self.stats['tokens'] += response.get('usage', dict()).get('total_tokens', 0)
+            return web.json_response(response, status=status)
+        if (error := self._inject(request, prompt_tokens + self.completion_tokens)) is not None:
+            return error
+        entry = self.cassette.get(key) if self.cassette else None
+        if entry:
+            self.stats['replayed'] += 1
+            response = entry['response']
+        else:
+            if self.mode == 'replay': self.stats['replay_misses'] += 1
+            content = self._synthetic_content(prompt, f'{request.scheme}://{request.host}')
+            completion_tokens = count_tokens(content)
+            response = {'id': f'chatcmpl-standin-{self.stats["chat"]}', 'object': 'chat.completion', 'created': int(time.time()),
+                        'model': body.get('model', 'gpt-3.5-turbo'),
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                                  'total_tokens': prompt_tokens + completion_tokens}}
+        await self._wait(response['usage']['completion_tokens'])
+        self.stats['tokens'] += response['usage']['total_tokens']
+        return web.json_response(response)
+
+    async def images_generations(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.stats['images'] += 1
+        n, size = int(body.get('n', 1)), str(body.get('size', '1024x1024'))
+        key = Cassette.make_key('/v1/images/generations', body)
+        base_url = f'{request.scheme}://{request.host}'
+        if self.mode == 'record':
+            status, response = await self._forward(request, '/v1/images/generations', body)
+            if status != 200:
+                return web.json_response(response, status=status)
+            # the real URLs expire, the images are kept with the cassette and served from here
+            files = []
+            self.cassette.files_dir.mkdir(parents=True, exist_ok=True)
+            for i, item in enumerate(response['data']):
+                async with self.session.get(item['url']) as image:
+                    (self.cassette.files_dir/f'{key}_{i}.png').write_bytes(await image.read())
+                files.append(f'{key}_{i}.png')
+            self.cassette.put({'key': key, 'endpoint': '/v1/images/generations', 'request': body, 'status': status,
+                               'response': response, 'files': files})
+            self.stats['recorded'] += 1
+            return web.json_response({**response, 'data': [{'url': f'{base_url}/cassette/{name}'} for name in files]})
+        if (error := self._inject(request, 0)) is not None:
+            return error
+        entry = self.cassette.get(key) if self.cassette else None
+        if entry:
+            self.stats['replayed'] += 1
+            data = [{'url': f'{base_url}/cassette/{name}'} for name in entry['files']]
+        else:
+            if self.mode == 'replay': self.stats['replay_misses'] += 1
+            side = int(size.split('x')[0])
+            data = [{'url': f'{base_url}/files/images/{self.rng.randrange(10 ** 6)}_{side}.jpg'} for _ in range(n)]
+        await self._wait(0)
+        return web.json_response({'created': int(time.time()), 'data': data})
+
+    async def image_file(self, request: web.Request) -> web.Response:
+        self.stats['image_downloads'] += 1
+        stem = request.match_info['name'].rsplit('.', 1)[0]
+        number, _, side = stem.partition('_')
+        return web.Response(body=self._synthetic_image(int(side or 512), int(number or 0) % 4), content_type='image/jpeg')
+
+    async def cassette_file(self, request: web.Request) -> web.Response:
+        self.stats['image_downloads'] += 1
+        path = self.cassette.files_dir/request.match_info['name'] if self.cassette else None
+        if not path or not path.is_file():
+            raise web.HTTPNotFound()
+        return web.FileResponse(path)
+
+    async def link(self, request: web.Request) -> web.Response:
+        self.stats['link_checks'] += 1
+        return web.Response(text='ok')
+
+    def report(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {**self.stats,
+                'latency_p50_s': round(latencies[len(latencies) // 2], 3) if latencies else 0.0,
+                'latency_p95_s': round(latencies[int(0.95 * (len(latencies) - 1))], 3) if latencies else 0.0}
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.report())
+
+    async def reset_stats(self, request: web.Request) -> web.Response:
+        self.stats.clear()
+        self.latencies.clear()
+        return web.json_response({'ok': True})
+
+
+def start_in_thread(standin: StandIn, host: str='127.0.0.1', port: int=0) -> str:
+    """
+    Serves the stand-in from a background thread with its own event loop.
+
+    Returns:
+        str: base URL of the server
+    """
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(standin.app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, host, port).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f'http://{host}:{runner.addresses[0][1]}'
+
+
+def client_env(base_url: str, keys: int=1, rpm: int=60, tpm: int=90000, use_cache: bool=False, record: bool=False) -> dict:
+    """
+    Environment that points a script at the stand-in: API base, a pool of `keys` dummy keys with
+    the given client-side limits (see `key_pool.load_keys`) and, by default, no response cache.
+    Record mode keeps the real keys of the environment.
+    """
+    env = {**os.environ, 'OPENAI_API_BASE': f'{base_url}/v1'}
+    if not record:
+        env['OPENAI_KEY_POOL'] = json.dumps([{'api_key': f'STANDIN_KEY_{i}', 'organization': 'STANDIN_ORG',
+                                              'rpm': rpm, 'tpm': tpm, 'images_rpm': rpm} for i in range(keys)])
+        env.update({f'STANDIN_KEY_{i}': f'sk-standin-{i}' for i in range(keys)})
+        env['STANDIN_ORG'] = 'org-standin'
+    if not use_cache:
+        env['GPT_CACHE_BYPASS'] = '1'
+    return env
+
+
+if __name__ == '__main__':
+    # the options go before the command, whatever follows the script belongs to the script
+    parser = argparse.ArgumentParser(description='Local OpenAI stand-in: serve it, or run a script against it and report the throughput',
+                                     usage='%(prog)s [options] serve | %(prog)s [options] run script.py [script args]')
+    parser.add_argument('command', choices=('serve', 'run'), help='serve: only the server; run: start it and run a script against it')
+    parser.add_argument('script', nargs='?', help='Script to run (run only), e.g. seo_accomodations.py')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments of the script')
+    parser.add_argument('--host', default='127.0.0.1', help='Host (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='Port, 0 for any free one (default: 8765)')
+    parser.add_argument('--mode', choices=MODES, default='synthetic', help='Answers: synthetic, replay or record (default: synthetic)')
+    parser.add_argument('--cassette', default=None, help='Cassette name for replay and record')
+    parser.add_argument('--latency', type=float, default=0.5, help='Response time in seconds (default: 0.5)')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Random +/- seconds (default: 0.2)')
+    parser.add_argument('--per-token', type=float, default=0.0, help='Seconds per completion token (default: 0)')
+    parser.add_argument('--error-429', type=float, default=0.0, help='Share of rate limit errors (default: 0)')
+    parser.add_argument('--error-5xx', type=float, default=0.0, help='Share of server errors (default: 0)')
+    parser.add_argument('--rpm', type=int, default=None, help='Server requests per minute per key (default: no limit)')
+    parser.add_argument('--tpm', type=int, default=None, help='Server tokens per minute per key (default: no limit)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed (optional)')
+    parser.add_argument('--keys', type=int, default=1, help='Dummy keys in the client pool (run only, default: 1)')
+    parser.add_argument('--client-rpm', type=int, default=60, help='Client-side requests per minute per key (run only, default: 60)')
+    parser.add_argument('--client-tpm', type=int, default=90000, help='Client-side tokens per minute per key (run only, default: 90000)')
+    parser.add_argument('--use-cache', action='store_true', help='Keep the response cache on (run only)')
+    args = parser.parse_args()
+
+    standin = StandIn(args.mode, args.cassette, args.latency, args.jitter, args.per_token, args.error_429, args.error_5xx,
+                      args.rpm, args.tpm, seed=args.seed)
+    if args.command == 'serve':
+        print(f'OpenAI stand-in on http://{args.host}:{args.port}, use OPENAI_API_BASE=http://{args.host}:{args.port}/v1')
+        web.run_app(standin.app(), host=args.host, port=args.port, print=None)
+    else:
+        if not args.script:
+            parser.error('run needs a script')
+        base_url = start_in_thread(standin, args.host, args.port)
+        env = client_env(base_url, args.keys, args.client_rpm, args.client_tpm, args.use_cache, args.mode == 'record')
+        start = time.perf_counter()
+        script = Path(args.script).resolve()
+        result = subprocess.run([sys.executable, str(script), *args.args], env=env, cwd=script.parent)
+        elapsed = time.perf_counter() - start
+        report = standin.report()
+        print(f'{args.script} finished with code {result.returncode} in {elapsed:.1f} s')
+        print(f'{report.get("chat", 0) / elapsed:.2f} chat requests/s, {report.get("tokens", 0) / elapsed:.0f} tokens/s')
+        print(json.dumps(report, indent=4))
+        sys.exit(result.returncode)
@@ -0,0 +1,315 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Callable
+
+from config import (PROMPTS_DIR, OPTION_LISTS_DIR, SEO_TEXTS_DIR, IMG_DIR, SMM_CITY_ATTRACTIONS_FP_DIR, POSTS_DIR,
+                    CHILDREN_ATTRACTIONS_LIST_DIR)
+from data_provider import get_provider, to_slug
+from journal import Journal
+from ledger import set_context, submit
+from profiling import span
+
+
+STATE_PATH = Path(__file__).resolve().parent.parent/'files'/'pipeline'/'state.json'
+
+
+class Stage:
+    def __init__(self,
+                 name: str,
+                 run: Callable,
+                 inputs: Callable,
+                 outputs: Callable,
+                 prompts: tuple=(),
+                 depends_on: tuple=(),
+                 journal: str | None=None,
+                 per_city: bool=True,
+                 options: Callable | None=None) -> None:
+        """
+        One step of the pipeline. A per-city stage is run with the list of (city, country) tuples
+        that are out of date, a whole-tree stage (per_city=False) is run without arguments.
+
+        Args:
+            name (str): stage name
+            run (Callable): runs the stage, run(cities) or run()
+            inputs (Callable): files the stage reads, inputs(city, country) or inputs()
+            outputs (Callable): files the stage writes, same signature as inputs
+            prompts (tuple, optional): prompt files the stage uses. Defaults to ().
+            depends_on (tuple, optional): names of upstream stages. Defaults to ().
+            journal (str | None, optional): journal category reset for the cities or options whose inputs changed. Defaults to None.
+            per_city (bool, optional): whether the stage is fingerprinted per city. Defaults to True.
+            options (Callable | None, optional): options of a city, options(city, country) -> {key: option}. With it
+                every option is fingerprinted by its own entry and only the changed ones are reset. Defaults to None.
+        """
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.prompts = prompts
+        self.depends_on = depends_on
+        self.journal = journal
+        self.per_city = per_city
+        self.options = options
+
+
+def hash_files(paths: list, extra: str='') -> str:
+    """
+    Content hash of a list of files, missing files are hashed by their name only.
+    """
+    digest = hashlib.sha256(extra.encode())
+    for path in sorted(Path(p) for p in paths):
+        digest.update(str(path).encode())
+        if path.is_file():
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, stages: list[Stage], state_path: Path | str=STATE_PATH) -> None:
+        """
+        Runs stages in dependency order and rebuilds only the cities (or the options of a city)
+        whose inputs or prompts changed since the last successful run. Stages that don't depend on each other run in parallel.
+
+        Args:
+            stages (list[Stage]): pipeline stages
+            state_path (Path | str, optional): file with the fingerprints of the last run. Defaults to STATE_PATH.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            for dep in stage.depends_on:
+                if dep not in self.stages:
+                    raise ValueError(f'Stage {stage.name} depends on unknown stage {dep}')
+        self._check_cycles()
+        self.state_path = Path(state_path)
+        self.state = json.loads(self.state_path.read_text()) if self.state_path.exists() else dict()
+        self.lock = threading.Lock()
+
+    def _check_cycles(self) -> None:
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done: return
+            if name in visiting: raise ValueError(f'Dependency cycle at stage {name}')
+            visiting.add(name)
+            for dep in self.stages[name].depends_on: visit(dep)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages: visit(name)
+
+    def _save_state(self) -> None:
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.state, indent=4))
+        os.replace(tmp_path, self.state_path)
+
+    def fingerprint(self, stage: Stage, *city) -> str:
+        prompts = hash_files([Path(f'{PROMPTS_DIR}/{prompt}') for prompt in stage.prompts])
+        return hash_files(stage.inputs(*city), extra=f'{stage.name}:{prompts}:{city}')
+
+    def option_fingerprints(self, stage: Stage, city: str, country: str) -> dict:
+        """
+        Returns the fingerprint of every option of a city: the prompts and the option's own entry.
+        """
+        prompts = hash_files([Path(f'{PROMPTS_DIR}/{prompt}') for prompt in stage.prompts])
+        return {str(key): hashlib.sha256(json.dumps([stage.name, prompts, city, str(key), option],
+                                                    sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+                for key, option in stage.options(city, country).items()}
+
+    def changed_options(self, stage: Stage, city: str, country: str) -> list:
+        """
+        Returns the options of a city that are new, changed or no longer in its option list.
+        """
+        recorded = self.state.get(stage.name, dict()).get(city)
+        # a city recorded before options were fingerprinted has no per-option state
+        recorded = recorded if isinstance(recorded, dict) else dict()
+        current = self.option_fingerprints(stage, city, country)
+        return [key for key in current if recorded.get(key) != current[key]] + [key for key in recorded if key not in current]
+
+    def stale(self, stage: Stage, cities: list) -> list:
+        """
+        Returns the cities whose fingerprint (or the fingerprint of one of their options) changed
+        or whose outputs are missing. For a whole-tree stage returns [()] if it is out of date, otherwise [].
+        """
+        recorded = self.state.get(stage.name, dict())
+        items = cities if stage.per_city else [()]
+        if stage.options:
+            return [item for item in items
+                    if self.changed_options(stage, *item) or not all(Path(path).exists() for path in stage.outputs(*item))]
+        return [item for item in items
+                if recorded.get(item[0] if item else '*') != self.fingerprint(stage, *item)
+                or not all(Path(path).exists() for path in stage.outputs(*item))]
+
+    def run_stage(self, stage: Stage, cities: list, dry_run: bool=False) -> list:
+        todo = self.stale(stage, cities)
+        print(f'Stage {stage.name}: {len(todo)} to rebuild')
+        if dry_run or not todo:
+            return todo
+        # every stage runs in its own copy of the context (see `Pipeline.run`), so this tags only its API calls
+        set_context(stage=stage.name)
+        if stage.journal:
+            journal = Journal(stage.journal)
+            recorded = self.state.get(stage.name, dict())
+            # changed inputs invalidate the results of earlier runs, of the changed options only if they are fingerprinted
+            for city, country in [item for item in todo if item and item[0] in recorded]:
+                if stage.options and isinstance(recorded[city], dict):
+                    journal.reset(city, [key for key in self.changed_options(stage, city, country) if key in recorded[city]])
+                else:
+                    journal.reset(city)
+        with span(f'stage.{stage.name}'):
+            if stage.per_city:
+                stage.run(todo)
+            else:
+                stage.run()
+        # the stage wrote its results from its own journal instance
+        journal = Journal(stage.journal) if stage.journal else None
+        with self.lock:
+            recorded = self.state.setdefault(stage.name, dict())
+            for item in todo:
+                if stage.options:
+                    # an option is recorded once it is done, failed ones are retried on the next run
+                    recorded[item[0]] = {key: fingerprint for key, fingerprint in self.option_fingerprints(stage, *item).items()
+                                         if journal is None or journal.is_done(item[0], key)}
+                # a city is recorded only when the stage produced all of its outputs
+                elif all(Path(path).exists() for path in stage.outputs(*item)):
+                    recorded[item[0] if item else '*'] = self.fingerprint(stage, *item)
+            self._save_state()
+        return todo
+
+    def run(self, cities: list, only: list | None=None, workers: int=4, dry_run: bool=False) -> None:
+        """
+        Runs the selected stages (all by default) with their upstream stages.
+
+        Args:
+            cities (list): (city, country) tuples
+            only (list | None, optional): names of the stages to run. Defaults to None.
+            workers (int, optional): stages run at the same time. Defaults to 4.
+            dry_run (bool, optional): only report what would be rebuilt. Defaults to False.
+        """
+        selected = set()
+        for name in only or self.stages:
+            stack = [name]
+            while stack:
+                current = stack.pop()
+                if current not in selected:
+                    selected.add(current)
+                    stack.extend(self.stages[current].depends_on)
+        finished, running = set(), dict()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while len(finished) < len(selected):
+                for name in selected - finished - set(running.values()):
+                    if all(dep in finished for dep in self.stages[name].depends_on):
+                        running[submit(executor, self.run_stage, self.stages[name], cities, dry_run)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    future.result()
+                    finished.add(name)
+
+
+def city_attractions_images(city: str) -> list:
+    """
+    Numbered images of a city, the ones compose_posts turns into posts.
+    """
+    return sorted(Path(f'{IMG_DIR}/city_attractions/{to_slug(city)}').glob('[0-9]*_*.jpg'))
+
+
+def city_attractions_posts_files(city: str) -> list:
+    """
+    Post files of a city, <city id * 100 + image number>.json as written by compose_posts.
+    """
+    city_id = get_provider().get_city_id(city)
+    numbers = dict.fromkeys(image.name.split('_')[0] for image in city_attractions_images(city))
+    return [Path(f'{POSTS_DIR}/city_attractions/en/{city_id * 100 + int(number)}.json') for number in numbers if number.isdigit()]
+
+
+def load_options(path: Path | str) -> dict:
+    """
+    Option list of a city, {} if it wasn't generated yet.
+    """
+    path = Path(path)
+    return json.loads(path.read_text()) if path.exists() else dict()
+
+
+def children_attractions_image_files(city: str) -> list:
+    """
+    Image files of a city, one per attraction as written by generate_images.
+    """
+    from generate_images import image_path
+    attractions = load_options(f'{CHILDREN_ATTRACTIONS_LIST_DIR}/{to_slug(city)}.json')
+    return [image_path(city, number, attraction) for number, attraction in attractions.items()]
+
+
+def build_default_pipeline() -> Pipeline:
+    """
+    Cheap eats: option lists -> texts and images -> compressed images,
+    children attractions: attraction lists -> generated and downloaded images,
+    city attractions: SMM texts and images -> posts.
+    """
+    def cheap_eats_options(cities):
+        import cheap_eats_option
+        cheap_eats_option.get_cheap_eats_options(cities=cities)
+
+    def cheap_eats_content(cities):
+        import cheap_eats_option
+        cheap_eats_option.gen_content(cities=cities)
+
+    def children_attractions_images(cities):
+        import generate_images
+        generate_images.generate_image(cities=[city for city, _ in cities])
+
+    def cheap_eats_compress():
+        from compress_images import compress_jpeg_images
+        compress_jpeg_images(f'{IMG_DIR}/cheap_eats')
+
+    def city_attractions_posts(cities):
+        import compose_posts
+        compose_posts.main(cities)
+
+    return Pipeline([
+        Stage('cheap_eats_options', cheap_eats_options,
+              inputs=lambda city, country: [],
+              outputs=lambda city, country: [Path(f'{OPTION_LISTS_DIR}/cheap_eats/{to_slug(city)}.json')],
+              prompts=('cheap_eats.json',),
+              journal='cheap_eats_options'),
+        Stage('cheap_eats_content', cheap_eats_content,
+              inputs=lambda city, country: [Path(f'{OPTION_LISTS_DIR}/cheap_eats/{to_slug(city)}.json')],
+              outputs=lambda city, country: [Path(f'{SEO_TEXTS_DIR}/cheap_eats/{to_slug(city)}.json')],
+              prompts=('cheap_eats.json',),
+              depends_on=('cheap_eats_options',),
+              journal='cheap_eats',
+              options=lambda city, country: load_options(f'{OPTION_LISTS_DIR}/cheap_eats/{to_slug(city)}.json')),
+        Stage('cheap_eats_compress', cheap_eats_compress,
+              inputs=lambda: list(Path(f'{IMG_DIR}/cheap_eats').rglob('*.jpg')),
+              outputs=lambda: [Path(f'{IMG_DIR}/cheap_eats_compressed')],
+              depends_on=('cheap_eats_content',),
+              per_city=False),
+        Stage('children_attractions_images', children_attractions_images,
+              inputs=lambda city, country: [Path(f'{CHILDREN_ATTRACTIONS_LIST_DIR}/{to_slug(city)}.json')],
+              outputs=lambda city, country: children_attractions_image_files(city),
+              prompts=('children_attractions_images_pmt.json',),
+              journal='children_attractions_images',
+              options=lambda city, country: load_options(f'{CHILDREN_ATTRACTIONS_LIST_DIR}/{to_slug(city)}.json')),
+        Stage('city_attractions_posts', city_attractions_posts,
+              inputs=lambda city, country: [Path(f'{SMM_CITY_ATTRACTIONS_FP_DIR}/{to_slug(city)}.json'),
+                                            *city_attractions_images(city)],
+              outputs=lambda city, country: city_attractions_posts_files(city)),
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild out-of-date pipeline artifacts')
+    parser.add_argument('--stages', nargs='*', help='Stages to run with their upstream stages (default: all)')
+    parser.add_argument('--cities', nargs='*', help='Cities to process (default: all)')
+    parser.add_argument('--workers', type=int, default=4, help='Stages run at the same time (default: 4)')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be rebuilt')
+    args = parser.parse_args()
+
+    cities = list(get_provider().gen_data(cities=args.cities))
+    build_default_pipeline().run(cities, args.stages, args.workers, args.dry_run)
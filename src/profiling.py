@@ -0,0 +1,190 @@
+import argparse
+import atexit
+import contextlib
+import cProfile
+import functools
+import io
+import pstats
+import runpy
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+
+PROFILES_DIR = Path(__file__).resolve().parent.parent/'files'/'profiles'
+# durations kept per span for the percentiles, count, total and max stay exact beyond it
+MAX_SAMPLES = 100_000
+TOP = 30
+
+
+class Timers:
+    def __init__(self) -> None:
+        """
+        Durations of named spans (limiter wait, request, parse, validate, download, resize, write ...)
+        collected from all threads and asyncio tasks of the process.
+        """
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.totals = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def add(self, name: str, seconds: float) -> None:
+        with self.lock:
+            total = self.totals[name]
+            total[0] += 1
+            total[1] += seconds
+            total[2] = max(total[2], seconds)
+            if len(self.samples[name]) < MAX_SAMPLES:
+                self.samples[name].append(seconds)
+
+    def report(self) -> dict:
+        """
+        Returns:
+            dict: span name -> count, total_s, p50_ms, p95_ms, max_ms, sorted by total time
+        """
+        with self.lock:
+            items = [(name, sorted(self.samples[name]), *self.totals[name]) for name in self.totals]
+        report = dict()
+        for name, samples, count, total, max_ in sorted(items, key=lambda item: -item[3]):
+            report[name] = {'count': count,
+                            'total_s': round(total, 3),
+                            'p50_ms': round(samples[len(samples) // 2] * 1000, 2),
+                            'p95_ms': round(samples[int(0.95 * (len(samples) - 1))] * 1000, 2),
+                            'max_ms': round(max_ * 1000, 2)}
+        return report
+
+    def format_report(self) -> str:
+        columns = ('count', 'total_s', 'p50_ms', 'p95_ms', 'max_ms')
+        lines = [f'{"span":<24}' + ''.join(f'{column:>12}' for column in columns)]
+        for name, row in self.report().items():
+            lines.append(f'{name:<24}' + ''.join(f'{row[column]:>12}' for column in columns))
+        return '\n'.join(lines)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.samples.clear()
+            self.totals.clear()
+
+
+_timers = Timers()
+
+
+def get_timers() -> Timers:
+    return _timers
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """
+    Times the with block under `name`, e.g. `with span('parse'): ...`. Works in threads and
+    coroutines alike; in a coroutine the time spent awaiting inside the block is included.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timers.add(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """
+    Decorator version of `span`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profile_call(func, *args, out_path: Path | str | None=None, top: int=TOP, **kwargs):
+    """
+    Runs a function under cProfile, writes the stats to a .pstats file (open it with
+    `python -m pstats` or snakeviz) and prints the top functions by own and cumulative time.
+
+    Args:
+        func (Callable): entry point
+        out_path (Path | str | None, optional): stats file. Defaults to PROFILES_DIR/<func>-<time>.pstats.
+        top (int, optional): functions in the printed summary. Defaults to TOP.
+
+    Returns:
+        the function's result
+    """
+    out_path = Path(out_path or PROFILES_DIR/f'{func.__name__}-{datetime.now():%Y%m%d%H%M%S}.pstats')
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(out_path)
+        summary = io.StringIO()
+        stats = pstats.Stats(profiler, stream=summary).strip_dirs()
+        stats.sort_stats('tottime').print_stats(top)
+        stats.sort_stats('cumulative').print_stats(top)
+        print(summary.getvalue())
+        print(f'Profile saved to {out_path}')
+
+
+def print_report() -> None:
+    if _timers.totals:
+        print(_timers.format_report())
+
+
+_report_registered = False
+
+
+def report_at_exit() -> None:
+    """
+    Prints the span timers once when the process exits.
+    """
+    global _report_registered
+    if not _report_registered:
+        _report_registered = True
+        atexit.register(print_report)
+
+
+def elapsed_time(func):
+    """
+    Times an entry point as the span 'run.<function>', prints its elapsed time and
+    the span timers of the whole run at exit.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        report_at_exit()
+        start_time = time.perf_counter()
+        try:
+            with span(f'run.{func.__name__}'):
+                return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            hours, rest = divmod(int(elapsed), 3600)
+            print(f'Elapsed time for {func.__name__}: {hours} hours, {rest // 60} minutes, {rest % 60} seconds')
+    return wrapper
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a script and print its span timers, with --profile under cProfile too',
+                                     usage='%(prog)s [--profile] [--top N] [--out FILE] script.py [script args]')
+    parser.add_argument('--profile', action='store_true', help='Run under cProfile, write a .pstats file and print the top functions')
+    parser.add_argument('--top', type=int, default=TOP, help=f'Functions in the cProfile summary (default: {TOP})')
+    parser.add_argument('--out', default=None, help='Stats file (default: files/profiles/<script>-<time>.pstats)')
+    parser.add_argument('script', help='Script to run, e.g. seo_accomodations.py')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments of the script')
+    args = parser.parse_args()
+
+    # the script sees its own arguments and imports its neighbours as if started directly
+    sys.argv = [args.script, *args.args]
+    sys.path.insert(0, str(Path(args.script).resolve().parent))
+    # the scripts time their spans in the imported `profiling` module, not in this __main__ copy
+    import profiling as _p
+    _p.report_at_exit()
+    run = functools.partial(runpy.run_path, args.script, run_name='__main__')
+    if args.profile:
+        run.__name__ = Path(args.script).stem
+        _p.profile_call(run, out_path=args.out, top=args.top)
+    else:
+        run()
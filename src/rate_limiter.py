@@ -0,0 +1,163 @@
+import asyncio
+import contextlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+DEFAULT_DB = Path(__file__).resolve().parent.parent/'files'/'cache'/'rate_limits.sqlite'
+DEFAULT_RPM = 3
+DEFAULT_TPM = 40000
+
+
+def estimate_tokens(text: str, completion_tokens: int=500) -> int:
+    """
+    Rough token count of a prompt (about 4 characters per token) plus the expected completion size.
+    It is only used to reserve budget before a request, the real usage is settled afterwards.
+
+    Args:
+        text (str): prompt text
+        completion_tokens (int, optional): expected completion size. Defaults to 500.
+
+    Returns:
+        int: estimated total tokens
+    """
+    return len(text) // 4 + completion_tokens
+
+
+class RateLimiter:
+    def __init__(self, key: str, rpm: int=DEFAULT_RPM, tpm: int | None=DEFAULT_TPM, path: Path | str=DEFAULT_DB) -> None:
+        """
+        Token bucket limiter with requests-per-minute and tokens-per-minute budgets for one API key.
+        The bucket state lives in a SQLite file, so all threads, asyncio tasks and processes using
+        the same key and file share one budget.
+
+        Args:
+            key (str): bucket name, usually the API key env variable name
+            rpm (int, optional): requests per minute. Defaults to DEFAULT_RPM.
+            tpm (int | None, optional): tokens per minute, None disables token accounting. Defaults to DEFAULT_TPM.
+            path (Path | str, optional): SQLite file with the buckets. Defaults to DEFAULT_DB.
+        """
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets '
+                         '(key TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL)')
+
+    def _connect(self) -> sqlite3.Connection:
+        # a connection per call keeps the limiter usable from any thread
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _try_acquire(self, tokens: int) -> float:
+        """
+        Takes one request and `tokens` tokens from the bucket if both are available.
+
+        Returns:
+            float: 0 if acquired, otherwise seconds to wait before the next attempt
+        """
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock, so refill and debit are atomic across processes
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = conn.execute('SELECT requests, tokens, updated FROM buckets WHERE key = ?', (self.key,)).fetchone()
+            if row is None:
+                requests_left, tokens_left = float(self.rpm), float(self.tpm or 0)
+            else:
+                elapsed = now - row[2]
+                requests_left = min(self.rpm, row[0] + elapsed * self.rpm / 60)
+                tokens_left = min(self.tpm, row[1] + elapsed * self.tpm / 60) if self.tpm else 0
+            wait = 0.0
+            if requests_left < 1:
+                wait = (1 - requests_left) * 60 / self.rpm
+            if self.tpm and tokens_left < tokens:
+                wait = max(wait, (tokens - tokens_left) * 60 / self.tpm)
+            if not wait:
+                requests_left -= 1
+                tokens_left -= tokens
+            conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)',
+                         (self.key, requests_left, tokens_left, now))
+            conn.execute('COMMIT')
+            return wait
+        finally:
+            conn.close()
+
+    def remaining(self) -> tuple[float, float]:
+        """
+        Current budget without taking from it, as fractions of the per-minute limits.
+
+        Returns:
+            tuple[float, float]: (requests, tokens) left, tokens is 1.0 without token accounting
+        """
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute('SELECT requests, tokens, updated FROM buckets WHERE key = ?', (self.key,)).fetchone()
+        if row is None:
+            return 1.0, 1.0
+        elapsed = time.time() - row[2]
+        requests_left = min(self.rpm, row[0] + elapsed * self.rpm / 60) / self.rpm
+        tokens_left = min(self.tpm, row[1] + elapsed * self.tpm / 60) / self.tpm if self.tpm else 1.0
+        return requests_left, tokens_left
+
+    def acquire(self, tokens: int=0) -> float:
+        """
+        Blocks until a request with `tokens` tokens fits into the budget.
+
+        Args:
+            tokens (int, optional): estimated tokens of the request. Defaults to 0.
+
+        Returns:
+            float: total seconds spent waiting
+        """
+        waited = 0.0
+        while delay := self._try_acquire(tokens):
+            time.sleep(delay)
+            waited += delay
+        return waited
+
+    async def acquire_async(self, tokens: int=0) -> float:
+        """
+        Asyncio version of `acquire`, waits without blocking the event loop.
+        """
+        waited = 0.0
+        while delay := await asyncio.to_thread(self._try_acquire, tokens):
+            await asyncio.sleep(delay)
+            waited += delay
+        return waited
+
+    def settle(self, reserved: int, used: int) -> None:
+        """
+        Corrects the token budget once the real usage of a request is known, or gives the
+        reservation back (used=0) when the request was rejected. The balance may go negative,
+        then the next requests wait for the overdraft to refill.
+
+        Args:
+            reserved (int): tokens asked from `acquire`, clamped to the tpm like there
+            used (int): tokens reported in the response usage
+        """
+        if not self.tpm:
+            return
+        reserved = min(reserved, self.tpm)
+        if used == reserved:
+            return
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('UPDATE buckets SET tokens = MIN(?, tokens + ?) WHERE key = ?',
+                         (self.tpm, reserved - used, self.key))
+
+
+_limiters = dict()
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(key: str, rpm: int=DEFAULT_RPM, tpm: int | None=DEFAULT_TPM, path: Path | str=DEFAULT_DB) -> RateLimiter:
+    """
+    Returns the process-wide limiter for a bucket, creating it on first use.
+    """
+    with _limiters_lock:
+        if (key, path) not in _limiters:
+            _limiters[(key, path)] = RateLimiter(key, rpm, tpm, path)
+        return _limiters[(key, path)]
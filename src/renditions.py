@@ -0,0 +1,116 @@
+import argparse
+import os
+from pathlib import Path
+from PIL import Image
+
+from profiling import span
+
+
+# rendition name -> longest side in pixels
+RENDITIONS = {'thumb': 256, 'medium': 512, 'full': 1024}
+FORMATS = ('jpeg', 'webp')
+EXTENSIONS = {'jpeg': '.jpg', 'webp': '.webp'}
+
+
+def rendition_path(out_dir: Path | str, name: str, stem: str, format_: str) -> Path:
+    """
+    Renditions go to a subfolder per rendition, e.g. <city>/thumb/1_Louvre.webp, so the
+    '[0-9]*.jpg' globs over the city folders keep seeing only the source images.
+    """
+    return Path(out_dir)/name/f'{stem}{EXTENSIONS[format_]}'
+
+
+def fit(size: tuple, longest: int) -> tuple:
+    """
+    Scales a size down so that its longest side is at most `longest`, never up.
+    """
+    scale = min(1.0, longest / max(size))
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def render(image: Image.Image,
+           out_dir: Path | str,
+           stem: str,
+           renditions: dict=RENDITIONS,
+           formats: tuple=FORMATS,
+           quality: int=80) -> list:
+    """
+    Writes all renditions of an already decoded image: every size in every format.
+    Sizes are produced from the largest to the smallest, each one from the previous, and
+    metadata (EXIF, ICC, comments) is not copied to the outputs.
+
+    Args:
+        image (Image.Image): decoded source image
+        out_dir (Path | str): folder for the rendition subfolders
+        stem (str): output file name without extension
+        renditions (dict, optional): rendition name -> longest side. Defaults to RENDITIONS.
+        formats (tuple, optional): 'jpeg' and/or 'webp'. Defaults to FORMATS.
+        quality (int, optional): encoder quality. Defaults to 80.
+
+    Returns:
+        list: written files
+    """
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    written = []
+    current = image
+    for name, longest in sorted(renditions.items(), key=lambda item: -item[1]):
+        size = fit(current.size, longest)
+        if size != current.size:
+            current = current.resize(size, Image.LANCZOS)
+        for format_ in formats:
+            path = rendition_path(out_dir, name, stem, format_)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f'.{path.name}.part')
+            if format_ == 'jpeg':
+                current.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+            else:
+                current.save(tmp_path, 'WEBP', quality=quality, method=4)
+            os.replace(tmp_path, path)
+            written.append(path)
+    return written
+
+
+def write_renditions(source: Path | str,
+                     out_dir: Path | str | None=None,
+                     renditions: dict=RENDITIONS,
+                     formats: tuple=FORMATS,
+                     quality: int=80) -> list:
+    """
+    Decodes a source image once and writes all its renditions. JPEG sources are decoded in
+    draft mode at the smallest scale that still covers the largest rendition.
+
+    Args:
+        source (Path | str): source image
+        out_dir (Path | str | None, optional): folder for the rendition subfolders. Defaults to the source folder.
+        renditions (dict, optional): rendition name -> longest side. Defaults to RENDITIONS.
+        formats (tuple, optional): 'jpeg' and/or 'webp'. Defaults to FORMATS.
+        quality (int, optional): encoder quality. Defaults to 80.
+
+    Returns:
+        list: written files
+    """
+    source = Path(source)
+    with span('resize'), Image.open(source) as image:
+        longest = max(renditions.values())
+        if image.format == 'JPEG':
+            image.draft('RGB', fit(image.size, longest))
+        image.load()
+        return render(image, out_dir or source.parent, source.stem, renditions, formats, quality)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write thumbnail, medium and full renditions of the images in a folder')
+    parser.add_argument('source_path', type=str, help='Folder with the source images, e.g. IMG_DIR/city_attractions')
+    parser.add_argument('--quality', type=int, default=80, help='Encoder quality (default: 80)')
+    parser.add_argument('--formats', nargs='*', default=list(FORMATS), choices=list(FORMATS), help='Output formats (default: jpeg webp)')
+    args = parser.parse_args()
+
+    for file_path in Path(args.source_path).rglob('*.jpg'):
+        # skip the renditions written by an earlier run
+        if file_path.parent.name in RENDITIONS:
+            continue
+        try:
+            write_renditions(file_path, quality=args.quality, formats=tuple(args.formats))
+        except (IOError, OSError) as err:
+            print(f'Error processing file: {file_path}. Skipping... ({err})')
@@ -0,0 +1,200 @@
+import asyncio
+import atexit
+import email.utils
+import random
+import threading
+import time
+from collections import Counter
+from typing import Callable
+
+
+# statuses worth another attempt, other 4xx are fatal
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+# rejected keys, retrying them only burns the deadline
+FATAL_STATUS = {401, 403}
+# exception classes (by name, so that the clients don't have to be imported here) worth another attempt
+RETRYABLE_ERRORS = {'Timeout', 'TryAgain', 'RateLimitError', 'APIError', 'APIConnectionError', 'ServiceUnavailableError',
+                    'ConnectTimeout', 'ReadTimeout', 'ChunkedEncodingError', 'ClientConnectionError',
+                    'ServerDisconnectedError', 'ClientPayloadError', 'TimeoutError', 'ConnectionError'}
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status: int, headers: dict | None=None) -> None:
+        """
+        A response status that should be retried, for clients that return statuses instead of raising.
+        """
+        super().__init__(f'HTTP status {status}')
+        self.status = status
+        self.headers = headers or dict()
+
+
+class RetryPolicy:
+    def __init__(self,
+                 attempts: int=5,
+                 base_delay: float=1.0,
+                 max_delay: float=60.0,
+                 timeout: float=60.0,
+                 deadline: float=300.0) -> None:
+        """
+        Exponential backoff with full jitter, honouring Retry-After.
+
+        Args:
+            attempts (int, optional): max attempts including the first one. Defaults to 5.
+            base_delay (float, optional): delay before the first retry in seconds. Defaults to 1.0.
+            max_delay (float, optional): max delay between attempts in seconds. Defaults to 60.0.
+            timeout (float, optional): timeout of one attempt in seconds. Defaults to 60.0.
+            deadline (float, optional): max total time of a call with its retries in seconds. Defaults to 300.0.
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.deadline = deadline
+
+    def delay(self, attempt: int, retry_after: float | None=None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+POLICIES = {
+    'openai': RetryPolicy(attempts=6, base_delay=2.0, timeout=90.0, deadline=600.0),
+    'download': RetryPolicy(attempts=4, base_delay=1.0, timeout=60.0, deadline=300.0),
+    'link': RetryPolicy(attempts=2, base_delay=1.0, max_delay=10.0, timeout=10.0, deadline=30.0),
+}
+
+
+class RetryStats:
+    def __init__(self) -> None:
+        """
+        Thread-safe counters of retries and of the time spent waiting for them, by call name.
+        """
+        self.lock = threading.Lock()
+        self.retries = Counter()
+        self.reasons = Counter()
+        self.gave_up = Counter()
+        self.waited = Counter()
+
+    def retry(self, name: str, reason: str, delay: float) -> None:
+        with self.lock:
+            self.retries[name] += 1
+            self.reasons[(name, reason)] += 1
+            self.waited[name] += delay
+
+    def give_up(self, name: str) -> None:
+        with self.lock:
+            self.gave_up[name] += 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {name: {'retries': self.retries[name],
+                           'gave_up': self.gave_up[name],
+                           'waited_s': round(self.waited[name], 1),
+                           'reasons': {reason: count for (name_, reason), count in self.reasons.items() if name_ == name}}
+                    for name in set(self.retries) | set(self.gave_up)}
+
+
+_stats = RetryStats()
+
+
+def get_retry_stats() -> RetryStats:
+    return _stats
+
+
+@atexit.register
+def _print_summary() -> None:
+    summary = _stats.summary()
+    if summary:
+        print('Retries:', summary)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Retry-After is either seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def is_fatal(err: BaseException) -> bool:
+    """
+    Tells whether an error means the key itself can't be used: an exhausted quota (which comes
+    as a 429 too, but no backoff fixes it) or a rejected key.
+    """
+    error = getattr(err, 'error', None)
+    status = getattr(err, 'http_status', None) or getattr(err, 'status', None)
+    return ('insufficient_quota' in (getattr(err, 'code', None), error.get('type') if isinstance(error, dict) else None)
+            or status in FATAL_STATUS)
+
+
+def classify(err: BaseException) -> tuple[bool, float | None]:
+    """
+    Tells whether an error of the openai, requests or aiohttp clients is transient.
+
+    Returns:
+        tuple[bool, float | None]: whether to retry and the server's Retry-After in seconds
+    """
+    response = getattr(err, 'response', None)
+    status = (getattr(err, 'http_status', None) or getattr(err, 'status', None)
+              or getattr(response, 'status_code', None))
+    headers = getattr(err, 'headers', None) or getattr(response, 'headers', None) or dict()
+    retry_after = parse_retry_after(headers.get('Retry-After') if hasattr(headers, 'get') else None)
+    if is_fatal(err):
+        return False, retry_after
+    if isinstance(status, int) and status >= 400:
+        return status in RETRYABLE_STATUS, retry_after
+    names = {cls.__name__ for cls in type(err).__mro__}
+    return bool(names & RETRYABLE_ERRORS) or isinstance(err, asyncio.TimeoutError), retry_after
+
+
+def _reason(err: BaseException) -> str:
+    status = getattr(err, 'http_status', None) or getattr(err, 'status', None) or getattr(getattr(err, 'response', None), 'status_code', None)
+    return str(status) if status else type(err).__name__
+
+
+def call_with_retry(func: Callable, *args, policy: RetryPolicy=POLICIES['openai'], name: str | None=None, **kwargs):
+    """
+    Calls func(*args, **kwargs), retrying transient errors with backoff until the policy's
+    attempts or deadline run out. Fatal errors and the last transient one are raised.
+    The per-attempt timeout has to be passed to the client by the caller (policy.timeout).
+    """
+    name = name or getattr(func, '__qualname__', 'call')
+    start = time.monotonic()
+    for attempt in range(policy.attempts):
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            retryable, retry_after = classify(err)
+            delay = policy.delay(attempt, retry_after)
+            if not retryable or attempt == policy.attempts - 1 or time.monotonic() - start + delay > policy.deadline:
+                if retryable: _stats.give_up(name)
+                raise
+            _stats.retry(name, _reason(err), delay)
+            time.sleep(delay)
+
+
+async def call_with_retry_async(func: Callable, *args, policy: RetryPolicy=POLICIES['openai'], name: str | None=None, **kwargs):
+    """
+    Asynchronous version of `call_with_retry`. Cut the request itself with
+    asyncio.wait_for(..., policy.timeout), not the waits for the rate limiter.
+    """
+    name = name or getattr(func, '__qualname__', 'call')
+    start = time.monotonic()
+    for attempt in range(policy.attempts):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as err:
+            retryable, retry_after = classify(err)
+            delay = policy.delay(attempt, retry_after)
+            if not retryable or attempt == policy.attempts - 1 or time.monotonic() - start + delay > policy.deadline:
+                if retryable: _stats.give_up(name)
+                raise
+            _stats.retry(name, _reason(err), delay)
+            await asyncio.sleep(delay)
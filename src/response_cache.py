@@ -0,0 +1,110 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+DEFAULT_DB = Path(__file__).resolve().parent.parent/'files'/'cache'/'responses.sqlite'
+DEFAULT_MAX_ENTRIES = 200_000
+# DALL-E image urls expire after an hour, so cached urls are not served for longer
+IMAGE_URLS_MAX_AGE = 3600
+EVICT_EVERY = 1000
+
+
+def cache_disabled() -> bool:
+    """
+    Global bypass switch: set GPT_CACHE_BYPASS=1 to send every request to the API.
+    """
+    return os.getenv('GPT_CACHE_BYPASS', '') not in ('', '0')
+
+
+class ResponseCache:
+    def __init__(self, path: Path | str=DEFAULT_DB, max_entries: int=DEFAULT_MAX_ENTRIES, max_age: float | None=None) -> None:
+        """
+        Content-addressed on-disk cache of API responses. Entries are keyed on a hash of the request
+        parameters (model, prompt, temperature, size...) and evicted by age and by total count.
+
+        Args:
+            path (Path | str, optional): SQLite file. Defaults to DEFAULT_DB.
+            max_entries (int, optional): entries kept after eviction. Defaults to DEFAULT_MAX_ENTRIES.
+            max_age (float | None, optional): seconds an entry lives, None means forever. Defaults to None.
+        """
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS responses '
+                         '(key TEXT PRIMARY KEY, value TEXT, created REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_created ON responses (created)')
+        self.evict()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def make_key(**params) -> str:
+        return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key: str, max_age: float | None=None) -> str | None:
+        """
+        Returns the cached value or None if there is no fresh entry.
+
+        Args:
+            key (str): key made by `make_key`
+            max_age (float | None, optional): overrides the cache max age for this lookup. Defaults to None.
+        """
+        max_age = max_age or self.max_age
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None or (max_age and time.time() - row[1] > max_age):
+            return None
+        return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, value, time.time()))
+        with self.lock:
+            self.writes += 1
+            evict = self.writes % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Removes entries older than `max_age` and the oldest entries above `max_entries`.
+
+        Returns:
+            int: number of removed entries
+        """
+        with contextlib.closing(self._connect()) as conn:
+            removed = 0
+            if self.max_age:
+                removed += conn.execute('DELETE FROM responses WHERE created < ?',
+                                        (time.time() - self.max_age,)).rowcount
+            removed += conn.execute('DELETE FROM responses WHERE key IN '
+                                    '(SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                                    (self.max_entries,)).rowcount
+        return removed
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> ResponseCache:
+    """
+    Returns the process-wide response cache, creating it on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
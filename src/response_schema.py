@@ -0,0 +1,230 @@
+import json
+import re
+from typing import Hashable
+
+from async_gpt import get_responses_GPT
+from ledger import call_context
+from profiling import timed
+
+
+REASKS = 1
+REASK_TEMPLATE = ('Answer the task below only for the keys {fields}. '
+                  'Return only a JSON object with exactly these keys, without any other text.\n\n{prompt}')
+# the fixes the scripts used to apply by hand, tried after the generic repairs
+LEGACY_FIXES = ((']]', ']}'), ('}.', '}'), ('}"', '}'))
+# curly quotes ChatGPT sometimes uses around keys and values
+SMART_QUOTES = '“”'
+
+
+class SchemaError(ValueError):
+    def __init__(self, problems: list, partial: dict) -> None:
+        """
+        Raised when a response still misses fields after the re-asks.
+
+        Args:
+            problems (list): missing or invalid fields
+            partial (dict): the valid fields
+        """
+        super().__init__(f'Missing or invalid fields: {", ".join(problems)}')
+        self.problems = problems
+        self.partial = partial
+
+
+class Schema:
+    def __init__(self, fields: dict, name: str='') -> None:
+        """
+        Expected keys of a JSON object response and their types. String fields must not be
+        empty, list fields may be (e.g. no links found).
+
+        Args:
+            fields (dict): key -> type or tuple of types
+            name (str, optional): prompt key the calls are recorded under in the ledger. Defaults to ''.
+        """
+        self.fields = fields
+        self.name = name
+
+    @timed('validate')
+    def validate(self, obj) -> tuple[dict, list]:
+        """
+        Returns:
+            tuple[dict, list]: the valid fields and the names of the missing or invalid ones
+        """
+        valid = dict()
+        for field, type_ in self.fields.items():
+            value = obj.get(field) if isinstance(obj, dict) else None
+            if isinstance(value, str): value = value.strip()
+            if isinstance(value, type_) and (value or isinstance(value, list)):
+                valid[field] = value
+        return valid, [field for field in self.fields if field not in valid]
+
+
+# schemas by prompt file and key, see the prompts in PROMPTS_DIR
+SCHEMAS = {
+    'cheap_eats.content': Schema({'meta': str, 'keywords': str, 'title': str, 'text': str, 'links': list}),
+    'accomodations_pmt.meta_keywords_links': Schema({'meta': str, 'keywords': (str, list), 'title': str, 'links': list}),
+    'children_attractions_pmt.keywords_links': Schema({'keywords': (str, list), 'links': list}),
+    'city_attractions_pmt.title_links': Schema({'title': str, 'links': list}),
+    'events_festivals_pmt.links': Schema({'links': list}),
+    'events_festivals_pmt.content': Schema({'summary': str, 'keywords': (str, list), 'title': str, 'text': str}),
+    'city_descriptions_pmt.popular_directions': Schema({'destinations_id': list}),
+}
+for name, schema in SCHEMAS.items(): schema.name = name
+
+
+def _normalize(text: str, smart_quotes: bool=False) -> str:
+    """
+    Drops trailing commas before a closing bracket and, with smart_quotes, turns curly quotes
+    used as JSON quotes into straight ones. The contents of string values are kept as they are.
+    """
+    out, quote, escaped = [], None, False
+    for char in text:
+        if quote:
+            if escaped: escaped = False
+            elif char == '\\': escaped = True
+            # a string opened by a curly quote may be closed by either kind
+            elif char == '"' or (quote != '"' and char in SMART_QUOTES):
+                out.append('"')
+                quote = None
+                continue
+        elif char == '"' or (smart_quotes and char in SMART_QUOTES):
+            out.append('"')
+            quote = char
+            continue
+        elif char in '}]':
+            end = len(out)
+            while end and out[end - 1].isspace(): end -= 1
+            if end and out[end - 1] == ',': del out[end - 1]
+        out.append(char)
+    return ''.join(out)
+
+
+def _close_brackets(text: str) -> str:
+    """
+    Closes the strings, objects and arrays left open by a truncated response,
+    the text is returned as it is when nothing is open.
+    """
+    stack, in_string, escaped = [], False, False
+    for char in text:
+        if in_string:
+            if escaped: escaped = False
+            elif char == '\\': escaped = True
+            elif char == '"': in_string = False
+        elif char == '"': in_string = True
+        elif char in '{[': stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack: stack.pop()
+    if not stack and not in_string:
+        return text
+    if in_string: text += '"'
+    return re.sub(r'[,:\s]+$', '', text) + ''.join(reversed(stack))
+
+
+def _legacy_fixes(text: str) -> str:
+    for old, new in LEGACY_FIXES:
+        text = text.replace(old, new)
+    return text
+
+
+def _candidates(text: str):
+    """
+    Yields the repairs to try in order, with whether the text had to be closed.
+    """
+    fence = re.search(r'```(?:json)?\s*(.*?)(?:```|$)', text, re.S)
+    if fence: text = fence.group(1)
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    text = text[min(starts):] if starts else text
+    yield text, False
+    yield _normalize(text), False
+    text = _normalize(text, smart_quotes=True)
+    yield text, False
+    yield _legacy_fixes(text), False
+    closed = _close_brackets(text)
+    if closed != text:
+        yield closed, True
+        yield _legacy_fixes(closed), True
+
+
+@timed('parse')
+def repair_json(response: str) -> dict | list | None:
+    """
+    Parses a JSON response, tolerating prose or code fences around it, trailing commas,
+    smart quotes, truncation and the usual ChatGPT glitches. Of a truncated response the
+    value that was being written when it was cut (the last key of an object, the last
+    item of an array) is dropped, so that it is validated as missing and asked again.
+
+    Args:
+        response (str): response content
+
+    Returns:
+        dict | list | None: parsed JSON or None if it can't be repaired
+    """
+    if not response:
+        return None
+    decoder = json.JSONDecoder(strict=False)
+    for text, closed in _candidates(response.strip()):
+        try:
+            # raw_decode ignores whatever follows the JSON value
+            parsed = decoder.raw_decode(text)[0]
+        except json.JSONDecodeError:
+            continue
+        if closed and isinstance(parsed, dict) and parsed:
+            del parsed[list(parsed)[-1]]
+        elif closed and isinstance(parsed, list) and parsed:
+            parsed.pop()
+        return parsed
+    return None
+
+
+def complete_responses(prompts: dict[Hashable, str], responses: dict, schema: Schema, reasks: int=REASKS) -> dict:
+    """
+    Validates responses against a schema and re-asks only for the missing or invalid
+    fields of each prompt, all re-asks of a round being sent at once. The valid fields
+    of the paid answers are kept.
+
+    Args:
+        prompts (dict[Hashable, str]): the original prompts by key
+        responses (dict): response text, already parsed object or None by the same keys
+        schema (Schema): expected fields
+        reasks (int, optional): follow-up rounds. Defaults to REASKS.
+
+    Returns:
+        dict: complete objects by key, SchemaError for the prompts still incomplete
+    """
+    results, problems = dict(), dict()
+    for key in prompts:
+        response = responses.get(key)
+        parsed = repair_json(response) if isinstance(response, str) else response
+        results[key], problems[key] = schema.validate(parsed)
+    for _ in range(reasks):
+        todo = [key for key in prompts if problems[key]]
+        if not todo:
+            break
+        with call_context(prompt_key=f'{schema.name}:reask'):
+            retried = get_responses_GPT({key: REASK_TEMPLATE.format(fields=', '.join(f'"{f}"' for f in problems[key]),
+                                                                    prompt=prompts[key]) for key in todo})
+        for key in todo:
+            valid, _ = Schema({field: schema.fields[field] for field in problems[key]}).validate(repair_json(retried.get(key)))
+            results[key].update(valid)
+            problems[key] = [field for field in problems[key] if field not in valid]
+    return {key: SchemaError(problems[key], results[key]) if problems[key] else results[key] for key in prompts}
+
+
+def get_structured_responses(prompts: dict[Hashable, str], schema: Schema, reasks: int=REASKS) -> dict:
+    """
+    Sends all prompts at once and completes the answers, see `complete_responses`.
+    """
+    with call_context(prompt_key=schema.name):
+        responses = get_responses_GPT(prompts)
+    return complete_responses(prompts, responses, schema, reasks)
+
+
+def get_structured_response(prompt: str, schema: Schema, reasks: int=REASKS) -> dict:
+    """
+    Blocking single-prompt version of `get_structured_responses`.
+
+    Raises:
+        SchemaError: fields still missing after the re-asks
+    """
+    result = get_structured_responses({0: prompt}, schema, reasks)[0]
+    if isinstance(result, SchemaError):
+        raise result
+    return result
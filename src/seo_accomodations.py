@@ -1,71 +1,80 @@
-import json
 from pathlib import Path
-from data_provider import CSVDataProvider
-from datetime import datetime
+from data_provider import get_provider
 from logger import logger_setup
 import functions
+from batch_prompts import get_batched_responses
+from response_schema import SCHEMAS, SchemaError
+from journal import Journal
+from ledger import set_context
+from content_store import get_store
 from config import PROMPTS_DIR, SEO_TEXTS_DIR
 import argparse
 
 
-dp = CSVDataProvider()
-timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-logger = logger_setup(f'{Path(__file__).stem}_{timestamp}')
+dp = get_provider()
+logger = logger_setup(Path(__file__).stem)
 
 
 @functions.elapsed_time
-def gen_content(first_el=None, last_el=None):
+def gen_content(first_el=None, last_el=None, replay_failed=False, shard=None, num_shards=1):
     category = 'accomodations'
+    journal = Journal(category)
     base_url = f'http://20.240.63.21/files/images/{category}'
     save_dir = Path(f'{SEO_TEXTS_DIR}/{category}/en')
     save_dir.mkdir(parents=True, exist_ok=True)
-    logger.info(f'Making output dir...SUCCESSFULLY')
+    logger.info('Making output dir...SUCCESSFULLY')
     prompts = functions.get_prompts_GPT(f'{PROMPTS_DIR}/{category}_pmt.json')
-    logger.info(f'Getting prompts...SUCCESSFULLY')
+    logger.info('Getting prompts...SUCCESSFULLY')
     j = 1
-    for city, country in dp.gen_data(first_el, last_el):
-        logger.info(f'Processing {city}, {country} started...')
-        city_ = city.replace(' ', '_').replace('-', '_')
+    for city, country in dp.gen_data(first_el, last_el, shard=shard, num_shards=num_shards):
+        if replay_failed and city not in journal.failed_cities(): continue
+        set_context(category=category, city=city, option=None)
+        logger.info('Processing %s, %s started...', city, country)
+        city_ = dp.get_city_slug(city)
         # getting option list for the given city
         try:
             accomodations = functions.load_json(f'{SEO_TEXTS_DIR}/{category}/en_copy/{city_}.json')
-            logger.info(f'Category options loading...SUCCESS')
+            logger.info('Category options loading...SUCCESS')
         except Exception as err:
-            logger.error(f'{type(err).__name__}: {err} while getting options. Continue to process with next city')
+            logger.error('%s: %s while getting options. Continue to process with next city', type(err).__name__, err)
             continue
-        # looping over the options
-        data = dict()
-        for key in accomodations.keys():
+        # sending the prompts of all options at once, several options per request
+        pending = journal.pending(city, accomodations.keys())
+        responses = get_batched_responses({key: prompts['meta_keywords_links'].format(text=accomodations[key]['description'])
+                                           for key in pending}, schema=SCHEMAS['accomodations_pmt.meta_keywords_links'])
+        logger.info('Getting responses for %s options...SUCCESS', len(responses))
+        # looping over the options, the ones completed in earlier runs are taken from the journal
+        data = journal.city_results(city)
+        for key in pending:
+            set_context(option=key)
             data[key] = dict()
             name = accomodations[key]['name']
             text = accomodations[key]['description']
-            logger.info(f'Starting process for "{key}.{name}"...')
-            # composing prompt for the given option
-            prompt = prompts['meta_keywords_links'].format(text=text)
-            # getting response from ChatGPT
+            logger.info('Starting process for "%s.%s"...', key, name)
             try:
-                response = functions.get_response_GPT(prompt)
-                logger.info(f'Generating response for "{key}.{name}"...SUCCESS')
-                parsed = json.loads(response)
-                logger.info(f'Parsing response for "{key}.{name}"...SUCCESS')
+                parsed = responses[key]
+                if isinstance(parsed, SchemaError): raise parsed
+                logger.info('Generating and parsing response for "%s.%s"...SUCCESS', key, name)
                 meta = parsed['meta']
                 keywords = parsed['keywords']
                 title = parsed['title']
-                links = [link for link in parsed['links'] if functions.is_valid_link(link)]
-                logger.info(f'Validation links...SUCCESS')
+                links = functions.filter_valid_links(parsed['links'])
+                logger.info('Validation links...SUCCESS')
             except Exception as err:
-                logger.error(f'{type(err).__name__}: {err} while getting ChatGPT response. Continue to process with next option')
+                logger.error('%s: %s while getting ChatGPT response. Continue to process with next option', type(err).__name__, err)
+                journal.fail(city, key, err)
                 del data[key]
                 continue
             prompt = prompts['images'].format(option=name, text=text)
             try:
                 url = functions.get_images_DALLE(prompt)
-                logger.info(f'Generating image of option "{key}.{name}"...SUCCESS')
-                img_name = functions.download_image(url[0], category, city, key, name)
+                logger.info('Generating image of option "%s.%s"...SUCCESS', key, name)
+                img_name = functions.download_image(url[0], category, city, key, name, background=True)
                 images = [f'{base_url}/{city_}/{img_name}']
-                logger.info(f'Saving image of option "{key}.{name}"...SUCCESS')
+                logger.info('Saving image of option "%s.%s"...SUCCESS', key, name)
             except Exception as err:
-                logger.error(f'{type(err).__name__}: {err} while generating or downloading image. Continue to process with next option')
+                logger.error('%s: %s while generating or downloading image. Continue to process with next option', type(err).__name__, err)
+                journal.fail(city, key, err)
                 del data[key]
                 continue
             # Compose a data[key] subdict
@@ -78,13 +87,21 @@ def gen_content(first_el=None, last_el=None):
                         'links': links,
                         'images': images
             }
-            logger.info(f'Adding option "{key}.{name}"...SUCCESS')
+            logger.info('Adding option "%s.%s"...SUCCESS', key, name)
+        # images were downloading in the background while the next options were generated,
+        # an option is journaled as done only once its image is on disk
+        failed = {key: err for (_, key), err in functions.wait_downloads().items()}
+        for key, err in failed.items():
+            logger.error('%s: %s while downloading image of option "%s"', type(err).__name__, err, key)
+            journal.fail(city, key, err)
+            data.pop(key, None)
+        for key in pending:
+            if key in data: journal.record(city, key, data[key])
         # avoid to save empty data dict
         if not data: continue
-        # saving data dict to json
-        with open(Path(f'{save_dir}/{city_}.json'), 'w') as fp:
-            json.dump(data, fp, indent=4)
-        logger.info(f'Processing {city}, {country} completed SUCCESSFULLY. Total score {j}/{dp.get_numrows()}')
+        # saving data dict to the store and its json
+        get_store().save_city(category, city, data, save_dir)
+        logger.info('Processing %s, %s completed SUCCESSFULLY. Total score %s/%s', city, country, j, dp.get_numrows())
         j += 1        
     
 
@@ -92,10 +109,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process two optional parameters.')
     parser.add_argument('first_el', nargs='?', type=int, help='The first city id in the range (optional)')
     parser.add_argument('last_el', nargs='?', type=int, help='The last city id in the range (optional)')
+    parser.add_argument('--replay-failed', action='store_true', help='Process only the options that failed in earlier runs')
+    parser.add_argument('--shard', type=int, default=None, help='Index of the share of cities processed by this worker (optional)')
+    parser.add_argument('--num-shards', type=int, default=1, help='Number of workers the cities are shared between (default: 1)')
 
     args = parser.parse_args()
 
     first_el = args.first_el
     last_el = args.last_el
 
-    gen_content(first_el, last_el)
\ No newline at end of file
+    gen_content(first_el, last_el, args.replay_failed, args.shard, args.num_shards)
\ No newline at end of file
@@ -1,26 +1,31 @@
 import json
 from pathlib import Path
-from datetime import datetime
 
 from logger import logger_setup
-from functions import get_response_GPT, get_prompts_GPT, get_cities_countries, is_valid_link, elapsed_time
-from config import PROMPTS_DIR, SEO_CHILDREN_ATTRACTIONS_DIR, CHILDREN_ATTRACTIONS_LIST_DIR, IMG_DIR
+from data_provider import to_slug
+from functions import get_prompts_GPT, get_cities_countries, filter_valid_links, elapsed_time
+from batch_prompts import get_batched_responses
+from response_schema import SCHEMAS, SchemaError
+from journal import Journal
+from ledger import set_context
+from image_index import get_image_index
+from content_store import get_store
+from config import PROMPTS_DIR, SEO_CHILDREN_ATTRACTIONS_DIR, CHILDREN_ATTRACTIONS_LIST_DIR
 
 
-timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-logger = logger_setup(f'{Path(__file__).stem}_{timestamp}')
+logger = logger_setup(Path(__file__).stem)
 
 
 @elapsed_time    
-def change_to():
-    base_url = "http://20.240.63.21/files/images/children_attractions"
+def change_to(replay_failed=False):
+    journal = Journal('children_attractions')
     # getting inputs
     try:
         cities_countries = get_cities_countries()
         if not cities_countries: raise Exception(f'No cities_countries list provided: {cities_countries}')
-        logger.info(f'Getting cities and countries list...SUCCESS')
+        logger.info('Getting cities and countries list...SUCCESS')
         prompts = get_prompts_GPT(f'{PROMPTS_DIR}/children_attractions_pmt.json')
-        logger.info(f'Getting prompts...SUCCESS')
+        logger.info('Getting prompts...SUCCESS')
     except FileNotFoundError as err:
         logger.critical(err)
         exit()
@@ -30,22 +35,35 @@ def change_to():
     # cities countries loop
     j = 0
     for city, country in cities_countries:
-        logger.info(f'\nProcessing {city.upper()}, {country.upper()}...')
-        city_ = city.replace('-', '_').replace(' ', '_')
+        if replay_failed and city not in journal.failed_cities(): continue
+        set_context(category='children_attractions', city=city, option=None)
+        logger.info('\nProcessing %s, %s...', city.upper(), country.upper())
+        city_ = to_slug(city)
         try:
             # getting children attractions list for given city
             attr_path = f'{CHILDREN_ATTRACTIONS_LIST_DIR}/{city_}.json'
             with open(attr_path, 'r') as fp:
                 attractions = json.load(fp)
-            logger.info(f'Children attractions list is retrieved for {city} successfully')
+            logger.info('Children attractions list is retrieved for %s successfully', city)
             # getting json with seo content for the same city
             seo_path = f'{SEO_CHILDREN_ATTRACTIONS_DIR}_copy/{city_}.json' 
             with open(seo_path, 'r') as fp:
                 seo_content = json.load(fp)
-                logger.info(f'Seo content is retrieved for {city} successfully')
-            data = dict()
-            for number, attraction in attractions.items():
-                logger.info(f'Starting {number}:{attraction}...')
+                logger.info('Seo content is retrieved for %s successfully', city)
+            # getting keywords and links for all attractions, several attractions per request
+            logger.info('Getting responses from ChatGPT...')
+            responses = get_batched_responses({number: prompts['keywords_links'].format(attraction=attraction, city=city, country=country,
+                                                                                        text=seo_content[number][attraction]['description'])
+                                               for number, attraction in attractions.items()
+                                               if attraction in seo_content.get(number, {}) and not journal.is_done(city, number)},
+                                              schema=SCHEMAS['children_attractions_pmt.keywords_links'])
+            logger.info('Got responses for %s attractions', len(responses))
+            # attractions completed in earlier runs are taken from the journal
+            data = journal.city_results(city)
+            for number in journal.pending(city, attractions.keys()):
+                set_context(option=number)
+                attraction = attractions[number]
+                logger.info('Starting %s:%s...', number, attraction)
                 try:
                     # saving value into a new key 'number'
                     data[number] = dict()
@@ -53,73 +71,64 @@ def change_to():
                     data[number]['name'] = attraction
                     data[number]['location'] = f'{city}, {country}'
                     data[number]['meta'] = seo_content[number][attraction]['meta']
-                    logger.info(f"Adding keys: 'name', 'location', 'meta', to data[{number}]...SUCCESS")
-                    # crafting the prompt for GPT
-                    logger.info(f'Crafting prompt for ChatGPT...')
-                    prompt = prompts['keywords_links'].format(attraction=attraction, city=city, 
-                                                           country=country, text=seo_content[number][attraction]['description'])
-                    logger.info(f'SUCCESS')
-                    # getting response from GPT
-                    logger.info(f'Getting response from ChatGPT...')
-                    response = get_response_GPT(prompt).replace(']]', ']}').replace('}.', '}').replace('}"', '}')
-                    logger.info(f'SUCCESS')
-                    # parsing response
-                    logger.info(f'Parsing response...')
-                    parsed = json.loads(response)
-                    logger.info(f'SUCCESS')
+                    logger.info("Adding keys: 'name', 'location', 'meta', to data[%s]...SUCCESS", number)
+                    parsed = responses.get(number)
+                    if parsed is None: raise ValueError(f'No valid response for {number}:{attraction}')
+                    if isinstance(parsed, SchemaError): raise parsed
+                    logger.info('Getting and parsing response...SUCCESS')
                     # adding some keys
                     data[number]['keywords'] = parsed['keywords']
                     data[number]['title'] = seo_content[number][attraction]['title']
                     data[number]['text'] = seo_content[number][attraction]['description']
-                    logger.info(f"Added keys: 'keywords', 'title', 'text' to data[{number}] successfully")
-                    logger.info(f'Starting response["links"] checking...')
-                    data[number]['links'] = [link for link in parsed['links'] if is_valid_link(link)]
-                    logger.info(f"Added key: {data[number]['links']} to data[{number}] successfully")
+                    logger.info("Added keys: 'keywords', 'title', 'text' to data[%s] successfully", number)
+                    logger.info('Starting response["links"] checking...')
+                    data[number]['links'] = filter_valid_links(parsed['links'])
+                    logger.info("Added key: %s to data[%s] successfully", data[number]['links'], number)
                     # setting up image path     
                     logger.info('Adding image urls...')               
-                    image_path = next(Path(f'{IMG_DIR}/children_attractions/{city_}').glob(f'{number}_*.jpg'))
-                    image_url = [f'{base_url}/{city_}/{image_path.name}']
+                    # a missing image raises KeyError
+                    image_url = [get_image_index().url('children_attractions', city, number)]
                     data[number]['images'] = image_url
                     logger.info('Added image urls to data[{number}]["links"] successfully')
-                    logger.info(f'Completed {number}: {attraction}...SUCCESS')
+                    journal.record(city, number, data[number])
+                    logger.info('Completed %s: %s...SUCCESS', number, attraction)
                     # del seo_content[attraction]   
                 except KeyError as err:
-                    logger.error(f'{err} while {number}:{attraction} in {city}, {country}')
+                    logger.error('%s while %s:%s in %s, %s', err, number, attraction, city, country)
+                    journal.fail(city, number, err)
                     del data[number]
-                    logger.error(f'data{[number]} was deleted in KeyError except')
+                    logger.error('data%s was deleted in KeyError except', [number])
                     continue
                 except AttributeError as err:
-                    logger.error(f'{err} while {number}:{attraction} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in AttributeError except')
+                    logger.error('%s while %s:%s in %s, %s', err, number, attraction, city, country)
+                    logger.error('data%s was deleted in AttributeError except', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
                 except TypeError as err:
-                    logger.error(f'{err} while {number}:{attraction} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in TypeError except')
+                    logger.error('%s while %s:%s in %s, %s', err, number, attraction, city, country)
+                    logger.error('data%s was deleted in TypeError except', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue   
                 except StopIteration as err:
-                    logger.error(f'{err} for {number}:{attraction} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in StopIteration except')
+                    logger.error('%s for %s:%s in %s, %s', err, number, attraction, city, country)
+                    logger.error('data%s was deleted in StopIteration except', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
-                except json.decoder.JSONDecodeError as err:
-                    logger.error(f'Error character: " {response[err.colno - 1]} "')
-                    logger.error(f'{err} for {number}:{attraction} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in JSONDecodeErrors')
-                    del data[number]
                 except Exception as err:
                     logger.error(err)
-                    logger.error(f'data{[number]} was deleted in Exception')
+                    logger.error('data%s was deleted in Exception', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
         except FileNotFoundError as err:
             logger.error(err)
             continue
-        # saving renewed date to json
-        with open(f'{SEO_CHILDREN_ATTRACTIONS_DIR}/{city_}.json', 'w') as fp:
-            json.dump(data, fp, indent=4)
-        logger.info(f'Finish processing {city}, {country}...SUCCESS, total score {j + 1}/{len(cities_countries)}')
+        # saving renewed date to the store and its json
+        get_store().save_city('children_attractions', city, data, SEO_CHILDREN_ATTRACTIONS_DIR)
+        logger.info('Finish processing %s, %s...SUCCESS, total score %s/%s', city, country, j + 1, len(cities_countries))
         j += 1
     
     
@@ -1,23 +1,32 @@
+import argparse
 import json
 from pathlib import Path
 
 from logger import logger_setup
-from functions import get_response_GPT, get_prompts_GPT, get_cities_countries, is_valid_link
-from config import PROMPTS_DIR, SEO_CITY_ATTRACTIONS_DIR, CITY_ATTRACTIONS_LIST_DIR, IMG_DIR
+from data_provider import to_slug
+from journal import Journal
+from ledger import set_context
+from response_schema import SCHEMAS, SchemaError, get_structured_response
+from image_index import get_image_index
+from content_store import get_store
+from functions import get_prompts_GPT, get_cities_countries, filter_valid_links
+from config import PROMPTS_DIR, SEO_CITY_ATTRACTIONS_DIR, CITY_ATTRACTIONS_LIST_DIR
 
 
 logger = logger_setup(Path(__file__).stem)
+# cities regenerated by hand
+CORRECTS = ('Ohrid', 'Pescara', 'Stuttgart', 'Constanta', 'Malmö', 'Mumbai', 'Zagreb')
 
     
-def change_to():
-    base_url = "http://20.240.63.21/files/images/city_attractions"
+def change_to(replay_failed=False, rerun=False):
+    journal = Journal('city_attractions')
     # getting inputs
     try:
         cities_countries = get_cities_countries()
         if not cities_countries: raise Exception(f'No cities_countries list provided: {cities_countries}')
-        logger.info(f'Getting cities and countries list...SUCCESS')
+        logger.info('Getting cities and countries list...SUCCESS')
         prompts = get_prompts_GPT(f'{PROMPTS_DIR}/city_attractions_pmt.json')
-        logger.info(f'Getting prompts...SUCCESS')
+        logger.info('Getting prompts...SUCCESS')
     except FileNotFoundError as err:
         logger.critical(err)
         exit()
@@ -26,25 +35,34 @@ def change_to():
         exit()
     # cities countries loop
     j = 0
-    corrects = ('Ohrid', 'Pescara', 'Stuttgart', 'Constanta', 'Malmö', 'Mumbai', 'Zagreb')
-    cities_countries = [cc for cc in cities_countries if cc[0] in corrects]
+    cities_countries = [cc for cc in cities_countries if cc[0] in CORRECTS]
+    # the journal skips the attractions done before, a rerun forgets them once up front
+    # so that a crash during the rerun still resumes where it stopped
+    if rerun:
+        for city, _ in cities_countries:
+            journal.reset(city)
     for city, country in cities_countries:
-        logger.info(f'Start processing {city.upper()}, {country.upper()}...SUCCESS')
-        city_ = city.replace('-', '_').replace(' ', '_')
+        if replay_failed and city not in journal.failed_cities(): continue
+        set_context(category='city_attractions', city=city, option=None)
+        logger.info('Start processing %s, %s...SUCCESS', city.upper(), country.upper())
+        city_ = to_slug(city)
         try:
             # getting city attractions list for given city
             attr_path = f'{CITY_ATTRACTIONS_LIST_DIR}/{city_}.json'
             with open(attr_path, 'r') as fp:
                 attractions = json.load(fp)
-                logger.info(f'Getting attraction list for {city}...SUCCESS')
+                logger.info('Getting attraction list for %s...SUCCESS', city)
             # getting json with seo content for the same city
             seo_path = f'{SEO_CITY_ATTRACTIONS_DIR}_copy/{city_}.json' 
             with open(seo_path, 'r') as fp:
                 seo_content = json.load(fp)
-                logger.info(f'Getting seo content for {city}...SUCCESS')
-            data = dict()
-            for number, attraction in attractions.items():
-                logger.info(f'Starting {number}: {attraction}')
+                logger.info('Getting seo content for %s...SUCCESS', city)
+            # attractions completed in earlier runs are taken from the journal
+            data = journal.city_results(city)
+            for number in journal.pending(city, attractions.keys()):
+                set_context(option=number)
+                attraction = attractions[number]
+                logger.info('Starting %s: %s', number, attraction)
                 try:
                     # saving value into a new key 'number'
                     data[number] = dict()
@@ -53,72 +71,78 @@ def change_to():
                     data[number]['location'] = f'{city}, {country}'
                     data[number]['meta'] = seo_content[attraction]['summary']
                     data[number]['keywords'] = seo_content[attraction]['keywords']
-                    logger.info(f"Adding keys: 'name', 'location', 'meta', 'keywords' to data[{number}]...SUCCESS")
+                    logger.info("Adding keys: 'name', 'location', 'meta', 'keywords' to data[%s]...SUCCESS", number)
                     # crafting the prompt for GPT
-                    logger.info(f'Crafting prompt for ChatGPT')
+                    logger.info('Crafting prompt for ChatGPT')
                     prompt = prompts['title_links'].format(attraction=attraction, city=city, 
                                                            country=country, text=seo_content[attraction]['text'])
-                    logger.info(f'SUCCESS')
-                    # getting response from GPT
-                    logger.info(f'Getting response from ChatGPT...')
-                    response = get_response_GPT(prompt).replace(']]', ']}').replace('}.', '}').replace('}"', '}')
-                    logger.info(f'SUCCESS')
-                    # parsing response
-                    logger.info(f'Parsing response...')
-                    parsed = json.loads(response)
-                    logger.info(f'SUCCESS')
+                    logger.info('SUCCESS')
+                    # getting and validating response from GPT, missing fields are asked again
+                    logger.info('Getting response from ChatGPT...')
+                    parsed = get_structured_response(prompt, SCHEMAS['city_attractions_pmt.title_links'])
+                    logger.info('SUCCESS')
                     # adding some keys
                     data[number]['title'] = parsed['title']
                     data[number]['text'] = seo_content[attraction]['text']
-                    logger.info(f"Adding keys: 'title', 'text' to data[{number}]...SUCCESS")
-                    logger.info(f'Starting response["links"] checking...')
-                    data[number]['links'] = [link for link in parsed['links'] if is_valid_link(link)]
-                    logger.info(f"Adding key: {data[number]['links']} to data[{number}]...SUCCESS")
+                    logger.info("Adding keys: 'title', 'text' to data[%s]...SUCCESS", number)
+                    logger.info('Starting response["links"] checking...')
+                    data[number]['links'] = filter_valid_links(parsed['links'])
+                    logger.info("Adding key: %s to data[%s]...SUCCESS", data[number]['links'], number)
                     # setting up image path                    
-                    image_path = next(Path(f'{IMG_DIR}/city_attractions/{city_}').glob(f'{number}_*.jpg'))
-                    image_url = [f'{base_url}/{city_}/{image_path.name}']
+                    # a missing image raises KeyError
+                    image_url = [get_image_index().url('city_attractions', city, number)]
                     data[number]['images'] = image_url
-                    logger.info(f'Completed {number}: {attraction}...SUCCESS')
+                    journal.record(city, number, data[number])
+                    logger.info('Completed %s: %s...SUCCESS', number, attraction)
                     # del seo_content[attraction]   
                 except KeyError as err:
-                    logger.error(f'{err} while {number}:{attraction} in {city}, {country}')
+                    logger.error('%s while %s:%s in %s, %s', err, number, attraction, city, country)
+                    journal.fail(city, number, err)
                     del data[number]
-                    logger.error(f'data{[number]} was deleted in KeyError except')
+                    logger.error('data%s was deleted in KeyError except', [number])
                     continue
                 except AttributeError as err:
-                    logger.error(f'{err} while {number}:{attraction} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in AttributeError except')
+                    logger.error('%s while %s:%s in %s, %s', err, number, attraction, city, country)
+                    logger.error('data%s was deleted in AttributeError except', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
                 except TypeError as err:
-                    logger.error(f'{err} while {number}:{attraction} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in TypeError except')
+                    logger.error('%s while %s:%s in %s, %s', err, number, attraction, city, country)
+                    logger.error('data%s was deleted in TypeError except', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue   
                 except StopIteration as err:
-                    logger.error(f'{err} for {number}:{attraction} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in StopIteration except')
+                    logger.error('%s for %s:%s in %s, %s', err, number, attraction, city, country)
+                    logger.error('data%s was deleted in StopIteration except', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
-                except json.decoder.JSONDecodeError as err:
-                    logger.error(f'Error character: " {response[err.colno - 1]} "')
-                    logger.error(f'{err} for {number}:{attraction} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in JSONDecodeErrors')
+                except SchemaError as err:
+                    logger.error('%s for %s:%s in %s, %s', err, number, attraction, city, country)
+                    logger.error('data%s was deleted in SchemaError except', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                 except Exception as err:
                     logger.error(err)
-                    logger.error(f'data{[number]} was deleted in Exception')
+                    logger.error('data%s was deleted in Exception', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
         except FileNotFoundError as err:
             logger.error(err)
             continue
-        # saving renewed date to json
-        with open(f'{SEO_CITY_ATTRACTIONS_DIR}/{city_}.json', 'w') as fp:
-            json.dump(data, fp, indent=4)
-        logger.info(f'Finish processing {city}, {country}...SUCCESS, total score {j + 1}/{len(cities_countries)}')
+        # saving renewed date to the store and its json
+        get_store().save_city('city_attractions', city, data, SEO_CITY_ATTRACTIONS_DIR)
+        logger.info('Finish processing %s, %s...SUCCESS, total score %s/%s', city, country, j + 1, len(cities_countries))
         j += 1
     
     
 if __name__ == '__main__':
-    change_to()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Regenerate the city attractions of the hand-picked cities')
+    parser.add_argument('--replay-failed', action='store_true', help='Process only the attractions that failed in earlier runs')
+    parser.add_argument('--rerun', action='store_true', help='Forget the journaled attractions of the cities and generate them again')
+    args = parser.parse_args()
+
+    change_to(args.replay_failed, args.rerun)
\ No newline at end of file
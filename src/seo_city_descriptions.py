@@ -1,36 +1,60 @@
-import pandas as pd
+import argparse
 import json
-from time import perf_counter
 from pathlib import Path
 
-from functions import get_response_GPT, get_prompts_GPT, elapsed_time, is_valid_link, get_cities, get_city_id
-from config import PROMPTS_DIR, SEO_CITY_DESCRIPTIONS_DIR, IMG_DIR
+from functions import get_response_GPT, get_prompts_GPT, elapsed_time, is_valid_link, get_cities
+from config import PROMPTS_DIR, SEO_CITY_DESCRIPTIONS_DIR
 from logger import logger_setup
+from content_store import get_store, WHOLE
+from data_provider import get_provider, to_slug
+from image_index import get_image_index
+from destinations import get_engine, DEFAULT_COUNT, SHORTLIST
+from ledger import set_context
 
 
 logger = logger_setup(Path(__file__).stem)
 
 
+def load_description(city: str) -> dict | None:
+    """
+    Returns the stored description of a city. Descriptions written before the content store
+    exist only as <city slug>.json, they are moved to the store on first use.
+    """
+    store = get_store()
+    content = store.get('city_descriptions', city)
+    if content is not None: return content
+    try:
+        with open(f'{SEO_CITY_DESCRIPTIONS_DIR}/{to_slug(city)}.json', 'r') as f:
+            content = json.load(f)
+    except FileNotFoundError:
+        return None
+    store.upsert('city_descriptions', city, WHOLE, content)
+    return content
+
+
 @elapsed_time
 def complete_seo_description():
     prompts_path = Path(f'{PROMPTS_DIR}/city_descriptions_pmt.json')
-    img_dir = Path(f'{IMG_DIR}/city_descriptions')
-    base_url = 'http://20.240.63.21/files/images/city_descriptions'
     missing = {'cities':[]}
     # with open('missing_cities.json', 'r') as f:
     #     missing_cities = json.load(f)
+    store = get_store()
+    dp = get_provider()
     for json_ in SEO_CITY_DESCRIPTIONS_DIR.glob('*.json'):
-        with open(json_, 'r') as f:
-            json_content = json.load(f)
+        try:
+            city = dp.get_city_name(dp.get_city_id_by_slug(json_.stem))
+        except KeyError:
+            city = json_.stem.replace('_', ' ')
+        json_content = load_description(city)
         prompts = get_prompts_GPT(prompts_path)
         try:
             response = json.loads(get_response_GPT(prompts['city_description'].format(description=json_content['description'])))
             for k, v in response.items(): json_content[k] = v
             if not is_valid_link(json_content['link']): json_content['link'] = ''
-            json_content['images'] = [f'{base_url}/{json_.stem}/{image.name}' 
-                                      for image in list(Path(f'{img_dir}/{json_.stem}').glob("*.jpg"))]
-            with open(json_, 'w') as f:
-                json.dump(json_content, f, indent=4)
+            json_content['images'] = get_image_index().urls('city_descriptions', json_.stem)
+            # written through the store, so the exports of add_directions and edit keep it
+            store.upsert('city_descriptions', city, WHOLE, json_content)
+            store.export_city('city_descriptions', city, SEO_CITY_DESCRIPTIONS_DIR)
         except Exception as err:
             print('\nSomething went wrong: ', err)
             missing['cities'].append(json_.stem)
@@ -40,38 +64,46 @@ def complete_seo_description():
 
 
 @elapsed_time
-def add_directions():
+def add_directions(rerank: bool=False, count: int=DEFAULT_COUNT):
+    """
+    Adds the ids of the popular destinations to every city description: the nearest cities with a few of
+    the same country first (see `destinations.DestinationEngine`). With rerank=True ChatGPT picks the most
+    popular of SHORTLIST nearby candidates instead of getting the whole city list.
+    """
     cities = get_cities()
     logger.info('Getting list of cities...SUCCESS')
-    prompts_path = Path(f'{PROMPTS_DIR}/city_descriptions_pmt.json')
-    prompts = get_prompts_GPT(prompts_path)
-    logger.info('Prompts loading...SUCCESS')
-    j = 0
-    for city in cities:
-        city_ = city.replace('-', '_').replace(' ', '_')
-        logger.info(f'Starting {city}...')
+    # descriptions not in the content store yet are imported from their json by `load_description`
+    store = get_store()
+    engine = get_engine()
+    if engine.missing: logger.warning('No coordinates for %s, only cities of the same country are used', engine.missing)
+    logger.info('Computing distances between cities...SUCCESS')
+    missing = [city for city in cities if load_description(city) is None]
+    for city in missing: logger.error('There was an error while processing %s: no description in the content store or %s', city, SEO_CITY_DESCRIPTIONS_DIR)
+    cities = [city for city in cities if city not in missing]
+    if rerank:
+        set_context(category='city_descriptions')
+        prompts = get_prompts_GPT(Path(f'{PROMPTS_DIR}/city_descriptions_pmt.json'))
+        logger.info('Prompts loading...SUCCESS')
+        destinations = engine.rerank(cities, prompts['popular_directions'], count)
+    else:
+        destinations = {city: engine.destinations(city, count) for city in cities}
+    logger.info('Choosing destinations of %s cities...SUCCESS', len(cities))
+    for j, city in enumerate(cities):
         try:
-            descr_path = f'{SEO_CITY_DESCRIPTIONS_DIR}/{city_}.json'
-            with open(descr_path, 'r') as fp:
-                content = json.load(fp)
-                logger.info(f'Loading {descr_path}...SUCCESS')
-            prompt = prompts['popular_directions'].format(city=city, city_list=[c for c in cities if c != city])    
-            response = json.loads(get_response_GPT(prompt))
-            logger.info(f'Getting response from ChatGPT...{response}...SUCCESS')
-            content['destinations_id'] = [get_city_id(c) for c in response['destinations_id']]
-            logger.info(f'Adding the key "destinations_id":{content["destinations_id"]} for {city}...SUCCESS')
-            with open(descr_path, 'w') as fp:
-                json.dump(content, fp, indent=4)
-        except FileNotFoundError as err:
-            logger.error(f'There was an error while processing {city}: {err}')
-            continue
+            content = store.update('city_descriptions', city, destinations_id=destinations[city])
+            logger.info('Adding the key "destinations_id":%s for %s...SUCCESS', content["destinations_id"], city)
+            store.export_city('city_descriptions', city, SEO_CITY_DESCRIPTIONS_DIR)
         except Exception as err:
-            logger.error(f'An unexpected error occurred: {err}')
+            logger.error('An unexpected error occurred: %s', err)
             continue
-        logger.info(f'Completed {city}...SUCCESS, total score {j + 1}/{len(cities)}')
-        j += 1
-        
+        logger.info('Completed %s...SUCCESS, total score %s/%s', city, j + 1, len(cities))
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add the popular destinations to the city descriptions')
+    parser.add_argument('--rerank', action='store_true', help=f'Let ChatGPT pick among the {SHORTLIST} nearest candidates')
+    parser.add_argument('--count', type=int, default=DEFAULT_COUNT, help=f'Destinations per city (default: {DEFAULT_COUNT})')
+    args = parser.parse_args()
+
     # complete_seo_description()
-    add_directions()
\ No newline at end of file
+    add_directions(args.rerank, args.count)
\ No newline at end of file
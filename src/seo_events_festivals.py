@@ -1,61 +1,64 @@
 import json
 from pathlib import Path
-from datetime import datetime
 
 from logger import logger_setup
-from functions import get_response_GPT, get_prompts_GPT, is_valid_link, elapsed_time
-from config import PROMPTS_DIR, IMG_DIR, OPTION_LISTS_DIR, SEO_FESTIVALS_DIR
-from data_provider import CSVDataProvider
+from functions import get_prompts_GPT, filter_valid_links, elapsed_time
+from config import PROMPTS_DIR, OPTION_LISTS_DIR, SEO_FESTIVALS_DIR
+from data_provider import get_provider
+from async_gpt import get_responses_GPT
+from journal import Journal
+from ledger import set_context
+from response_schema import SCHEMAS, SchemaError, complete_responses
+from image_index import get_image_index
+from content_store import get_store
 
 
-timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-logger = logger_setup(f'{Path(__file__).stem}_{timestamp}')
-dp = CSVDataProvider()
+logger = logger_setup(Path(__file__).stem)
+dp = get_provider()
 
 
 @elapsed_time    
-def change_to():
-    base_url = 'http://20.240.63.21/files/images/events_festivals'
+def change_to(replay_failed=False):
+    journal = Journal('events_festivals')
     prompts = get_prompts_GPT(f'{PROMPTS_DIR}/events_festivals_pmt.json')
     # cities countries loop
     j = 0
     for city, country in dp.gen_data(from_=21):
-        logger.info(f'Processing {city.upper()}, {country.upper()}...')
-        city_ = city.replace('-', '_').replace(' ', '_')
+        if replay_failed and city not in journal.failed_cities(): continue
+        set_context(category='events_festivals', city=city, option=None)
+        logger.info('Processing %s, %s...', city.upper(), country.upper())
+        city_ = dp.get_city_slug(city)
         try:
             # getting options list for given city
             evafs_path = f'{OPTION_LISTS_DIR}/events_festivals/{city_}.json'
             with open(evafs_path, 'r') as fp:
                 evafs = json.load(fp)
-            logger.info(f'Events and Festivals list is retrieved for {city} successfully')
+            logger.info('Events and Festivals list is retrieved for %s successfully', city)
             # getting json with seo content for the same city
             seo_path = f'{SEO_FESTIVALS_DIR}_copy/{city_}.json' 
             with open(seo_path, 'r') as fp:
                 seo_content = json.load(fp)
-                logger.info(f'Seo content is retrieved for {city} successfully')
-            data = dict()
-            for number, option in evafs.items():
-                logger.info(f'Starting {number}:{option}...')
+                logger.info('Seo content is retrieved for %s successfully', city)
+            # generating links for all options at once
+            logger.info('Getting responses from ChatGPT for %s options...', len(evafs))
+            pending = journal.pending(city, evafs.keys())
+            links_prompts = {number: prompts['links'].format(event=evafs[number], city=city, country=country) for number in pending}
+            responses = complete_responses(links_prompts, get_responses_GPT(links_prompts), SCHEMAS['events_festivals_pmt.links'])
+            # options completed in earlier runs are taken from the journal
+            data = journal.city_results(city)
+            for number in pending:
+                set_context(option=number)
+                option = evafs[number]
+                logger.info('Starting %s:%s...', number, option)
                 try:                 
-                    # generating links
-                    logger.info(f'Crafting prompt for generating links using ChatGPT...')
-                    prompt = prompts['links'].format(event=option, city=city, country=country)
-                    logger.info(f'Prompt crafted successfully')
-                    # getting response from GPT
-                    logger.info(f'Getting response from ChatGPT...')
-                    response = get_response_GPT(prompt)
-                    if not response:
-                        logger.warning(f'No response got for {number}:{option}. No links wll be added')
+                    parsed = responses[number]
+                    if isinstance(parsed, SchemaError):
+                        logger.warning('No valid response got for %s:%s (%s). No links wll be added', number, option, parsed)
                         parsed = {'links':[]}
                     else:
-                        logger.info(f'Got response successfully')
-                        # parsing response
-                        logger.info(f'Parsing response...')
-                        response = response.replace(']]', ']}').replace('}.', '}').replace('}"', '}')
-                        parsed = json.loads(response)
-                        logger.info(f'Response is parsed successfully')
-                        logger.info(f'Links checking...')
-                        parsed['links'] = [link for link in parsed['links'] if is_valid_link(link)]
+                        logger.info('Got and validated response successfully')
+                        logger.info('Links checking...')
+                        parsed['links'] = filter_valid_links(parsed['links'])
                     
                     # adding all keys
                     data[number] = dict()
@@ -66,51 +69,51 @@ def change_to():
                     data[number]['title'] = seo_content[number]['title']
                     data[number]['text'] = seo_content[number]['description']
                     data[number]['links'] = parsed['links']
-                    logger.info(f"{data[number]['links']} added successfully")
+                    logger.info("%s added successfully", data[number]['links'])
                    
                     # adding images     
                     logger.info('Adding image urls...')               
-                    image_path = next(Path(f'{IMG_DIR}/events_festivals/{city_}').glob(f'{number}_*.jpg'))
-                    image_url = [f'{base_url}/{city_}/{image_path.name}']
+                    # a missing image raises KeyError
+                    image_url = [get_image_index().url('events_festivals', city, number)]
                     data[number]['images'] = image_url
                     logger.info('Image urls are added successfully')
-                    logger.info(f'Completed {number}: {option}...SUCCESS')
+                    journal.record(city, number, data[number])
+                    logger.info('Completed %s: %s...SUCCESS', number, option)
                      
                 except KeyError as err:
-                    logger.error(f'KeyError: {err} while {number}:{option} in {city}, {country}')
+                    logger.error('KeyError: %s while %s:%s in %s, %s', err, number, option, city, country)
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
                 except AttributeError as err:
-                    logger.error(f'AttributeError: {err} while {number}:{option} in {city}, {country}')
+                    logger.error('AttributeError: %s while %s:%s in %s, %s', err, number, option, city, country)
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
                 except TypeError as err:
-                    logger.error(f'TypeError: {err} while {number}:{option} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in TypeError except')
+                    logger.error('TypeError: %s while %s:%s in %s, %s', err, number, option, city, country)
+                    logger.error('data%s was deleted in TypeError except', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue   
                 except StopIteration as err:
-                    logger.error(f'{err} for {number}:{option} in {city}, {country}')
-                    logger.error(f'data{[number]} was deleted in StopIteration except')
+                    logger.error('%s for %s:%s in %s, %s', err, number, option, city, country)
+                    logger.error('data%s was deleted in StopIteration except', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
-                except json.decoder.JSONDecodeError as err:
-                    # logger.error(f'Error character: " {response[err.colno - 1]} "')
-                    logger.error(f'JSONDecodeError: {err} while {number}:{option} in {city}, {country}')
-                    parsed = {'links':[]}
-                    pass
                 except Exception as err:
                     logger.error(err)
-                    logger.error(f'data{[number]} was deleted in Exception')
+                    logger.error('data%s was deleted in Exception', [number])
+                    journal.fail(city, number, err)
                     del data[number]
                     continue
         except FileNotFoundError as err:
             logger.error(err)
             continue
-        # saving data to json
-        with open(f'{SEO_FESTIVALS_DIR}/{city_}.json', 'w') as fp:
-            json.dump(data, fp, indent=4)
-        logger.info(f'Finish processing {city}, {country}...SUCCESS, total score {j + 1}/{dp.get_numrows()}')
+        # saving data to the store and its json
+        get_store().save_city('events_festivals', city, data, SEO_FESTIVALS_DIR)
+        logger.info('Finish processing %s, %s...SUCCESS, total score %s/%s', city, country, j + 1, dp.get_numrows())
         j += 1
     
     
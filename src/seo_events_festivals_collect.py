@@ -1,56 +1,57 @@
 import json
 from pathlib import Path
-from datetime import datetime
 
 from logger import logger_setup
-from functions import get_response_GPT, get_prompts_GPT, is_valid_link, elapsed_time
+from functions import get_prompts_GPT, elapsed_time
 from config import PROMPTS_DIR, IMG_DIR, OPTION_LISTS_DIR, SEO_FESTIVALS_DIR
-from data_provider import CSVDataProvider
+from data_provider import get_provider
+from journal import Journal
+from ledger import set_context
+from response_schema import SCHEMAS, SchemaError, get_structured_response
+from content_store import get_store
 
 
-timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-logger = logger_setup(f'{Path(__file__).stem}_{timestamp}')
-dp = CSVDataProvider()
+logger = logger_setup(Path(__file__).stem)
+dp = get_provider()
 
 
 @elapsed_time    
-def change_to():
+def change_to(replay_failed=False):
     prompts = get_prompts_GPT(f'{PROMPTS_DIR}/events_festivals_pmt.json')
+    journal = Journal('events_festivals_content')
 
     # cities countries loop
     j = 0
     for city, country in [cc for cc in dp.gen_data() if cc[0] == 'Naypyidaw']:
-        logger.info(f'\nProcessing {city.upper()}, {country.upper()}...')
-        city_ = city.replace('-', '_').replace(' ', '_')
+        if replay_failed and city not in journal.failed_cities(): continue
+        set_context(category='events_festivals_content', city=city, option=None)
+        logger.info('\nProcessing %s, %s...', city.upper(), country.upper())
+        city_ = dp.get_city_slug(city)
         try:
             # getting children options list for given city
             evafs_path = f'{OPTION_LISTS_DIR}/events_festivals/{city_}.json'
             with open(evafs_path, 'r') as fp:
                 evafs = json.load(fp)
-            logger.info(f'Events and Festivals list is retrieved for {city} successfully')
+            logger.info('Events and Festivals list is retrieved for %s successfully', city)
             # getting json with seo content for the same city
             seo_path = f'{SEO_FESTIVALS_DIR}_copy/{city_}.json' 
             with open(seo_path, 'r') as fp:
                 seo_content = json.load(fp)
-            logger.info(f'Seo content is retrieved for {city} successfully')
+            logger.info('Seo content is retrieved for %s successfully', city)
             if not seo_content:
-                logger.warning(f'SEO_content is empty. Trying to generate it...')
-                data = dict()
-                for number, option in evafs.items():
-                    logger.info(f'Starting {number}:{option}...')
+                logger.warning('SEO_content is empty. Trying to generate it...')
+                # options completed in earlier runs are taken from the journal
+                data = journal.city_results(city)
+                for number in journal.pending(city, evafs.keys()):
+                    set_context(option=number)
+                    option = evafs[number]
+                    logger.info('Starting %s:%s...', number, option)
                     try:
-                        logger.info(f'Crafting prompt for generating content using ChatGPT...')
+                        logger.info('Crafting prompt for generating content using ChatGPT...')
                         prompt = prompts['content'].format(event=option, city=city, country=country)
-                        response = get_response_GPT(prompt)
-                        if not response:
-                            logger.warning(f'No response got for {number}:{option}. Continue with next option')
-                            continue
-                        logger.info(f'Got response successfully')
-                        # parsing response
-                        logger.info(f'Parsing response...')
-                        response = response.replace(']]', ']}').replace('}.', '}').replace('}"', '}')
-                        parsed = json.loads(response)
-                        logger.info(f'Response is parsed successfully')
+                        # the response is repaired and validated, missing fields are asked again
+                        parsed = get_structured_response(prompt, SCHEMAS['events_festivals_pmt.content'])
+                        logger.info('Got and validated response successfully')
                         # saving value into a new key 'number'
                         data[number] = dict()
                         data[number]['name'] = option
@@ -58,50 +59,53 @@ def change_to():
                         data[number]['keywords'] = parsed['keywords']
                         data[number]['title'] = parsed['title']
                         data[number]['description'] = parsed['text']
+                        journal.record(city, number, data[number])
                         
-                        logger.info(f'Completed {number}: {option}...SUCCESS')
+                        logger.info('Completed %s: %s...SUCCESS', number, option)
                         
                     except KeyError as err:
-                        logger.error(f'{err} while {number}:{option} in {city}, {country}')
+                        logger.error('%s while %s:%s in %s, %s', err, number, option, city, country)
+                        journal.fail(city, number, err)
                         del data[number]
-                        logger.error(f'data{[number]} was deleted in KeyError except')
+                        logger.error('data%s was deleted in KeyError except', [number])
                         continue
                     except AttributeError as err:
-                        logger.error(f'{err} while {number}:{option} in {city}, {country}')
-                        logger.error(f'data{[number]} was deleted in AttributeError except')
+                        logger.error('%s while %s:%s in %s, %s', err, number, option, city, country)
+                        logger.error('data%s was deleted in AttributeError except', [number])
+                        journal.fail(city, number, err)
                         del data[number]
                         continue
                     except TypeError as err:
-                        logger.error(f'{err} while {number}:{option} in {city}, {country}')
-                        logger.error(f'data{[number]} was deleted in TypeError except')
+                        logger.error('%s while %s:%s in %s, %s', err, number, option, city, country)
+                        logger.error('data%s was deleted in TypeError except', [number])
+                        journal.fail(city, number, err)
                         del data[number]
                         continue   
                     except StopIteration as err:
-                        logger.error(f'{err} for {number}:{option} in {city}, {country}')
-                        logger.error(f'data{[number]} was deleted in StopIteration except')
+                        logger.error('%s for %s:%s in %s, %s', err, number, option, city, country)
+                        logger.error('data%s was deleted in StopIteration except', [number])
+                        journal.fail(city, number, err)
                         del data[number]
                         continue
-                    except json.decoder.JSONDecodeError as err:
-                        logger.error(f'Error character: " {response[err.colno - 1]} "')
-                        logger.error(f'{err} for {number}:{option} in {city}, {country}')
-                        logger.error(f'data{[number]} was deleted in JSONDecodeErrors')
-                        # del data[number]
+                    except SchemaError as err:
+                        logger.error('%s for %s:%s in %s, %s', err, number, option, city, country)
+                        journal.fail(city, number, err)
                         continue
                     except Exception as err:
                         logger.error(err)
-                        logger.error(f'data{[number]} was deleted in Exception')
+                        logger.error('data%s was deleted in Exception', [number])
+                        journal.fail(city, number, err)
                         del data[number]
                         continue
             
-                # saving renewed date to json
-                with open(f'{SEO_FESTIVALS_DIR}_copy/{city_}.json', 'w') as fp:
-                    json.dump(data, fp, indent=4)
+                # saving renewed date to the store and its json
+                get_store().save_city('events_festivals_content', city, data, f'{SEO_FESTIVALS_DIR}_copy')
     
         except FileNotFoundError as err:
             logger.error(err)
             continue
         
-        logger.info(f'Finish processing {city}, {country}...SUCCESS, total score {j + 1}/{dp.get_numrows()}')
+        logger.info('Finish processing %s, %s...SUCCESS, total score %s/%s', city, country, j + 1, dp.get_numrows())
         j += 1
     
     
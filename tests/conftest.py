@@ -0,0 +1,20 @@
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT/'src'))
+
+# config.py is local to every machine and not in the repo, the tests use their own folders
+_data = Path(tempfile.mkdtemp(prefix='content_tests_'))
+config = types.ModuleType('config')
+config.CITIES_COUNTRIES_CSV = ROOT/'files'/'cities_countries.csv'
+config.LOGS_DIR = _data/'logs'
+config.LOG_FORMATTER = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+for name in ('IMG_DIR', 'POSTS_DIR', 'PROMPTS_DIR', 'OPTION_LISTS_DIR', 'SEO_TEXTS_DIR', 'SMM_DIR', 'SMM_CITY_ATTRACTIONS_FP_DIR',
+             'SEO_CITY_DESCRIPTIONS_DIR', 'SEO_CITY_ATTRACTIONS_DIR', 'SEO_CHILDREN_ATTRACTIONS_DIR', 'SEO_FESTIVALS_DIR',
+             'CITY_ATTRACTIONS_LIST_DIR', 'CHILDREN_ATTRACTIONS_LIST_DIR'):
+    setattr(config, name, _data/name.lower())
+sys.modules['config'] = config
@@ -0,0 +1,26 @@
+from bench import compare
+
+
+def result(ops_per_s=100.0, peak_rss_mb=100.0, error=None):
+    return {'ops_per_s': ops_per_s, 'peak_rss_mb': peak_rss_mb, 'error': error}
+
+
+BASELINE = {'results': {'resize': result(), 'broken': result(error='ValueError')}}
+
+
+def test_no_regressions_within_the_tolerance():
+    assert compare({'resize': result(ops_per_s=85, peak_rss_mb=115)}, BASELINE, tolerance=0.2) == []
+
+
+def test_slower_and_bigger_are_regressions():
+    regressions = compare({'resize': result(ops_per_s=70, peak_rss_mb=130)}, BASELINE, tolerance=0.2)
+    assert len(regressions) == 2
+    assert all(message.startswith('resize:') for message in regressions)
+
+
+def test_an_error_is_a_regression_against_a_passing_baseline():
+    assert compare({'resize': result(error='MemoryError')}, BASELINE) == ['resize: failed with MemoryError, baseline passed']
+
+
+def test_benchmarks_without_a_passing_baseline_are_skipped():
+    assert compare({'broken': result(error='ValueError'), 'new': result(ops_per_s=1)}, BASELINE) == []
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from content_store import ContentStore, WHOLE
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ContentStore(tmp_path/'content.sqlite')
+
+
+def test_round_trip(store):
+    store.upsert_city('cheap_eats', 'Paris', {1: {'title': 'a'}, 2: {'title': 'b'}})
+    assert store.get('cheap_eats', 'Paris', 1) == {'title': 'a'}
+    assert store.get_city('cheap_eats', 'Paris') == {'1': {'title': 'a'}, '2': {'title': 'b'}}
+    assert store.get('cheap_eats', 'Paris', 3) is None
+    assert store.cities('cheap_eats') == ['Paris']
+    assert store.get_city('cheap_eats', 'Paris', language='ru') == {}
+
+
+def test_upsert_replaces_an_option_and_keeps_the_order(store):
+    store.upsert_city('cheap_eats', 'Paris', {1: 'a', 2: 'b', 3: 'c'})
+    store.upsert('cheap_eats', 'Paris', 1, 'A')
+    assert store.get_city('cheap_eats', 'Paris') == {'1': 'A', '2': 'b', '3': 'c'}
+    assert list(store.get_city('cheap_eats', 'Paris')) == ['1', '2', '3']
+
+
+def test_upsert_city_with_replace_drops_the_other_options(store):
+    store.upsert_city('cheap_eats', 'Paris', {1: 'a', 2: 'b'})
+    store.upsert_city('cheap_eats', 'Paris', {2: 'B'})
+    assert store.get_city('cheap_eats', 'Paris') == {'1': 'a', '2': 'B'}
+    store.upsert_city('cheap_eats', 'Paris', {2: 'B'}, replace=True)
+    assert store.get_city('cheap_eats', 'Paris') == {'2': 'B'}
+
+
+def test_update_sets_some_fields(store):
+    store.upsert('city_descriptions', 'Paris', WHOLE, {'text': 'a', 'images': []})
+    assert store.update('city_descriptions', 'Paris', images=['x.jpg']) == {'text': 'a', 'images': ['x.jpg']}
+    assert store.get('city_descriptions', 'Paris') == {'text': 'a', 'images': ['x.jpg']}
+    with pytest.raises(KeyError):
+        store.update('city_descriptions', 'Rome', images=[])
+
+
+def test_a_failed_transaction_is_rolled_back(store):
+    store.upsert_city('cheap_eats', 'Paris', {1: 'a'})
+    with pytest.raises(TypeError):
+        store.upsert_city('cheap_eats', 'Paris', {2: object()}, replace=True)
+    assert store.get_city('cheap_eats', 'Paris') == {'1': 'a'}
+
+
+def test_export_writes_the_site_layout(store, tmp_path):
+    store.upsert('city_descriptions', 'Rio de Janeiro', WHOLE, {'text': 'a'})
+    store.upsert_city('cheap_eats', 'Rio de Janeiro', {1: {'title': 'é'}})
+    path = store.export_city('city_descriptions', 'Rio de Janeiro', tmp_path/'descriptions')
+    assert path == tmp_path/'descriptions'/'Rio_de_Janeiro.json'
+    assert json.loads(path.read_text()) == {'text': 'a'}
+    path = store.save_city('cheap_eats', 'Rio de Janeiro', {1: {'title': 'é'}}, tmp_path/'cheap_eats', ensure_ascii=False)
+    assert '"é"' in path.read_text(encoding='utf-8')
+    assert json.loads(path.read_text(encoding='utf-8')) == {'1': {'title': 'é'}}
+    assert store.export_city('cheap_eats', 'Rome', tmp_path/'cheap_eats') is None
+    assert store.export('cheap_eats', tmp_path/'all') == 1
+
+
+def test_import_dir_round_trip(store, tmp_path, monkeypatch):
+    import data_provider
+    monkeypatch.setattr(data_provider, 'SNAPSHOT_DIR', tmp_path/'snapshots')
+    csv = tmp_path/'cities.csv'
+    csv.write_text('id_city,city,country\n1,Rio de Janeiro,Brazil\n', encoding='utf-8')
+    store.upsert_city('cheap_eats', 'Rio de Janeiro', {1: {'title': 'a'}, 2: {'title': 'b'}})
+    store.export('cheap_eats', tmp_path/'cheap_eats')
+    imported = ContentStore(tmp_path/'imported.sqlite')
+    assert imported.import_dir('cheap_eats', tmp_path/'cheap_eats', provider=data_provider.CSVDataProvider(csv)) == 1
+    assert imported.get_city('cheap_eats', 'Rio de Janeiro') == store.get_city('cheap_eats', 'Rio de Janeiro')
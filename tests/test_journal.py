@@ -0,0 +1,54 @@
+from journal import Journal
+
+
+def test_results_are_replayed_from_disk(tmp_path):
+    journal = Journal('test', tmp_path/'test.jsonl')
+    journal.record('Paris', 1, {'text': 'a'})
+    journal.fail('Paris', 2, ValueError('bad'))
+    journal.record('Rome', 'options', ['x'])
+
+    replayed = Journal('test', tmp_path/'test.jsonl')
+    assert replayed.get('Paris', '1') == {'text': 'a'}
+    assert replayed.pending('Paris', ['1', '2', '3']) == ['2', '3']
+    assert replayed.failed == {('Paris', '2'): 'ValueError: bad'}
+    assert replayed.failed_cities() == {'Paris'}
+    assert replayed.city_results('Rome') == {'options': ['x']}
+
+
+def test_the_last_record_of_an_option_wins(tmp_path):
+    journal = Journal('test', tmp_path/'test.jsonl')
+    journal.fail('Paris', 1, 'timeout')
+    journal.record('Paris', 1, 'done')
+    replayed = Journal('test', tmp_path/'test.jsonl')
+    assert replayed.is_done('Paris', 1)
+    assert not replayed.failed
+
+
+def test_a_torn_last_line_is_skipped(tmp_path):
+    journal = Journal('test', tmp_path/'test.jsonl')
+    journal.record('Paris', 1, 'done')
+    with open(journal.path, 'a') as fp:
+        fp.write('{"status": "done", "city": "Paris", "opt')
+    assert Journal('test', tmp_path/'test.jsonl').city_results('Paris') == {'1': 'done'}
+
+
+def test_reset_forgets_a_city(tmp_path):
+    journal = Journal('test', tmp_path/'test.jsonl')
+    journal.record('Paris', 1, 'done')
+    journal.fail('Paris', 2, 'error')
+    journal.record('Rome', 1, 'done')
+    journal.reset('Paris')
+    for replayed in (journal, Journal('test', tmp_path/'test.jsonl')):
+        assert replayed.city_results('Paris') == {}
+        assert replayed.failed_cities() == set()
+        assert replayed.city_results('Rome') == {'1': 'done'}
+
+
+def test_reset_forgets_only_the_given_options(tmp_path):
+    journal = Journal('test', tmp_path/'test.jsonl')
+    for option in (1, 2, 3):
+        journal.record('Paris', option, option)
+    journal.reset('Paris', [2, 3])
+    journal.record('Paris', 3, 'again')
+    for replayed in (journal, Journal('test', tmp_path/'test.jsonl')):
+        assert replayed.city_results('Paris') == {'1': 1, '3': 'again'}
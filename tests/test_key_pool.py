@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+import key_pool
+from key_pool import ApiKey, KeyPool, NoKeyAvailable
+from rate_limiter import RateLimiter
+
+
+class APIError(Exception):
+    def __init__(self, http_status, code=None, headers=None):
+        super().__init__(f'{http_status} {code}')
+        self.http_status, self.code, self.headers = http_status, code, headers
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(key_pool, 'get_limiter', lambda key, rpm, tpm: RateLimiter(key, rpm, tpm, tmp_path/'limits.sqlite'))
+    return KeyPool([ApiKey('KEY_1', rpm=10), ApiKey('KEY_2', rpm=10)])
+
+
+def test_checkout_takes_the_key_with_the_most_budget(pool):
+    first = pool.checkout(100)
+    assert pool.checkout(100) is not first
+
+
+def test_a_rate_limited_key_is_skipped(pool):
+    limited = pool.keys[0]
+    pool.report_error(limited, APIError(429, headers={'Retry-After': '30'}))
+    assert limited.fatal_error is None
+    assert all(pool.checkout() is pool.keys[1] for _ in range(3))
+
+
+def test_every_key_fatal_fails_at_once(pool):
+    pool.report_error(pool.keys[0], APIError(429, code='insufficient_quota'))
+    pool.report_error(pool.keys[1], APIError(401))
+    start = time.monotonic()
+    with pytest.raises(NoKeyAvailable):
+        pool.checkout()
+    assert time.monotonic() - start < 1
+
+
+def test_the_wait_stops_at_the_deadline(pool):
+    for key in pool.keys:
+        pool.report_error(key, APIError(429, headers={'Retry-After': '60'}))
+    with pytest.raises(NoKeyAvailable):
+        pool.checkout(deadline=time.monotonic() + 1)
+
+
+def test_other_errors_keep_the_key(pool):
+    pool.report_error(pool.keys[0], APIError(500))
+    assert pool.keys[0].cooldown_until == 0.0
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import journal
+from ledger import get_context, set_context
+from pipeline import Pipeline, Stage, load_options
+
+
+@pytest.fixture
+def options_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, 'JOURNAL_DIR', tmp_path/'journal')
+    path = tmp_path/'options.json'
+    path.write_text(json.dumps({'1': 'a', '2': 'b', '3': 'c'}))
+    return path
+
+
+def option_stage(tmp_path, options_file, runs):
+    output = tmp_path/'output.json'
+
+    def run(cities):
+        log = journal.Journal('options')
+        for city, _ in cities:
+            pending = log.pending(city, load_options(options_file))
+            runs.append((city, pending, dict(get_context())))
+            for option in pending: log.record(city, option, option)
+            set_context(city=city)
+        output.write_text('{}')
+
+    return Stage('options', run, inputs=lambda city, country: [options_file], outputs=lambda city, country: [output],
+                 journal='options', options=lambda city, country: load_options(options_file))
+
+
+def test_only_changed_options_are_rebuilt(tmp_path, options_file):
+    runs = []
+    cities = [('Paris', 'France')]
+    Pipeline([option_stage(tmp_path, options_file, runs)], tmp_path/'state.json').run(cities)
+    options_file.write_text(json.dumps({'1': 'a', '2': 'B', '4': 'd'}))
+    Pipeline([option_stage(tmp_path, options_file, runs)], tmp_path/'state.json').run(cities)
+    Pipeline([option_stage(tmp_path, options_file, runs)], tmp_path/'state.json').run(cities)
+    assert [pending for _, pending, _ in runs] == [['1', '2', '3'], ['2', '4']]
+    # the removed option is dropped from the results too
+    assert journal.Journal('options').city_results('Paris') == {'1': '1', '2': '2', '4': '4'}
+
+
+def test_stages_run_in_dependency_order_with_their_own_context(tmp_path):
+    order = []
+
+    def stage(name, depends_on=()):
+        def run():
+            order.append((name, dict(get_context())))
+            set_context(category=name)
+        return Stage(name, run, inputs=lambda: [], outputs=lambda: [tmp_path/name], depends_on=depends_on, per_city=False)
+
+    set_context(category=None)
+    Pipeline([stage('b', ('a',)), stage('a')], tmp_path/'state.json').run([], workers=1)
+    assert order == [('a', {'category': None, 'stage': 'a'}), ('b', {'category': None, 'stage': 'b'})]
+
+
+def test_dependency_cycles_are_rejected(tmp_path):
+    stages = [Stage(name, print, inputs=list, outputs=list, depends_on=(dep,)) for name, dep in (('a', 'b'), ('b', 'a'))]
+    with pytest.raises(ValueError):
+        Pipeline(stages, tmp_path/'state.json')
@@ -0,0 +1,49 @@
+import pytest
+
+from rate_limiter import RateLimiter
+
+
+def test_acquire_waits_when_the_requests_run_out(tmp_path):
+    limiter = RateLimiter('key', rpm=120, tpm=None, path=tmp_path/'limits.sqlite')
+    for _ in range(120):
+        assert limiter.acquire() == 0
+    # one request refills every 0.5 s
+    assert 0 < limiter.acquire() <= 0.5
+
+
+def test_acquire_waits_for_tokens(tmp_path):
+    limiter = RateLimiter('key', rpm=1000, tpm=6000, path=tmp_path/'limits.sqlite')
+    assert limiter._try_acquire(6000) == 0
+    # 100 tokens refill per second
+    assert limiter._try_acquire(50) == pytest.approx(0.5, abs=0.05)
+
+
+def test_buckets_are_shared_through_the_file(tmp_path):
+    first = RateLimiter('key', rpm=2, tpm=None, path=tmp_path/'limits.sqlite')
+    second = RateLimiter('key', rpm=2, tpm=None, path=tmp_path/'limits.sqlite')
+    other = RateLimiter('other', rpm=2, tpm=None, path=tmp_path/'limits.sqlite')
+    assert first._try_acquire(0) == 0 and second._try_acquire(0) == 0
+    assert first._try_acquire(0) > 0
+    assert other._try_acquire(0) == 0
+
+
+def test_settle_refunds_a_rejected_request(tmp_path):
+    limiter = RateLimiter('key', rpm=100, tpm=1000, path=tmp_path/'limits.sqlite')
+    limiter.acquire(400)
+    limiter.settle(400, 0)
+    assert limiter.remaining()[1] == pytest.approx(1.0)
+
+
+def test_settle_charges_the_overdraft(tmp_path):
+    limiter = RateLimiter('key', rpm=100, tpm=1000, path=tmp_path/'limits.sqlite')
+    limiter.acquire(100)
+    limiter.settle(100, 700)
+    assert limiter.remaining()[1] == pytest.approx(0.3, abs=0.01)
+
+
+def test_settle_clamps_the_reservation_like_the_debit(tmp_path):
+    limiter = RateLimiter('key', rpm=100, tpm=1000, path=tmp_path/'limits.sqlite')
+    # only the tpm is debited for a reservation above it
+    limiter.acquire(5000)
+    limiter.settle(5000, 200)
+    assert limiter.remaining()[1] == pytest.approx(0.8, abs=0.01)
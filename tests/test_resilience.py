@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from resilience import RetryPolicy, call_with_retry, classify, parse_retry_after
+
+
+class APIError(Exception):
+    def __init__(self, http_status=None, code=None, headers=None):
+        super().__init__(f'{http_status} {code}')
+        self.http_status, self.code, self.headers = http_status, code, headers
+
+
+class Timeout(Exception):
+    pass
+
+
+@pytest.mark.parametrize('err, retry', [
+    (APIError(429, headers={'Retry-After': '2'}), True),
+    (APIError(503), True),
+    (APIError(429, code='insufficient_quota'), False),
+    (APIError(401), False),
+    (APIError(400), False),
+    (Timeout(), True),
+    (asyncio.TimeoutError(), True),
+    (KeyError('x'), False),
+])
+def test_classify(err, retry):
+    assert classify(err)[0] is retry
+
+
+def test_retry_after():
+    assert classify(APIError(429, headers={'Retry-After': '2'}))[1] == 2
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+
+
+def test_transient_errors_are_retried():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3: raise APIError(503)
+        return 'ok'
+
+    assert call_with_retry(flaky, policy=RetryPolicy(attempts=5, base_delay=0.0)) == 'ok'
+    assert len(calls) == 3
+
+
+def test_fatal_errors_are_not_retried():
+    calls = []
+
+    def rejected():
+        calls.append(1)
+        raise APIError(401)
+
+    with pytest.raises(APIError):
+        call_with_retry(rejected, policy=RetryPolicy(attempts=5, base_delay=0.0))
+    assert len(calls) == 1
+
+
+def test_no_retry_past_the_deadline():
+    calls = []
+
+    def limited():
+        calls.append(1)
+        raise APIError(429, headers={'Retry-After': '10'})
+
+    with pytest.raises(APIError):
+        call_with_retry(limited, policy=RetryPolicy(attempts=5, deadline=1.0))
+    assert len(calls) == 1
@@ -0,0 +1,38 @@
+import pytest
+
+from response_schema import Schema, repair_json
+
+
+@pytest.mark.parametrize('response, expected', [
+    ('{"a": 1}', {'a': 1}),
+    ('```json\n{"a": 1}\n```', {'a': 1}),
+    ('Sure! Here is the JSON:\n{"a": [1, 2]}\nHope it helps.', {'a': [1, 2]}),
+    ('{"a": [1, 2,], "b": "x",}', {'a': [1, 2], 'b': 'x'}),
+    ('{“a”: “b”}', {'a': 'b'}),
+    ('[1, 2, 3]', [1, 2, 3]),
+])
+def test_repairs(response, expected):
+    assert repair_json(response) == expected
+
+
+def test_string_values_are_not_touched():
+    assert repair_json('{"a": "x,}", "b": "say “hi”",}') == {'a': 'x,}', 'b': 'say “hi”'}
+
+
+def test_the_value_cut_by_truncation_is_dropped():
+    assert repair_json('{"title": "T", "links": ["http://a.com", "http://b') == {'title': 'T'}
+    assert repair_json('{"title": "T", "text": "Once upon') == {'title': 'T'}
+    assert repair_json('[{"a": 1}, {"a": 2}, {"a": 3') == [{'a': 1}, {'a': 2}]
+
+
+@pytest.mark.parametrize('response', ['', None, 'no json here', '{"a": '])
+def test_unrepairable(response):
+    assert not repair_json(response)
+
+
+def test_schema_validation():
+    schema = Schema({'title': str, 'keywords': (str, list), 'links': list})
+    valid, problems = schema.validate({'title': '  ', 'keywords': ['a'], 'links': []})
+    assert valid == {'keywords': ['a'], 'links': []}
+    assert problems == ['title']
+    assert schema.validate(['not', 'a', 'dict'])[1] == ['title', 'keywords', 'links']